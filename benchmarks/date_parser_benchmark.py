@@ -0,0 +1,51 @@
+"""
+Mide el rendimiento del parser de fechas (src/utils/date_parser.py):
+formas rápidas sin caché, entradas repetidas (caché LRU) y el parser genérico de respaldo.
+
+Uso:
+    python -m benchmarks.date_parser_benchmark [repeticiones]
+"""
+import sys
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from src.utils import date_parser
+from src.utils.date_parser import parse_date_text
+
+TIMEZONE = "America/Argentina/Buenos_Aires"
+
+FAST_INPUTS = [
+    "hoy 18:00", "mañana", "Mañana a las 9", "pasado mañana 6pm", "en 3 días", "dentro de 2 semanas",
+    "lunes", "el viernes a las 18", "sábado 10:30", "25/12/2025 18:00", "25/12", "3 de marzo",
+]
+# Formas que no cubren las rutas rápidas y pasan por dateparser
+FALLBACK_INPUTS = ["next monday", "el primer día de diciembre", "diciembre 25", "mañana por la tarde"]
+
+
+def measure(inputs: list[str], repetitions: int, clear_cache: bool) -> float:
+    """Devuelve parseos por segundo."""
+    now = datetime.now(ZoneInfo(TIMEZONE))
+    parse_date_text(inputs[0], TIMEZONE, now) # Calentamiento (imports perezosos)
+    started = time.perf_counter()
+    for _ in range(repetitions):
+        if clear_cache:
+            date_parser._parse_cached.cache_clear()
+        for text in inputs:
+            parse_date_text(text, TIMEZONE, now)
+    return repetitions * len(inputs) / (time.perf_counter() - started)
+
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f"{repetitions} repeticiones")
+    print(f"  Formas rápidas, sin caché   {measure(FAST_INPUTS, repetitions, True):12,.0f} parseos/s")
+    print(f"  Formas rápidas, con caché   {measure(FAST_INPUTS, repetitions, False):12,.0f} parseos/s")
+    fallback_repetitions = max(1, repetitions // 100)
+    print(f"  dateparser, sin caché       {measure(FALLBACK_INPUTS, fallback_repetitions, True):12,.0f} parseos/s")
+    print(f"  dateparser, con caché       {measure(FALLBACK_INPUTS, repetitions, False):12,.0f} parseos/s")
+    print(f"  {date_parser._parse_cached.cache_info()}")
+
+
+if __name__ == "__main__":
+    main()
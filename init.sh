@@ -31,6 +31,12 @@ echo "--- FIN DE SECCIÓN DE DEPURACIÓN ---"
 # Iniciar el bot de Telegram
 # La inicialización de la base de datos y la carga de hábitos
 # ahora se manejan exclusivamente en la función post_init de productivity_habits_bot.py
+# Con BOT_MODE=dispatcher el contenedor corre solo el scheduler y los envíos salientes
+if [ "${BOT_MODE:-all}" = "dispatcher" ]; then
+    echo "Iniciando el dispatcher (scheduler + envíos salientes)..."
+    exec python -m src.bot.dispatcher
+fi
+
 echo "Iniciando el bot de Telegram..."
 # Cambiado a 'python -m src.bot.productivity_habits_bot' para ejecutar como módulo
 exec python -m src.bot.productivity_habits_bot
@@ -3,9 +3,6 @@ import logging
 import os
 from dotenv import load_dotenv
 
-# Importa la función 'main' de tu bot
-from src.bot.productivity_habits_bot import main as run_bot_application_sync
-
 # Cargar variables de entorno desde .env (útil para desarrollo local)
 load_dotenv()
 
@@ -16,6 +13,15 @@ logging.basicConfig(
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
 if __name__ == "__main__":
-    logging.info("Iniciando la aplicación del bot...")
-    # Llama a la función 'main' del bot, que es la que gestionará asyncio.run()
-    run_bot_application_sync()
\ No newline at end of file
+    # BOT_MODE='dispatcher' arranca solo el scheduler y los envíos salientes;
+    # 'bot' y 'all' arrancan el bot interactivo (ver src/utils/scheduler.py)
+    if os.getenv("BOT_MODE", "all").strip().lower() == "dispatcher":
+        from src.bot.dispatcher import main as run_dispatcher_sync
+        logging.info("Iniciando el proceso dispatcher...")
+        run_dispatcher_sync()
+    else:
+        # Importa la función 'main' de tu bot
+        from src.bot.productivity_habits_bot import main as run_bot_application_sync
+        logging.info("Iniciando la aplicación del bot...")
+        # Llama a la función 'main' del bot, que es la que gestionará asyncio.run()
+        run_bot_application_sync()
@@ -0,0 +1,82 @@
+import os
+import asyncio
+import logging
+import signal
+
+from src.database.database_interation import load_default_habits
+from src.database.db_context import get_db, init_db_async
+from src.utils.scheduler import (
+    setup_scheduler, schedule_all_due_tasks_for_persistence,
+    schedule_habit_digests, schedule_metrics_jobs, schedule_task_archiving, schedule_stats_rollup,
+    process_scheduler_commands
+)
+from src.utils.outbound import shutdown_outbound_bot
+from src.utils.metrics import start_metrics_server, stop_metrics_server
+from src.utils.logger_config import configure_logging
+
+# Configuración del logger para este módulo
+configure_logging()
+logger = logging.getLogger(__name__)
+
+# Cada cuántos segundos se revisa la cola de órdenes que deja el bot interactivo
+DISPATCHER_POLL_INTERVAL = float(os.getenv("DISPATCHER_POLL_INTERVAL", "2"))
+DISPATCHER_BATCH_SIZE = int(os.getenv("DISPATCHER_BATCH_SIZE", "100"))
+
+
+async def run_dispatcher():
+    """
+    Proceso dispatcher: corre el scheduler persistente y los envíos salientes
+    (recordatorios de tareas y de hábitos) sin atender updates de Telegram.
+    El bot interactivo (BOT_MODE='bot') le delega el trabajo a través de la
+    tabla scheduler_commands.
+    """
+    logger.info("Dispatcher: Inicializando la base de datos y configurando el scheduler...")
+    await init_db_async()
+    async with get_db() as db:
+        await load_default_habits(db)
+
+    await start_metrics_server()
+    scheduler = setup_scheduler()
+    await schedule_all_due_tasks_for_persistence()
+    await schedule_habit_digests()
+    schedule_metrics_jobs()
+    schedule_task_archiving()
+    schedule_stats_rollup()
+    logger.info("Dispatcher: Scheduler listo. Esperando órdenes del bot interactivo...")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass # Windows no soporta add_signal_handler
+
+    try:
+        while not stop_event.is_set():
+            try:
+                processed = await process_scheduler_commands(DISPATCHER_BATCH_SIZE)
+            except Exception as e:
+                logger.error(f"Dispatcher: Error al procesar la cola de órdenes: {e}", exc_info=True)
+                processed = 0
+            if processed >= DISPATCHER_BATCH_SIZE:
+                continue # Quedan órdenes pendientes, seguir sin esperar
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=DISPATCHER_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        logger.info("Dispatcher: Deteniendo scheduler y cerrando conexiones...")
+        if scheduler.running:
+            scheduler.shutdown(wait=False)
+        await shutdown_outbound_bot()
+        await stop_metrics_server()
+
+
+def main() -> None:
+    logger.info("Iniciando el proceso dispatcher...")
+    asyncio.run(run_dispatcher())
+
+
+if __name__ == "__main__":
+    main()
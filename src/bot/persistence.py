@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import pickle
+import asyncio
+import logging
+from datetime import timedelta
+
+from telegram import Update
+from telegram.ext import BasePersistence, PersistenceInput, ConversationHandler, ContextTypes, TypeHandler
+
+from src.database.db_context import get_db, init_db_async
+from src.database.database_interation import load_persistence_rows, save_persistence_rows
+from src.utils import metrics
+from src.utils.conversation_state import CONVERSATION_TIMEOUT, CONVERSATION_USER_DATA_KEYS, release_user_data
+
+# Configuración del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Cada cuántos segundos la Application entrega a la persistencia el estado que cambió
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "30"))
+# Espera antes de escribir, para juntar en una sola transacción todos los cambios de una ronda
+PERSISTENCE_FLUSH_DELAY = float(os.getenv("PERSISTENCE_FLUSH_DELAY", "1"))
+
+USER_DATA_KIND = "user_data"
+CONVERSATION_KIND_PREFIX = "conversation:"
+
+metrics.describe("persistence_flush_seconds", "Duración de cada escritura por lotes del estado persistido.")
+metrics.describe("persistence_rows_total", "Filas del estado persistido escritas o eliminadas.")
+
+
+class DatabasePersistence(BasePersistence):
+    """
+    Persistencia de la Application en la tabla bot_persistence (user_data y conversaciones).
+    Los cambios se acumulan en memoria (un valor por clave, el último gana), se descartan
+    los que no modificaron el valor ya guardado y se escriben por lotes en una sola
+    transacción: tras cada ronda de actualización de la Application y al apagar el bot.
+
+    Cada estado de conversación se guarda con el instante de su última actualización. PTB no
+    reprograma el conversation_timeout de lo restaurado, así que al cargar se descartan las
+    conversaciones vencidas (limpiando sus claves de user_data) y stale_conversation_handler
+    cierra las que venzan después sin que el usuario haya vuelto a escribir.
+    """
+
+    def __init__(self, update_interval: float = PERSISTENCE_UPDATE_INTERVAL,
+                 conversation_timeout: float = CONVERSATION_TIMEOUT):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.conversation_timeout = conversation_timeout
+        self._user_data = None
+        self._conversations = None
+        # (nombre, clave de conversación) -> time.time() de la última actualización del estado
+        self._conversation_times = {}
+        self._load_lock = asyncio.Lock()
+        # (kind, key) -> datos serializados, o None para eliminar la fila
+        self._pending = {}
+        # (kind, key) -> hash de lo último guardado, para no reescribir valores sin cambios
+        self._saved_hashes = {}
+        self._flush_task = None
+        self._write_lock = asyncio.Lock()
+
+    async def _load(self):
+        """Carga (una sola vez) todo el estado guardado."""
+        async with self._load_lock:
+            if self._user_data is not None:
+                return
+            # La Application carga la persistencia antes de post_init: la tabla tiene que existir
+            await init_db_async()
+            async with get_db() as db:
+                rows = await load_persistence_rows(db)
+
+            user_data, conversations, expired = {}, {}, []
+            now = time.time()
+            for kind, key, data in rows:
+                try:
+                    value = pickle.loads(data)
+                except Exception as e:
+                    logger.warning(f"Se descarta el estado persistido ({kind}, {key}) por no poder leerse: {e}")
+                    continue
+                self._saved_hashes[(kind, key)] = hash(data)
+                if kind == USER_DATA_KIND:
+                    user_data[int(key)] = value
+                elif kind.startswith(CONVERSATION_KIND_PREFIX):
+                    name = kind.removeprefix(CONVERSATION_KIND_PREFIX)
+                    conversation_key = tuple(json.loads(key))
+                    # Las filas anteriores al instante de actualización son solo el estado: se dan por vencidas
+                    state, updated_at = (value["state"], value["updated_at"]) if isinstance(value, dict) else (value, None)
+                    if self.conversation_timeout > 0 and (updated_at is None or now - updated_at > self.conversation_timeout):
+                        expired.append((kind, key, name, conversation_key))
+                        continue
+                    self._conversation_times[(name, conversation_key)] = updated_at
+                    conversations.setdefault(name, {})[conversation_key] = state
+
+            for kind, key, name, conversation_key in expired:
+                self._mark(kind, key, None)
+                self._release_expired_keys(user_data, name, conversation_key)
+            self._user_data = user_data
+            self._conversations = conversations
+            logger.info(
+                f"Estado persistido cargado: {len(user_data)} usuarios, {sum(map(len, conversations.values()))} "
+                f"conversaciones ({len(expired)} vencidas descartadas)."
+            )
+
+    def _release_expired_keys(self, user_data: dict, name: str, conversation_key: tuple):
+        """Quita de user_data (ya cargado) las claves de una conversación vencida antes de entregarlo a la Application."""
+        # Los ConversationHandler del bot son por chat y usuario: el ID del usuario es el último elemento de la clave
+        user_id = conversation_key[-1]
+        data = user_data.get(user_id)
+        if not data:
+            return
+        for data_key in CONVERSATION_USER_DATA_KEYS.get(name, ()):
+            data.pop(data_key, None)
+        if not data:
+            del user_data[user_id]
+        self._mark(USER_DATA_KIND, str(user_id), data or None)
+
+    def conversation_expired(self, name: str, key: tuple, timeout: float) -> bool:
+        """True si el estado guardado de la conversación lleva más de `timeout` segundos sin actualizarse."""
+        updated_at = self._conversation_times.get((name, key))
+        return updated_at is not None and time.time() - updated_at > timeout
+
+    def _mark(self, kind: str, key: str, value):
+        """Registra un cambio pendiente. value=None elimina la fila."""
+        data = None if value is None else pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        item = (kind, key)
+        saved_hash = self._saved_hashes.get(item)
+        if data is None and saved_hash is None:
+            self._pending.pop(item, None) # Nunca se guardó: no hay fila que eliminar
+            return
+        if data is not None and saved_hash == hash(data):
+            self._pending.pop(item, None) # Igual a lo guardado
+            return
+        self._pending[item] = data
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(PERSISTENCE_FLUSH_DELAY)
+        # shield: si flush() cancela esta tarea durante la escritura, el lote se termina de guardar
+        await asyncio.shield(self._write_pending())
+
+    async def _write_pending(self):
+        async with self._write_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            upserts = [(kind, key, data) for (kind, key), data in batch.items() if data is not None]
+            deletes = [item for item, data in batch.items() if data is None]
+            started = time.monotonic()
+            try:
+                async with get_db() as db:
+                    await save_persistence_rows(db, upserts, deletes)
+            except Exception as e:
+                logger.error(f"No se pudo guardar el estado persistido ({len(batch)} cambios). Se reintentará: {e}")
+                # Se conservan los cambios más nuevos que hayan llegado mientras tanto
+                self._pending = {**batch, **self._pending}
+                return
+            for kind, key, data in upserts:
+                self._saved_hashes[(kind, key)] = hash(data)
+            for item in deletes:
+                self._saved_hashes.pop(item, None)
+            metrics.observe("persistence_flush_seconds", time.monotonic() - started)
+            metrics.increment("persistence_rows_total", {"op": "upsert"}, len(upserts))
+            metrics.increment("persistence_rows_total", {"op": "delete"}, len(deletes))
+
+    # --- Lectura (la Application las llama una vez al inicializarse) ---
+
+    async def get_user_data(self) -> dict:
+        await self._load()
+        return dict(self._user_data)
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        await self._load()
+        return dict(self._conversations.get(name, {}))
+
+    # --- Escritura ---
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._mark(USER_DATA_KIND, str(user_id), data if data else None)
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object) -> None:
+        if new_state is None:
+            self._conversation_times.pop((name, key), None)
+            self._mark(CONVERSATION_KIND_PREFIX + name, json.dumps(list(key)), None)
+            return
+        updated_at = time.time()
+        self._conversation_times[(name, key)] = updated_at
+        self._mark(CONVERSATION_KIND_PREFIX + name, json.dumps(list(key)), {"state": new_state, "updated_at": updated_at})
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._mark(USER_DATA_KIND, str(user_id), None)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Escribe los cambios pendientes (la Application la llama al apagarse)."""
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._write_pending()
+        logger.info("Estado persistido guardado.")
+
+
+def stale_conversation_handler() -> TypeHandler:
+    """
+    Handler para el grupo -1 (antes que los demás): si el usuario tiene una conversación
+    persistente cuyo estado lleva más de su conversation_timeout sin cambios (restaurada tras
+    un reinicio y nunca retomada), la termina y limpia sus claves de user_data, para que el
+    mensaje lo atiendan los handlers normales en vez de un paso viejo de la conversación.
+    """
+    async def expire_stale_conversations(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        persistence = context.application.persistence
+        if not isinstance(persistence, DatabasePersistence) or not update.effective_user or not update.effective_chat:
+            return
+        key = (update.effective_chat.id, update.effective_user.id)
+        for handlers in context.application.handlers.values():
+            for handler in handlers:
+                if not (isinstance(handler, ConversationHandler) and handler.persistent and handler.conversation_timeout):
+                    continue
+                timeout = handler.conversation_timeout
+                if isinstance(timeout, timedelta):
+                    timeout = timeout.total_seconds()
+                if not persistence.conversation_expired(handler.name, key, timeout):
+                    continue
+                logger.info(f"Conversación '{handler.name}' restaurada y vencida para el usuario {key[1]}. Se cierra.")
+                # PTB no expone otra forma de terminar una conversación desde fuera de sus handlers
+                handler._update_state(ConversationHandler.END, key)
+                await persistence.update_conversation(handler.name, key, None)
+                release_user_data(context, key[1], *CONVERSATION_USER_DATA_KEYS.get(handler.name, ()))
+
+    return TypeHandler(Update, expire_stale_conversations)
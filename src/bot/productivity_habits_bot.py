@@ -1,4 +1,5 @@
 import os
+import asyncio
 import logging
 from datetime import datetime, time, timedelta
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
@@ -7,34 +8,93 @@ from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandl
 
 # Importar funciones de interacción con la base de datos
 from src.database.database_interation import (
-    create_user_if_not_exists, get_user_by_telegram_id,
-    load_default_habits, set_task, get_incomplete_tasks, mark_as_completed,
-    delete_task_by_id, complete_task_by_id, update_user_timezone, get_user_tasks
+    create_user_if_not_exists, get_user_by_telegram_id, reactivate_user_by_telegram_id,
+    load_default_habits, mark_as_completed, update_user_timezone,
+    complete_user_task, delete_user_task, get_task_page, get_pending_task_page, TaskRow,
+    get_user_timezone, create_user_task, complete_user_tasks, delete_user_tasks, search_user_tasks,
+    get_agenda_rows
 )
 from src.database.db_context import get_db, init_db_async
 from src.utils.scheduler import (
-    setup_scheduler, get_scheduler, schedule_instant_reminder,
-    schedule_recurring_task, schedule_all_due_tasks_for_persistence
+    setup_scheduler, get_scheduler, schedule_all_due_tasks_for_persistence,
+    schedule_habit_digests, schedule_metrics_jobs, schedule_task_archiving, schedule_stats_rollup, request_task_schedule, request_task_unschedule,
+    BOT_MODE, SCHEDULER_IS_REMOTE
+)
+from src.utils.outbound import shutdown_outbound_bot
+from src.utils.metrics import start_metrics_server, stop_metrics_server
+from src.utils.http_client import close_http_client
+from src.utils.city_index import get_city_index
+from src.utils.timezone_index import get_timezone_index
+from src.utils.date_parser import (
+    ParsedDueDate, parse_date_text, parse_date_range, parse_time_text, to_aware_datetime, is_no_date, normalize_date_text
+)
+from src.utils.conversation_state import CONVERSATION_TIMEOUT, TTLStateStore, timeout_handlers, release_user_data
+from src.utils.agenda import (
+    AGENDA_MAX_DAYS, RenderedAgenda, local_day_window, expand_agenda, render_agenda,
+    today_agenda_cache, invalidate_today_agenda
 )
 from src.utils.logger_config import configure_logging
 from src.handlers.set_timezone_handler import get_set_timezone_conversation_handler 
 from src.handlers.weather_handler import get_weather_conversation_handler
-from src.handlers.habits_handler import get_habits_conversation_handler
-from src.utils.habits_api import send_daily_habits
+from src.handlers.habits_handler import (
+    get_habits_conversation_handler, get_habit_time_handler, get_habit_checkin_handlers, get_streaks_handler
+)
+from src.handlers.stats_handler import get_stats_handler, get_admin_stats_handler
+from src.bot.webhook import run_webhook
+from src.bot.update_processor import PerChatUpdateProcessor, UPDATE_CONCURRENCY
+from src.bot.persistence import DatabasePersistence, stale_conversation_handler
 
 # Configuración del logger para este módulo
 configure_logging()
 logger = logging.getLogger(__name__)
 
+# Forma de recibir updates: 'polling' (por defecto) o 'webhook' (ver src/bot/webhook.py)
+BOT_DELIVERY_MODE = os.getenv("BOT_DELIVERY_MODE", "polling").strip().lower()
+
+# Solo los tipos de update que consumen los handlers registrados:
+# comandos y texto (MESSAGE) y botones inline (CALLBACK_QUERY).
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
 # Definición de estados para los ConversationHandlers (conversaciones con el bot)
 TASK_DESCRIPTION, TASK_DATE, TASK_TIME, TASK_FREQUENCY = range(4)
-COMPLETE_TASK_SELECT_ID, DELETE_TASK_SELECT_ID = range(4, 6)
+# Claves de user_data de la conversación /task (solo valores primitivos)
+NEW_TASK_KEYS = ('current_task_description', 'current_task_date', 'current_task_due_date', 'current_task_frequency')
+# Frecuencias escritas en /task desc | fecha | frecuencia (texto normalizado -> valor guardado)
+FREQUENCY_ALIASES = {
+    "una vez": "una vez", "unica": "una vez", "ninguna": "una vez", "no": "una vez",
+    "diaria": "diaria", "diario": "diaria", "cada dia": "diaria", "todos los dias": "diaria",
+    "semanal": "semanal", "cada semana": "semanal",
+    "mensual": "mensual", "cada mes": "mensual",
+    "anual": "anual", "cada ano": "anual",
+}
+
+# Tareas por página en los teclados de /complete_task y /delete_task
+TASK_PAGE_SIZE = 8
+TASK_BUTTON_TEXT_MAX = 40
+
+# Máximo de IDs por comando masivo (/complete_task 3 5 7-12), para acotar rangos enormes
+BULK_TASK_IDS_MAX = 500
+# Palabras para borrar de una vez todas las tareas completadas (/delete_task completadas)
+COMPLETED_KEYWORDS = ("completadas", "todas las completadas", "hechas")
+
+# Paginación de /list_tasks: tareas por página y tope de caracteres de un mensaje de Telegram
+TASK_LIST_PAGE_SIZE = 10
+TASK_LIST_DESCRIPTION_MAX = 300
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Largo máximo del texto de /buscar
+TASK_SEARCH_QUERY_MAX = 200
+# Última búsqueda de cada usuario, para los botones de página (el callback_data solo lleva el número).
+# Fuera de user_data: no se persiste y vence sola como las conversaciones abandonadas.
+task_search_queries = TTLStateStore()
+_EPOCH = datetime(1970, 1, 1, tzinfo=ZoneInfo('UTC'))
+# Ejemplos de fechas aceptadas que se muestran al pedir la fecha de una tarea
+DATE_EXAMPLES = '"mañana", "hoy 18:00", "lunes", "en 3 días" o "25/12/2025 18:00"'
 
 
 async def global_cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancela cualquier conversación en curso y limpia los datos del usuario."""
     logger.info(f"Comando /cancelar recibido de usuario: {update.effective_user.id}. Limpiando user_data.")
-    context.user_data.clear()
+    release_user_data(context, update.effective_user.id, *list(context.user_data))
     
     if update.effective_chat:
         await update.message.reply_text('Operación cancelada.')
@@ -56,23 +116,40 @@ async def post_init(application: Application):
     async with get_db() as db:
         await load_default_habits(db)
     logger.info("post_init: Hábitos por defecto cargados (si no existían).")
+    # Los índices de ciudades y zonas horarias se cargan en un hilo para no bloquear el event loop
+    await asyncio.to_thread(get_city_index)
+    await asyncio.to_thread(get_timezone_index)
+    await start_metrics_server()
 
-    scheduler_instance = setup_scheduler() 
+    if SCHEDULER_IS_REMOTE:
+        logger.info("post_init: BOT_MODE='bot'. El scheduler y los envíos programados corren en el proceso dispatcher.")
+        return
+
+    setup_scheduler()
     await schedule_all_due_tasks_for_persistence() 
     logger.info("post_init: Tareas pendientes y recurrentes programadas en el scheduler.")
-    #para configurar el horario de notificacion de los habitos
-    notification_times = [
-        #esto no esta en el horario del usuario, sino en UTC
-        #hora_utc = hora_arg + 3(horas)
-        time(hour=6, minute=0),
-        time(hour=19, minute=0)
-    ]
-    for notification_time in notification_times:
-        application.job_queue.run_daily(send_daily_habits, time=notification_time)
-        logger.info(f"programada las notificaciones diarias de habitos a las {notification_time.strftime('%H:%M')}.")
+    await schedule_habit_digests()
+    schedule_metrics_jobs()
+    schedule_task_archiving()
+    schedule_stats_rollup()
     logger.info("post_init: Bot y scheduler listos para operar.")
 
 
+async def post_shutdown(application: Application):
+    """
+    Función que se ejecuta al detener la aplicación.
+    Detiene el scheduler local (si corre en este proceso) y cierra el bot de envíos salientes,
+    el cliente HTTP compartido y el endpoint de métricas.
+    """
+    scheduler = get_scheduler()
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+        logger.info("post_shutdown: Scheduler detenido.")
+    await shutdown_outbound_bot()
+    await close_http_client()
+    await stop_metrics_server()
+
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Maneja el comando /start. Registra al usuario si es nuevo y le da la bienvenida.
@@ -87,6 +164,11 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
     async with get_db() as db:
         new_user = await create_user_if_not_exists(db, user_telegram_id, username, user_first_name, last_name)
+        # Si el usuario había bloqueado el bot, vuelve a recibir envíos y se reprograman sus tareas
+        tasks_to_reschedule = await reactivate_user_by_telegram_id(db, user_telegram_id)
+
+    for task_id, frequency in tasks_to_reschedule:
+        await request_task_schedule(task_id, frequency)
 
     await update.message.reply_html(
         rf"¡Hola {user.mention_html()}! Soy tu bot de hábitos y productividad. "
@@ -102,25 +184,47 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
                                      "/start - Inicia el bot y te registra\n"
                                      "/help - Muestra esta ayuda\n"
                                      "/set_timezone - Configura tu zona horaria\n"
-                                     "/task - Crea una nueva tarea\n" 
+                                     "/task - Crea una nueva tarea (o en un mensaje: /task Comprar pan | mañana 18:00 | diaria)\n" 
                                      "/list_tasks - Lista tus tareas pendientes\n"
-                                     "/complete_task - Marca una tarea como completada\n"
-                                     "/delete_task - Elimina una tarea\n"
+                                     "/buscar - Busca entre tus tareas por texto\n"
+                                     "/hoy, /semana - Tus tareas de hoy o de los próximos 7 días\n"
+                                     "/agenda - Tareas de un período (ej: /agenda 20/10 25/10)\n"
+                                     "/complete_task - Marca una tarea como completada (o varias: /done 3 5 7-12)\n"
+                                     "/delete_task - Elimina una tarea (o varias: /borrar 3 5 7-12, /borrar completadas)\n"
+                                     "/habit_time - Elige la hora de tu resumen diario de hábitos\n"
+                                     "/streaks - Tus rachas de hábitos\n"
+                                     "/stats - Tus estadísticas de la última semana y el último mes\n"
                                      "/cancelar - Cancela cualquier operación en curso") 
 
 
 async def new_task_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Inicia la conversación para crear una nueva tarea.
-    Pide la descripción de la tarea.
+    Con `/task descripción | fecha | frecuencia` crea la tarea en un solo mensaje; si falta
+    algún dato (o no se entiende) la conversación sigue pidiendo solo lo que falta.
     """
-    if context.args:
-        context.user_data['current_task_description'] = " ".join(context.args)
-        await update.message.reply_text('¿Para cuándo es la tarea? (Ej: "DD/MM/AAAA" o "ninguna"):')
-        return TASK_DATE
-    else:
+    context.user_data.pop('current_task_frequency', None)
+    if not context.args:
+        await update.message.reply_text('Por favor, ingresa la descripción de tu nueva tarea:')
+        return TASK_DESCRIPTION
+
+    parts = [part.strip() for part in " ".join(context.args).split("|")]
+    if not parts[0]:
         await update.message.reply_text('Por favor, ingresa la descripción de tu nueva tarea:')
         return TASK_DESCRIPTION
+    context.user_data['current_task_description'] = parts[0]
+
+    if len(parts) > 2 and parts[2]:
+        frequency = FREQUENCY_ALIASES.get(normalize_date_text(parts[2]))
+        if frequency:
+            context.user_data['current_task_frequency'] = frequency
+        else:
+            await update.message.reply_text(f"No reconocí la frecuencia '{parts[2][:40]}'. Te la preguntaré al final.")
+
+    if len(parts) > 1 and parts[1]:
+        return await _handle_task_date_text(update, context, parts[1])
+    await update.message.reply_text(f'¿Para cuándo es la tarea? (Ej: {DATE_EXAMPLES} o "ninguna"):')
+    return TASK_DATE
 
 async def received_task_description(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
@@ -132,43 +236,59 @@ async def received_task_description(update: Update, context: ContextTypes.DEFAUL
         return TASK_DESCRIPTION # Quédate en este estado
         
     context.user_data['current_task_description'] = update.message.text
-    await update.message.reply_text('¿Para cuándo es la tarea? (Ej: "DD/MM/AAAA" o "ninguna"):')
+    await update.message.reply_text(f'¿Para cuándo es la tarea? (Ej: {DATE_EXAMPLES} o "ninguna"):')
     return TASK_DATE
 
 async def received_task_date(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
-    Parsea la fecha de vencimiento ingresada por el usuario y la guarda.
-    Luego pide la hora.
+    Parsea la fecha de vencimiento ingresada por el usuario ("mañana", "lunes 18:00", "25/12/2025"...).
+    Si el texto ya incluye la hora pasa directo a la frecuencia; si no, pide la hora.
     """
     if not update.message or not update.message.text:
-        await update.message.reply_text('Por favor, ingresa una fecha válida (Ej: "DD/MM/AAAA" o "ninguna").')
+        await update.message.reply_text(f'Por favor, ingresa una fecha válida (Ej: {DATE_EXAMPLES} o "ninguna").')
         return TASK_DATE # Quédate en este estado
+    return await _handle_task_date_text(update, context, update.message.text)
+
 
-    date_str = update.message.text.lower().strip()
+async def _handle_task_date_text(update: Update, context: ContextTypes.DEFAULT_TYPE, date_str: str) -> int:
+    """Interpreta la fecha de la tarea (desde la conversación o desde /task en un solo mensaje)."""
     telegram_user_id = update.effective_user.id
 
-    if date_str == "ninguna":
+    if is_no_date(date_str):
         context.user_data['current_task_due_date'] = None
-        await update.message.reply_text('¿Con qué frecuencia debe repetirse esta tarea? (Ej: "diaria", "semanal", "mensual", "anual", "una vez" o "ninguna"):')
-        return TASK_FREQUENCY
-    else:
-        try:
-            parsed_date_naive = datetime.strptime(date_str, '%d/%m/%Y').date()
-            context.user_data['current_task_date'] = parsed_date_naive
-            await update.message.reply_text('¿A qué hora debe ser el recordatorio? (Ej: "HH:MM" o "ninguna"):')
-            return TASK_TIME
-        except ValueError:
-            await update.message.reply_text(
-                'Formato de fecha inválido. Por favor, usa "DD/MM/AAAA" (ej: "25/12/2025") o escribe "ninguna".'
-            )
-            return TASK_DATE
-        except Exception as e:
-            logger.error(f"Error al parsear fecha '{date_str}' para el usuario {telegram_user_id}: {e}", exc_info=True)
-            await update.message.reply_text(
-                'Ocurrió un error al procesar la fecha. Por favor, intenta con el formato "DD/MM/AAAA" o escribe "ninguna".'
-            )
-            return TASK_DATE
+        return await _ask_task_frequency(update, context)
+
+    # Solo la zona horaria: no hace falta cargar el usuario completo
+    async with get_db() as db:
+        _, user_timezone = await get_user_timezone(db, telegram_user_id)
+
+    try:
+        parsed = parse_date_text(date_str, user_timezone)
+    except Exception as e:
+        logger.error(f"Error al parsear fecha '{date_str}' para el usuario {telegram_user_id}: {e}", exc_info=True)
+        parsed = None
+    if parsed is None:
+        await update.message.reply_text(
+            f'No pude entender la fecha. Prueba con {DATE_EXAMPLES} o escribe "ninguna".'
+        )
+        return TASK_DATE
 
+    if parsed.time is None:
+        context.user_data['current_task_date'] = parsed.date
+        await update.message.reply_text('¿A qué hora debe ser el recordatorio? (Ej: "18:00", "9am" o "ninguna"):')
+        return TASK_TIME
+
+    if not user_timezone:
+        await update.message.reply_text(
+            "Por favor, establece tu zona horaria con /set_timezone antes de añadir tareas con fecha."
+        )
+        return TASK_DATE
+    due_date = to_aware_datetime(parsed, user_timezone).astimezone(ZoneInfo('UTC'))
+    if due_date < datetime.now(ZoneInfo('UTC')):
+        await update.message.reply_text('La fecha y hora proporcionada ya han pasado. Por favor, ingresa una fecha futura.')
+        return TASK_DATE
+    context.user_data['current_task_due_date'] = due_date
+    return await _ask_task_frequency(update, context)
 
 
 async def received_task_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -179,7 +299,7 @@ async def received_task_time(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text('Por favor, ingresa una hora válida (Ej: "HH:MM" o "ninguna").')
         return TASK_TIME
 
-    time_str = update.message.text.lower().strip()
+    time_str = update.message.text
     telegram_user_id = update.effective_user.id
     parsed_due_date = None
 
@@ -191,34 +311,36 @@ async def received_task_time(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
             return TASK_TIME
 
-    user_tz = ZoneInfo(user.timezone)
     current_task_date = context.user_data.get('current_task_date')
 
-    if time_str == "ninguna":
-        if current_task_date:
-            parsed_date_time_naive = datetime.combine(current_task_date, time(0, 0))
-            # --- LÍNEA CORREGIDA ---
-            parsed_due_date_aware = parsed_date_time_naive.replace(tzinfo=user_tz)
-            parsed_due_date = parsed_due_date_aware.astimezone(ZoneInfo('UTC'))
+    if is_no_date(time_str):
+        parsed_time = time(0, 0)
     else:
-        try:
-            parsed_time_naive = datetime.strptime(time_str, '%H:%M').time()
-            if current_task_date:
-                parsed_date_time_naive = datetime.combine(current_task_date, parsed_time_naive)
-                # --- LÍNEA CORREGIDA ---
-                parsed_due_date_aware = parsed_date_time_naive.replace(tzinfo=user_tz)
-                parsed_due_date = parsed_due_date_aware.astimezone(ZoneInfo('UTC'))
-
-            if parsed_due_date and parsed_due_date < datetime.now(ZoneInfo('UTC')):
-                await update.message.reply_text('La fecha y hora proporcionada ya han pasado. Por favor, ingresa una hora futura.')
-                return TASK_TIME
-        except ValueError:
-            await update.message.reply_text('Formato de hora inválido. Usa "HH:MM" (ej: "18:00").')
+        parsed_time = parse_time_text(time_str)
+        if parsed_time is None:
+            await update.message.reply_text('Formato de hora inválido. Usa "HH:MM" (ej: "18:00") o algo como "6pm".')
+            return TASK_TIME
+
+    if current_task_date:
+        parsed_due_date = to_aware_datetime(
+            ParsedDueDate(current_task_date, parsed_time), user.timezone
+        ).astimezone(ZoneInfo('UTC'))
+        if parsed_due_date < datetime.now(ZoneInfo('UTC')) and not is_no_date(time_str):
+            await update.message.reply_text('La fecha y hora proporcionada ya han pasado. Por favor, ingresa una hora futura.')
             return TASK_TIME
 
     context.user_data['current_task_due_date'] = parsed_due_date
+    return await _ask_task_frequency(update, context)
 
-    # ---  MENU DE BOTONES ---
+
+async def _ask_task_frequency(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Presenta el menú de botones para elegir la frecuencia de la tarea, salvo que ya se
+    haya indicado en /task desc | fecha | frecuencia: en ese caso crea la tarea directamente.
+    """
+    frequency = context.user_data.get('current_task_frequency')
+    if frequency:
+        return await _create_new_task(update.message, context, update.effective_user.id, frequency)
     keyboard = [
         [InlineKeyboardButton("Una sola vez", callback_data="freq_una vez")],
         [InlineKeyboardButton("Diaria", callback_data="freq_diaria")],
@@ -243,260 +365,560 @@ async def received_task_frequency(update: Update, context: ContextTypes.DEFAULT_
     frequency_str = query.data.split('_', 1)[1]
 
     await query.edit_message_text(f"Frecuencia seleccionada: {frequency_str.capitalize()}. Creando tarea...")
+    return await _create_new_task(query.message, context, query.from_user.id, frequency_str)
 
-    frequency = None if frequency_str in ["una vez", "ninguna"] else frequency_str
 
-    telegram_user_id = query.from_user.id
-    description = context.user_data['current_task_description']
+async def _create_new_task(message, context: ContextTypes.DEFAULT_TYPE, telegram_user_id: int, frequency_str: str) -> int:
+    """Guarda la tarea armada en user_data con un único INSERT y programa su recordatorio."""
+    frequency = None if frequency_str in ["una vez", "ninguna"] else frequency_str
+    description = context.user_data.get('current_task_description')
     due_date = context.user_data.get('current_task_due_date')
+    if not description:
+        await message.reply_text("La creación de la tarea expiró. Usa /task para volver a empezar.")
+        return ConversationHandler.END
 
     try:
         async with get_db() as db:
-            user = await get_user_by_telegram_id(db, telegram_user_id)
-            if not user:
-                await query.message.reply_text("Error: No se encontró tu usuario. Usa /start.")
-                return ConversationHandler.END
+            task_id = await create_user_task(db, telegram_user_id, description, due_date, frequency)
 
-            task = await set_task(db, user.id, description, due_date, frequency)
+        if task_id is None:
+            await message.reply_text("Error: No se encontró tu usuario. Usa /start.")
+            return ConversationHandler.END
 
-        await query.message.reply_text(f'Tarea "{task.description}" (ID: `{task.id}`) creada exitosamente.')
-        logger.info(f"Tarea '{task.description}' (ID: {task.id}) creada por {telegram_user_id}.")
+        invalidate_today_agenda(telegram_user_id)
+        await message.reply_text(f'Tarea "{description}" (ID: `{task_id}`) creada exitosamente.')
+        logger.info(f"Tarea '{description}' (ID: {task_id}) creada por {telegram_user_id}.")
 
-        if task.due_date:
-            if not task.frequency or task.frequency == 'una vez':
-                await schedule_instant_reminder(task.id)
-            elif task.frequency in ['diaria', 'semanal', 'mensual', 'anual']:
-                await schedule_recurring_task(task.id, task.frequency)
+        if due_date:
+            await request_task_schedule(task_id, frequency)
 
     except Exception as e:
         logger.error(f"Error al crear tarea para {telegram_user_id}: {e}", exc_info=True)
-        await query.message.reply_text('Lo siento, ocurrió un error al crear la tarea.')
+        await message.reply_text('Lo siento, ocurrió un error al crear la tarea.')
 
     finally:
-        context.user_data.clear()
+        release_user_data(context, telegram_user_id, *NEW_TASK_KEYS)
 
     return ConversationHandler.END
 
 
-async def list_tasks_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+def _encode_task_cursor(due_date: datetime | None, task_id: int) -> str:
+    """Cursor compacto para el callback: microsegundos desde epoch (o '-' sin fecha) e ID."""
+    if due_date is None:
+        return f"-:{task_id}"
+    if due_date.tzinfo is None:
+        due_date = due_date.replace(tzinfo=ZoneInfo('UTC'))
+    return f"{(due_date - _EPOCH) // timedelta(microseconds=1)}:{task_id}"
+
+
+def _decode_task_cursor(cursor: str) -> tuple[datetime | None, int]:
+    due_str, _, task_id_str = cursor.partition(":")
+    due_date = None if due_str == "-" else _EPOCH + timedelta(microseconds=int(due_str))
+    return due_date, int(task_id_str)
+
+
+def _format_task_line(task: TaskRow, user_tz: ZoneInfo) -> str:
+    task_id, description, due_date, frequency = task.id, task.description, task.due_date, task.frequency
+    display_due_date = "Sin fecha"
+    if due_date:
+        if due_date.tzinfo is None:
+            due_date = due_date.replace(tzinfo=ZoneInfo('UTC'))
+        display_due_date = due_date.astimezone(user_tz).strftime('%Y-%m-%d %H:%M %Z')
+    if len(description) > TASK_LIST_DESCRIPTION_MAX:
+        description = description[:TASK_LIST_DESCRIPTION_MAX - 1] + "…"
+    freq_str = f" (Frecuencia: {frequency.capitalize()})" if frequency else ""
+    return f"- ID: `{task_id}` | `{description}` (Vence: {display_due_date}){freq_str}\n"
+
+
+async def _build_task_list_page(telegram_user_id: int, cursor: str = None, backwards: bool = False) -> tuple[str, InlineKeyboardMarkup | None]:
     """
-    Maneja el comando /list_tasks. Lista las tareas incompletas del usuario.
-    Optimización: Obtener user una sola vez.
+    Arma una página de /list_tasks: una consulta por keyset sobre (due_date, id) y un texto
+    que nunca supera el límite de tamaño de mensaje de Telegram. Si no entran todas las
+    tareas de la página, el resto queda para la página siguiente (o anterior).
     """
-    telegram_user_id = update.effective_user.id
     async with get_db() as db:
-        user = await get_user_by_telegram_id(db, telegram_user_id)
-        if not user:
-            await update.message.reply_text("Por favor, usa /start primero para registrarte.")
-            return
+        rows, user_tz_str, has_more = await get_pending_task_page(
+            db, telegram_user_id,
+            cursor=_decode_task_cursor(cursor) if cursor else None,
+            backwards=backwards,
+            limit=TASK_LIST_PAGE_SIZE,
+        )
+        if not rows and cursor is None and not await get_user_by_telegram_id(db, telegram_user_id):
+            return "Por favor, usa /start primero para registrarte.", None
+
+    if not rows:
+        if cursor is None:
+            return "No tienes tareas pendientes. ¡Buen trabajo!", None
+        return "No hay más tareas en esta dirección.", InlineKeyboardMarkup(
+            [[InlineKeyboardButton("⏮ Volver al inicio", callback_data="tl:f")]]
+        )
 
-        tasks = await get_incomplete_tasks(db, user.id)
-        if tasks:
-            response = "Tus tareas pendientes:\n"
-            user_tz_str = user.timezone if user.timezone else 'UTC'
-            try:
-                user_tz = ZoneInfo(user_tz_str)
-            except ZoneInfoNotFoundError:
-                logger.warning(f"Zona horaria inválida '{user_tz_str}' para el usuario {telegram_user_id}. Usando UTC para mostrar tareas.")
-                user_tz = ZoneInfo('UTC') 
-
-            for task in tasks:
-                display_due_date = "Sin fecha"
-                if task.due_date:
-                    if task.due_date.tzinfo is None:
-                        task.due_date = task.due_date.replace(tzinfo=ZoneInfo('UTC'))
-                    
-                    due_date_in_user_tz = task.due_date.astimezone(user_tz)
-                    display_due_date = due_date_in_user_tz.strftime('%Y-%m-%d %H:%M %Z')
-                
-                freq_str = f" (Frecuencia: {task.frequency.capitalize()})" if task.frequency else ""
-                response += f"- ID: `{task.id}` | `{task.description}` (Vence: {display_due_date}){freq_str}\n"
-            await update.message.reply_text(response)
-        else:
-            await update.message.reply_text("No tienes tareas pendientes. ¡Buen trabajo!")
-    logger.info(f"Comando /list_tasks ejecutado por el usuario {telegram_user_id}.")
+    try:
+        user_tz = ZoneInfo(user_tz_str or 'UTC')
+    except ZoneInfoNotFoundError:
+        logger.warning(f"Zona horaria inválida '{user_tz_str}' para el usuario {telegram_user_id}. Usando UTC para mostrar tareas.")
+        user_tz = ZoneInfo('UTC')
+
+    header = "Tus tareas pendientes:\n"
+    budget = TELEGRAM_MESSAGE_LIMIT - len(header)
+    lines = [(row, _format_task_line(row, user_tz)) for row in rows]
+    # Hacia adelante se conservan las primeras; hacia atrás, las más cercanas al cursor (las últimas)
+    kept, used = [], 0
+    for row, line in (reversed(lines) if backwards else lines):
+        if kept and used + len(line) > budget:
+            break
+        kept.append((row, line))
+        used += len(line)
+    if backwards:
+        kept.reverse()
+    truncated = len(kept) < len(rows)
+
+    has_prev = cursor is not None and (not backwards or has_more or truncated)
+    has_next = backwards or has_more or truncated
+    first_row, last_row = kept[0][0], kept[-1][0]
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton(
+            "⬅️ Anterior", callback_data=f"tl:p:{_encode_task_cursor(first_row.due_date, first_row.id)}"
+        ))
+    if has_next:
+        navigation.append(InlineKeyboardButton(
+            "Siguiente ➡️", callback_data=f"tl:n:{_encode_task_cursor(last_row.due_date, last_row.id)}"
+        ))
+
+    text = header + "".join(line for _, line in kept)
+    return text, InlineKeyboardMarkup([navigation]) if navigation else None
 
 
-async def complete_task_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def list_tasks_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    Inicia el proceso para marcar una tarea como completada.
-    Lista las tareas pendientes y pide al usuario el ID de la tarea a completar.
-    Optimización: Obtener user y user_tz una sola vez.
+    Maneja el comando /list_tasks. Muestra la primera página de tareas incompletas del usuario,
+    con botones para avanzar o retroceder.
     """
     telegram_user_id = update.effective_user.id
     try:
-        async with get_db() as db:
-            user = await get_user_by_telegram_id(db, telegram_user_id)
-            if not user:
-                await update.message.reply_text("Por favor, usa /start primero para registrarte.")
-                return ConversationHandler.END
-
-            tasks = await get_incomplete_tasks(db, user.id)
-        if not tasks:
-            await update.message.reply_text("No tienes tareas incompletas para marcar como completadas.")
-            return ConversationHandler.END
+        text, reply_markup = await _build_task_list_page(telegram_user_id)
+        await update.message.reply_text(text, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Error en list_tasks_command para usuario {telegram_user_id}: {e}", exc_info=True)
+        await update.message.reply_text('Lo siento, ocurrió un error al listar tus tareas.')
+    logger.info(f"Comando /list_tasks ejecutado por el usuario {telegram_user_id}.")
 
-        context.user_data['tasks_to_complete'] = {str(task.id): task for task in tasks}
 
-        message = "Por favor, ingresa el ID de la tarea que quieres marcar como completada:\n"
-        
-        user_tz_str = user.timezone if user.timezone else 'UTC'
+async def task_list_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Atiende los botones de /list_tasks: "tl:n:<cursor>" (siguiente), "tl:p:<cursor>" (anterior), "tl:f" (inicio)."""
+    query = update.callback_query
+    telegram_user_id = query.from_user.id
+    _, _, rest = query.data.partition(":")
+    direction, _, cursor = rest.partition(":")
+    try:
+        if direction == "f":
+            cursor = None
+        elif direction not in ("n", "p"):
+            raise ValueError(query.data)
+        else:
+            _decode_task_cursor(cursor) # Valida el cursor antes de consultar
+        await query.answer()
+        text, reply_markup = await _build_task_list_page(telegram_user_id, cursor or None, backwards=(direction == "p"))
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except ValueError:
+        await query.answer("Botón inválido.")
+    except Exception as e:
+        logger.error(f"Error en task_list_page_callback ({query.data}) para usuario {telegram_user_id}: {e}", exc_info=True)
+        await query.answer("Lo siento, ocurrió un error. Por favor, inténtalo de nuevo.", show_alert=True)
+
+
+async def _load_agenda(telegram_user_id: int, kind: str, range_text: str = "") -> RenderedAgenda:
+    """
+    Arma la agenda de /hoy ('hoy'), /semana ('semana') o /agenda ('agenda' con fechas).
+    La ventana se calcula en la zona horaria del usuario; las tareas salen de un escaneo por
+    rango de due_date y las recurrentes se expanden en memoria.
+    """
+    async with get_db() as db:
+        registered, user_tz_str = await get_user_timezone(db, telegram_user_id)
+        if not registered:
+            return RenderedAgenda("No estás registrado. Usa /start primero.", [], None)
         try:
-            user_tz = ZoneInfo(user_tz_str)
+            user_tz = ZoneInfo(user_tz_str or 'UTC')
         except ZoneInfoNotFoundError:
-            logger.error(f"Zona horaria '{user_tz_str}' no válida para el usuario {telegram_user_id}. Mostrando fecha en UTC.")
             user_tz = ZoneInfo('UTC')
+        today = datetime.now(user_tz).date()
+
+        if kind == "hoy":
+            first_day, days = today, 1
+            title = f"🗓 Hoy, {today.strftime('%d/%m')}"
+        elif kind == "semana":
+            first_day, days = today, 7
+            title = "🗓 Próximos 7 días"
+        else:
+            date_range = parse_date_range(range_text, user_tz_str)
+            if date_range is None:
+                return RenderedAgenda(
+                    'No entendí las fechas. Ejemplos: /agenda 20/10 25/10, /agenda lunes a viernes, '
+                    '/agenda mañana, /agenda 1 de noviembre | 15 de noviembre', [], None
+                )
+            first_day, last_day = date_range
+            days = (last_day - first_day).days + 1
+            if days < 1:
+                return RenderedAgenda("La fecha final es anterior a la inicial.", [], None)
+            if days > AGENDA_MAX_DAYS:
+                return RenderedAgenda(f"El período es demasiado largo (máximo {AGENDA_MAX_DAYS} días).", [], None)
+            title = f"🗓 Agenda del {first_day.strftime('%d/%m/%Y')} al {last_day.strftime('%d/%m/%Y')}"
+
+        start, end = local_day_window(user_tz, first_day, days)
+        rows = await get_agenda_rows(db, telegram_user_id, start.astimezone(ZoneInfo('UTC')), end.astimezone(ZoneInfo('UTC')))
+
+    if not user_tz_str:
+        title += " (en UTC: configura tu zona horaria con /set_timezone)"
+    items = expand_agenda(rows, user_tz, start, end)
+    return RenderedAgenda(render_agenda(title, items), items, end)
+
+
+async def _build_agenda(telegram_user_id: int, kind: str, range_text: str = "") -> str:
+    """Texto de la agenda. La de hoy se sirve desde la caché por usuario (sin consultas) mientras siga vigente."""
+    if kind == "hoy":
+        agenda = await today_agenda_cache.get_or_load(telegram_user_id, lambda: _load_agenda(telegram_user_id, "hoy"))
+    else:
+        agenda = await _load_agenda(telegram_user_id, kind, range_text)
+    return agenda.text
 
-        for task_item in tasks:
-            due_date_str = "Sin fecha"
-            if task_item.due_date:
-                if task_item.due_date.tzinfo is None:
-                    task_item.due_date = task_item.due_date.replace(tzinfo=ZoneInfo('UTC'))
-                due_date_str = task_item.due_date.astimezone(user_tz).strftime('%Y-%m-%d %H:%M')
-            
-            freq_str = f" (Frecuencia: {task_item.frequency.capitalize()})" if task_item.frequency else ""
-            message += f"ID: {task_item.id} - {task_item.description} (Vence: {due_date_str}){freq_str}\n"
-        await update.message.reply_text(message)
-        return COMPLETE_TASK_SELECT_ID 
+
+async def agenda_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Maneja /hoy, /semana y /agenda <desde> <hasta>: tareas pendientes de un período, día por día."""
+    telegram_user_id = update.effective_user.id
+    kind = update.message.text.split()[0].lstrip("/").split("@")[0].lower()
+    try:
+        text = await _build_agenda(telegram_user_id, kind, " ".join(context.args))
+        await update.message.reply_text(text)
     except Exception as e:
-        logger.error(f"Error en complete_task_command para usuario {telegram_user_id}: {e}", exc_info=True)
-        await update.message.reply_text('Lo siento, ocurrió un error al iniciar el proceso para completar una tarea.')
-        return ConversationHandler.END
+        logger.error(f"Error en agenda_command ({kind}) para usuario {telegram_user_id}: {e}", exc_info=True)
+        await update.message.reply_text('Lo siento, ocurrió un error al armar tu agenda.')
+
+
+async def _build_task_search_page(telegram_user_id: int, query_text: str, page: int) -> tuple[str, InlineKeyboardMarkup | None]:
+    """Arma una página de resultados de /buscar (ordenados por relevancia) con botones de navegación."""
+    async with get_db() as db:
+        rows, user_tz_str = await search_user_tasks(
+            db, telegram_user_id, query_text, page * TASK_LIST_PAGE_SIZE, TASK_LIST_PAGE_SIZE
+        )
+    if not rows:
+        if page > 0:
+            return "No hay más resultados.", None
+        return f"No encontré tareas que coincidan con '{query_text}'.", None
+
+    try:
+        user_tz = ZoneInfo(user_tz_str or 'UTC')
+    except ZoneInfoNotFoundError:
+        user_tz = ZoneInfo('UTC')
 
-async def confirm_complete_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    lines = [f"Resultados para '{query_text}' (página {page + 1}):\n\n"]
+    for task in rows[:TASK_LIST_PAGE_SIZE]:
+        line = _format_task_line(task, user_tz)
+        lines.append(f"✅ {line[2:]}" if task.completed else line)
+
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"bs:{page - 1}"))
+    if len(rows) > TASK_LIST_PAGE_SIZE:
+        navigation.append(InlineKeyboardButton("Siguiente ➡️", callback_data=f"bs:{page + 1}"))
+    return "".join(lines)[:TELEGRAM_MESSAGE_LIMIT], InlineKeyboardMarkup([navigation]) if navigation else None
+
+
+async def search_tasks_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    Confirma y marca una tarea como completada.
+    Maneja el comando /buscar <texto>: búsqueda de texto completo en las tareas del usuario
+    (pendientes y completadas), con resultados por relevancia y paginados.
     """
-    task_id_str = update.message.text
     telegram_user_id = update.effective_user.id
-
+    query_text = " ".join(context.args).strip()[:TASK_SEARCH_QUERY_MAX]
+    if not query_text:
+        await update.message.reply_text('Indica qué buscar. Ej: /buscar comprar pan, o /buscar "informe mensual" -borrador')
+        return
+    task_search_queries.update(telegram_user_id, query=query_text)
     try:
-        task_id = int(task_id_str)
-        
-        task_obj = context.user_data.get('tasks_to_complete', {}).get(task_id_str)
-
-        if not task_obj:
-            await update.message.reply_text("ID de tarea inválido. Por favor, ingresa un ID de la lista.")
-            return COMPLETE_TASK_SELECT_ID 
+        text, reply_markup = await _build_task_search_page(telegram_user_id, query_text, 0)
+        await update.message.reply_text(text, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Error en search_tasks_command para usuario {telegram_user_id}: {e}", exc_info=True)
+        await update.message.reply_text('Lo siento, ocurrió un error al buscar tus tareas.')
 
-        if task_obj.frequency and task_obj.frequency != 'una vez' and task_obj.frequency is not None:
-            await update.message.reply_text(f"La tarea '{task_obj.description}' (ID: `{task_id}`) es una tarea recurrente. No se puede marcar como 'completada' permanentemente en este contexto. Puedes eliminarla si ya no la necesitas.")
-            logger.info(f"Usuario {telegram_user_id} intentó 'completar' tarea recurrente {task_id}.")
-            return ConversationHandler.END 
 
-        async with get_db() as db:
-            success = await complete_task_by_id(db, task_id) 
-            
-            if success:
-                await update.message.reply_text(f"Tarea {task_id} marcada como completada exitosamente. ¡Felicitaciones!")
-                logger.info(f"Tarea {task_obj.id} marcada como completada por el usuario {telegram_user_id}.")
-                scheduler = get_scheduler() 
-                job_id_instant = str(task_id) 
-                if scheduler.get_job(job_id_instant):
-                    scheduler.remove_job(job_id_instant)
-                    logger.info(f"Job instantáneo {job_id_instant} removido del scheduler después de completar la tarea {task_id}.")
-            else:
-                await update.message.reply_text(f"No se pudo encontrar la tarea con ID {task_id} o ya estaba completada.")
-                logger.warning(f"Intento de marcar como completada la tarea {task_id} falló para el usuario {telegram_user_id}.")
-        return ConversationHandler.END 
+async def task_search_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Atiende los botones de página de /buscar: "bs:<página>"."""
+    query = update.callback_query
+    telegram_user_id = query.from_user.id
+    search_state = task_search_queries.get(telegram_user_id)
+    query_text = search_state['query'] if search_state else None
+    try:
+        page = int(query.data.partition(":")[2])
+        if page < 0:
+            raise ValueError(query.data)
+        if not query_text:
+            await query.answer("La búsqueda expiró. Usa /buscar de nuevo.", show_alert=True)
+            return
+        await query.answer()
+        text, reply_markup = await _build_task_search_page(telegram_user_id, query_text, page)
+        await query.edit_message_text(text, reply_markup=reply_markup)
     except ValueError:
-        await update.message.reply_text("Por favor, ingresa un número válido para el ID de la tarea.")
-        return COMPLETE_TASK_SELECT_ID 
+        await query.answer("Botón inválido.")
     except Exception as e:
-        logger.error(f"Error en confirm_complete_task para usuario {telegram_user_id}: {e}", exc_info=True)
-        await update.message.reply_text('Lo siento, ocurrió un error al marcar la tarea como completada. Por favor, inténtalo de nuevo.')
-        return ConversationHandler.END
-
-async def delete_task_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        logger.error(f"Error en task_search_page_callback ({query.data}) para usuario {telegram_user_id}: {e}", exc_info=True)
+        await query.answer("Lo siento, ocurrió un error. Por favor, inténtalo de nuevo.", show_alert=True)
+
+
+def _task_button_label(action: str, description: str, due_date, completed: bool, user_tz: ZoneInfo) -> str:
+    """Texto corto del botón de una tarea: acción, descripción recortada y vencimiento."""
+    icon = "✅" if action == "c" else "🗑"
+    if len(description) > TASK_BUTTON_TEXT_MAX:
+        description = description[:TASK_BUTTON_TEXT_MAX - 1] + "…"
+    label = f"{icon} {description}"
+    if due_date:
+        if due_date.tzinfo is None:
+            due_date = due_date.replace(tzinfo=ZoneInfo('UTC'))
+        label += f" · {due_date.astimezone(user_tz).strftime('%d/%m %H:%M')}"
+    if completed:
+        label += " (completada)"
+    return label
+
+
+async def _build_task_action_page(telegram_user_id: int, action: str, cursor: str = None, backwards: bool = False) -> tuple[str, InlineKeyboardMarkup | None]:
     """
-    Inicia el proceso para eliminar una tarea.
-    Lista todas las tareas del usuario (completadas e incompletas) y pide el ID de la tarea a eliminar.
-    Optimización: Obtener user y user_tz una sola vez.
+    Arma el mensaje y el teclado inline de una página de tareas para completar ('c') o eliminar ('d').
+    Cada botón lleva en su callback solo la acción y el ID de la tarea (ej. "tc:42"); la navegación
+    usa el mismo cursor (due_date, id) que /list_tasks, así que completar o eliminar tareas
+    no hace saltar filas al cambiar de página.
     """
-    telegram_user_id = update.effective_user.id
+    async with get_db() as db:
+        rows, user_tz_str, has_more = await get_task_page(
+            db, telegram_user_id,
+            cursor=_decode_task_cursor(cursor) if cursor else None,
+            backwards=backwards,
+            limit=TASK_PAGE_SIZE,
+            completable_only=(action == "c"),
+        )
+
+    if not rows:
+        if cursor is not None:
+            return "No hay más tareas en esta dirección.", InlineKeyboardMarkup(
+                [[InlineKeyboardButton("⏮ Volver al inicio", callback_data=f"tp:{action}:f")]]
+            )
+        if action == "c":
+            return "No tienes tareas incompletas para marcar como completadas.", None
+        return "No tienes tareas para eliminar.", None
+
     try:
-        async with get_db() as db:
-            user = await get_user_by_telegram_id(db, telegram_user_id)
-            if not user:
-                await update.message.reply_text("Por favor, usa /start primero para registrarte.")
-                return ConversationHandler.END
-
-            tasks = await get_user_tasks(db, user.id) 
-        if not tasks:
-            await update.message.reply_text("No tienes tareas para eliminar.")
-            return ConversationHandler.END
+        user_tz = ZoneInfo(user_tz_str or 'UTC')
+    except ZoneInfoNotFoundError:
+        user_tz = ZoneInfo('UTC')
 
-        context.user_data['tasks_to_delete'] = {str(task.id): task for task in tasks}
+    keyboard = [
+        [InlineKeyboardButton(
+            _task_button_label(action, task.description, task.due_date, task.completed, user_tz),
+            callback_data=f"t{action}:{task.id}"
+        )]
+        for task in rows
+    ]
+    has_prev = cursor is not None and (not backwards or has_more)
+    has_next = backwards or has_more
+    first_row, last_row = rows[0], rows[-1]
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton(
+            "⬅️ Anterior", callback_data=f"tp:{action}:p:{_encode_task_cursor(first_row.due_date, first_row.id)}"
+        ))
+    if has_next:
+        navigation.append(InlineKeyboardButton(
+            "Siguiente ➡️", callback_data=f"tp:{action}:n:{_encode_task_cursor(last_row.due_date, last_row.id)}"
+        ))
+    if navigation:
+        keyboard.append(navigation)
+
+    if action == "c":
+        text = "Toca una tarea para marcarla como completada (las recurrentes no se completan, puedes eliminarlas):"
+    else:
+        text = "Toca una tarea para eliminarla:"
+    return text, InlineKeyboardMarkup(keyboard)
 
-        message = "Por favor, ingresa el ID de la tarea que quieres eliminar:\n"
-        
-        user_tz_str = user.timezone if user.timezone else 'UTC'
+
+def _parse_task_ids(args: list[str]) -> list[int]:
+    """
+    Interpreta IDs sueltos y rangos: ["3", "5", "7-12"] o ["3,5,7-12"] -> [3, 5, 7, 8, ..., 12].
+    Lanza ValueError si algo no es un ID o un rango válido, o si se superan BULK_TASK_IDS_MAX.
+    """
+    task_ids = set()
+    for token in " ".join(args).replace(",", " ").split():
+        start_str, dash, end_str = token.partition("-")
+        start = int(start_str)
+        end = int(end_str) if dash else start
+        if start <= 0 or end < start or len(task_ids) + (end - start + 1) > BULK_TASK_IDS_MAX:
+            raise ValueError(token)
+        task_ids.update(range(start, end + 1))
+    return sorted(task_ids)
+
+
+def _format_id_ranges(task_ids: list[int]) -> str:
+    """Resume IDs ordenados como rangos: [3, 5, 7, 8, 9] -> "3, 5, 7-9"."""
+    parts = []
+    start = previous = None
+    for task_id in task_ids:
+        if previous is not None and task_id == previous + 1:
+            previous = task_id
+            continue
+        if start is not None:
+            parts.append(f"{start}-{previous}" if previous != start else str(start))
+        start = previous = task_id
+    if start is not None:
+        parts.append(f"{start}-{previous}" if previous != start else str(start))
+    return ", ".join(parts)
+
+
+async def _bulk_task_action(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str) -> None:
+    """
+    /complete_task o /delete_task con argumentos: completa ('c') o elimina ('d') varias tareas
+    con una sola sentencia que verifica el dueño, y cancela sus recordatorios en un único lote.
+    """
+    telegram_user_id = update.effective_user.id
+    spec = normalize_date_text(" ".join(context.args))
+    completed_only = action == "d" and spec in COMPLETED_KEYWORDS
+    task_ids = None
+    if not completed_only:
         try:
-            user_tz = ZoneInfo(user_tz_str)
-        except ZoneInfoNotFoundError:
-            logger.error(f"Zona horaria '{user_tz_str}' no válida para el usuario {telegram_user_id}. Mostrando fecha en UTC.")
-            user_tz = ZoneInfo('UTC')
+            task_ids = _parse_task_ids(context.args)
+        except ValueError:
+            command = "/complete_task" if action == "c" else "/delete_task"
+            extra = ' o "completadas"' if action == "d" else ""
+            await update.message.reply_text(
+                f"No entendí los IDs. Usa por ejemplo `{command} 3 5 7-12`{extra} (hasta {BULK_TASK_IDS_MAX} tareas)."
+            )
+            return
 
-        for task_item in tasks:
-            status = "✅ Completada" if task_item.completed else "⏳ Pendiente"
-            due_date_str = "Sin fecha"
-            if task_item.due_date:
-                if task_item.due_date.tzinfo is None:
-                    task_item.due_date = task_item.due_date.replace(tzinfo=ZoneInfo('UTC'))
-                due_date_str = task_item.due_date.astimezone(user_tz).strftime('%Y-%m-%d %H:%M')
-
-            freq_str = f" (Frecuencia: {task_item.frequency.capitalize()})" if task_item.frequency else ""
-            message += f"ID: {task_item.id} - {task_item.description} (Estado: {status}, Vence: {due_date_str}){freq_str}\n"
-        await update.message.reply_text(message)
-        return DELETE_TASK_SELECT_ID 
+    async with get_db() as db:
+        if action == "c":
+            done_ids = await complete_user_tasks(db, telegram_user_id, task_ids)
+        else:
+            done_ids = await delete_user_tasks(db, telegram_user_id, task_ids, completed_only=completed_only)
+
+    if done_ids:
+        invalidate_today_agenda(telegram_user_id)
+        await request_task_unschedule(done_ids)
+    logger.info(f"Acción masiva '{action}' del usuario {telegram_user_id}: {len(done_ids)} tareas afectadas.")
+
+    verb = "completadas" if action == "c" else "eliminadas"
+    if not done_ids:
+        text = f"No hubo tareas {verb}."
+    else:
+        text = f"✅ {len(done_ids)} tareas {verb}: {_format_id_ranges(done_ids)}"
+    skipped = sorted(set(task_ids or ()) - set(done_ids))
+    if skipped:
+        reason = "no existen, no son tuyas, son recurrentes o ya estaban completadas" if action == "c" else "no existen o no son tuyas"
+        text += f"\nSin cambios ({reason}): {_format_id_ranges(skipped)}"
+    await update.message.reply_text(text[:TELEGRAM_MESSAGE_LIMIT])
+
+
+async def complete_task_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Maneja el comando /complete_task. Sin argumentos muestra las tareas pendientes como botones:
+    tocar una la marca como completada en un solo paso. Con IDs (`/complete_task 3 5 7-12`)
+    las completa todas de una vez.
+    """
+    telegram_user_id = update.effective_user.id
+    try:
+        if context.args:
+            await _bulk_task_action(update, context, "c")
+            return
+        text, reply_markup = await _build_task_action_page(telegram_user_id, "c")
+        await update.message.reply_text(text, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Error en complete_task_command para usuario {telegram_user_id}: {e}", exc_info=True)
+        await update.message.reply_text('Lo siento, ocurrió un error al iniciar el proceso para completar una tarea.')
+
+async def delete_task_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Maneja el comando /delete_task. Sin argumentos muestra todas las tareas (completadas e incompletas)
+    como botones: tocar una la elimina en un solo paso. Con IDs (`/delete_task 3 5 7-12`) o
+    "completadas" las elimina todas de una vez.
+    """
+    telegram_user_id = update.effective_user.id
+    try:
+        if context.args:
+            await _bulk_task_action(update, context, "d")
+            return
+        text, reply_markup = await _build_task_action_page(telegram_user_id, "d")
+        await update.message.reply_text(text, reply_markup=reply_markup)
     except Exception as e:
         logger.error(f"Error en delete_task_command para usuario {telegram_user_id}: {e}", exc_info=True)
         await update.message.reply_text('Lo siento, ocurrió un error al iniciar el proceso para eliminar una tarea.')
-        return ConversationHandler.END
 
-async def confirm_delete_task(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+def _without_button(reply_markup: InlineKeyboardMarkup, callback_data: str) -> InlineKeyboardMarkup | None:
+    """Devuelve el teclado sin el botón indicado, para actualizar la lista sin volver a consultar la DB."""
+    rows = [
+        [button for button in row if button.callback_data != callback_data]
+        for row in (reply_markup.inline_keyboard if reply_markup else [])
+    ]
+    rows = [row for row in rows if row]
+    # Si solo quedan los botones de navegación ya no hay tareas en esta página
+    if not any(button.callback_data.startswith(("tc:", "td:")) for row in rows for button in row):
+        return None
+    return InlineKeyboardMarkup(rows)
+
+async def task_action_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    Confirma y elimina una tarea de la base de datos y del scheduler.
+    Atiende los botones de /complete_task y /delete_task:
+    - "tc:<id>" completa la tarea, "td:<id>" la elimina (una única sentencia que verifica el dueño).
+    - "tp:<acción>:n:<cursor>" / "tp:<acción>:p:<cursor>" cambia de página, "tp:<acción>:f" vuelve al inicio.
     """
-    task_id_str = update.message.text
-    telegram_user_id = update.effective_user.id
+    query = update.callback_query
+    telegram_user_id = query.from_user.id
+    kind, _, arg = query.data.partition(":")
 
     try:
-        task_id = int(task_id_str)
-        task_obj = context.user_data.get('tasks_to_delete', {}).get(task_id_str)
-
-        if not task_obj:
-            await update.message.reply_text("ID de tarea inválido. Por favor, ingresa un número de la lista.")
-            return DELETE_TASK_SELECT_ID 
+        if kind == "tp":
+            action, _, rest = arg.partition(":")
+            direction, _, cursor = rest.partition(":")
+            if action not in ("c", "d") or direction not in ("n", "p", "f"):
+                raise ValueError(query.data)
+            if direction == "f":
+                cursor = None
+            else:
+                _decode_task_cursor(cursor) # Valida el cursor antes de consultar
+            await query.answer()
+            text, reply_markup = await _build_task_action_page(
+                telegram_user_id, action, cursor or None, backwards=(direction == "p")
+            )
+            await query.edit_message_text(text, reply_markup=reply_markup)
+            return
 
+        task_id = int(arg)
         async with get_db() as db:
-            success = await delete_task_by_id(db, task_id) 
-            if success:
-                scheduler = get_scheduler()
-                
-                job_id_instant = str(task_id) 
-                if scheduler.get_job(job_id_instant):
-                    scheduler.remove_job(job_id_instant)
-                    logger.info(f"Job instantáneo {job_id_instant} removido del scheduler después de eliminar la tarea {task_id}.")
-                
-                jobs_to_remove = [job.id for job in list(scheduler.get_jobs()) if job.id and job.id.startswith(f"recurring_task_{task_id}")]
-                for job_id_rec in jobs_to_remove:
-                    scheduler.remove_job(job_id_rec)
-                    logger.info(f"Job recurrente {job_id_rec} removido del scheduler después de eliminar la tarea {task_id}.")
-
-                await update.message.reply_text(f"Tarea {task_id} eliminada exitosamente.")
-                logger.info(f"Tarea {task_obj.id} eliminada por el usuario {telegram_user_id}.")
+            if kind == "tc":
+                description = await complete_user_task(db, telegram_user_id, task_id)
             else:
-                await update.message.reply_text(f"No se pudo encontrar la tarea con ID {task_id}.")
-                logger.warning(f"Intento de eliminar tarea {task_id} falló para el usuario {telegram_user_id}.")
-        return ConversationHandler.END 
+                description = await delete_user_task(db, telegram_user_id, task_id)
+
+        if description is None:
+            await query.answer("Esa tarea ya no está disponible.", show_alert=True)
+            logger.warning(f"Acción '{kind}' sobre la tarea {task_id} sin efecto para el usuario {telegram_user_id}.")
+        elif kind == "tc":
+            await query.answer(f"¡Tarea completada: {description[:150]}!")
+            logger.info(f"Tarea {task_id} marcada como completada por el usuario {telegram_user_id}.")
+        else:
+            await query.answer(f"Tarea eliminada: {description[:150]}")
+            logger.info(f"Tarea {task_id} eliminada por el usuario {telegram_user_id}.")
+
+        if description is not None:
+            invalidate_today_agenda(telegram_user_id)
+            await request_task_unschedule([task_id])
+
+        reply_markup = _without_button(query.message.reply_markup, query.data)
+        if reply_markup is None:
+            await query.edit_message_text("Listo. No quedan tareas en esta lista.")
+        else:
+            await query.edit_message_reply_markup(reply_markup=reply_markup)
     except ValueError:
-        await update.message.reply_text("Por favor, ingresa un número válido para el ID de la tarea.")
-        return DELETE_TASK_SELECT_ID 
+        await query.answer("Botón inválido.")
     except Exception as e:
-        logger.error(f"Error en confirm_delete_task para usuario {telegram_user_id}: {e}", exc_info=True)
-        await update.message.reply_text('Lo siento, ocurrió un error al eliminar la tarea. Por favor, inténtalo de nuevo.')
-        return ConversationHandler.END
+        logger.error(f"Error en task_action_callback ({query.data}) para usuario {telegram_user_id}: {e}", exc_info=True)
+        await query.answer("Lo siento, ocurrió un error. Por favor, inténtalo de nuevo.", show_alert=True)
 
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
@@ -516,9 +938,22 @@ def main() -> None:
         logger.critical("TELEGRAM_BOT_TOKEN no está configurado. ¡El bot no puede iniciarse!")
         raise ValueError("El token de Telegram no está configurado en las variables de entorno.")
 
-    application = Application.builder().token(token).post_init(post_init).build()
-    logger.info("Aplicación de Telegram construida.")
-
+    builder = (
+        Application.builder()
+        .token(token)
+        # user_data y estados de conversación sobreviven a reinicios (escritura por lotes)
+        .persistence(DatabasePersistence())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if UPDATE_CONCURRENCY > 1:
+        # Concurrencia entre chats, orden estricto dentro de cada chat (ConversationHandlers consistentes)
+        builder = builder.concurrent_updates(PerChatUpdateProcessor(UPDATE_CONCURRENCY))
+    application = builder.build()
+    logger.info(f"Aplicación de Telegram construida (BOT_MODE='{BOT_MODE}').")
+
+    # Antes que cualquier otro handler: cierra las conversaciones restauradas que ya vencieron
+    application.add_handler(stale_conversation_handler(), group=-1)
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("cancelar", global_cancel_command))
@@ -532,38 +967,42 @@ def main() -> None:
             TASK_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_task_date)],
             TASK_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_task_time)],
             TASK_FREQUENCY: [CallbackQueryHandler(received_task_frequency, pattern="^freq_")],
+            ConversationHandler.TIMEOUT: timeout_handlers(*NEW_TASK_KEYS, conversation="new_task"),
         },
         fallbacks=[CommandHandler('cancelar', global_cancel_command)],
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        name="new_task",
+        persistent=True,
     )
 
     application.add_handler(new_task_conv_handler) 
 
     application.add_handler(CommandHandler("list_tasks", list_tasks_command))
+    application.add_handler(CallbackQueryHandler(task_list_page_callback, pattern=r"^tl:"))
+    application.add_handler(CommandHandler("buscar", search_tasks_command))
+    application.add_handler(CommandHandler(["hoy", "semana", "agenda"], agenda_command))
+    application.add_handler(CallbackQueryHandler(task_search_page_callback, pattern=r"^bs:\d+$"))
 
-    complete_task_conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('complete_task', complete_task_command)],
-        states={
-            COMPLETE_TASK_SELECT_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_complete_task)],
-        },
-        fallbacks=[CommandHandler('cancelar', global_cancel_command)], 
-    )
-    application.add_handler(complete_task_conv_handler)
-
-    delete_task_conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('delete_task', delete_task_command)],
-        states={
-            DELETE_TASK_SELECT_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_delete_task)],
-        },
-        fallbacks=[CommandHandler('cancelar', global_cancel_command)], 
-    )
-    application.add_handler(delete_task_conv_handler)
+    application.add_handler(CommandHandler(["complete_task", "done"], complete_task_command))
+    application.add_handler(CommandHandler(["delete_task", "borrar"], delete_task_command))
+    application.add_handler(CallbackQueryHandler(task_action_callback, pattern=r"^t[cdp]:"))
 
     application.add_handler(get_habits_conversation_handler())
+    application.add_handler(get_habit_time_handler())
+    application.add_handler(get_streaks_handler())
+    for handler in get_habit_checkin_handlers():
+        application.add_handler(handler)
+    application.add_handler(get_stats_handler())
+    application.add_handler(get_admin_stats_handler())
 
     application.add_handler(get_weather_conversation_handler())
 
-    logger.info("Iniciando polling del bot...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_DELIVERY_MODE == "webhook":
+        logger.info("Iniciando el bot en modo webhook...")
+        asyncio.run(run_webhook(application, ALLOWED_UPDATES))
+    else:
+        logger.info("Iniciando polling del bot...")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":
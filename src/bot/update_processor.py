@@ -0,0 +1,113 @@
+import os
+import re
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from src.utils import metrics
+
+# Configuración del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Máximo de updates procesándose a la vez. 1 vuelve al procesamiento secuencial.
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+
+# Tope de etiquetas distintas en las métricas por handler, para acotar las series
+_MAX_HANDLER_LABELS = 64
+_COMMAND_RE = re.compile(r"^/([A-Za-z0-9_]{1,32})")
+
+metrics.describe("updates_in_flight", "Updates que se están procesando en este momento.")
+metrics.describe("updates_waiting_chat", "Updates esperando a que termine otro update del mismo chat.")
+metrics.describe("update_handler_seconds", "Duración del procesamiento de un update por tipo de handler.")
+metrics.describe("updates_total", "Updates procesados por tipo de handler y resultado.")
+
+
+def _chat_key(update: object) -> int | None:
+    """Clave de serialización: el chat del update (o el usuario si no hay chat)."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return None
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Procesa updates de forma concurrente (hasta `max_concurrent_updates`) pero en orden
+    dentro de cada chat, para que los ConversationHandler nunca vean dos updates del
+    mismo chat a la vez. Registra updates en curso y latencia por tipo de handler.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # chat_id -> [asyncio.Lock, updates que lo usan o esperan]
+        self._chat_locks = {}
+        self._handler_labels = set()
+
+    def _handler_label(self, update: object) -> str:
+        """Etiqueta de métricas: comando, prefijo del callback, texto, ubicación u otro."""
+        label = "other"
+        if isinstance(update, Update):
+            if update.callback_query and update.callback_query.data:
+                label = "callback:" + re.split(r"[_:]", update.callback_query.data, maxsplit=1)[0]
+            elif update.message and update.message.text:
+                match = _COMMAND_RE.match(update.message.text)
+                label = f"/{match.group(1).lower()}" if match else "text"
+            elif update.message and update.message.location:
+                label = "location"
+        if label not in self._handler_labels:
+            if len(self._handler_labels) >= _MAX_HANDLER_LABELS:
+                return "other"
+            self._handler_labels.add(label)
+        return label
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat_id = _chat_key(update)
+        if chat_id is None:
+            await super().process_update(update, coroutine)
+            return
+
+        # El lock del chat se toma antes que el cupo de concurrencia: los updates en espera
+        # de un mismo chat no ocupan cupos que podrían usar otros chats.
+        entry = self._chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        metrics.add_gauge("updates_waiting_chat", 1)
+        waiting = True
+        try:
+            async with entry[0]:
+                metrics.add_gauge("updates_waiting_chat", -1)
+                waiting = False
+                await super().process_update(update, coroutine)
+        finally:
+            if waiting:
+                metrics.add_gauge("updates_waiting_chat", -1)
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._chat_locks.pop(chat_id, None)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        label = self._handler_label(update)
+        outcome = "ok"
+        started = time.monotonic()
+        metrics.add_gauge("updates_in_flight", 1)
+        try:
+            await coroutine
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            metrics.add_gauge("updates_in_flight", -1)
+            metrics.observe("update_handler_seconds", time.monotonic() - started, {"handler": label})
+            metrics.increment("updates_total", {"handler": label, "outcome": outcome})
+
+    async def initialize(self) -> None:
+        logger.info(f"Procesamiento concurrente de updates habilitado (máximo {self.max_concurrent_updates}, en orden por chat).")
+
+    async def shutdown(self) -> None:
+        self._chat_locks.clear()
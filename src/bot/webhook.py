@@ -0,0 +1,153 @@
+import os
+import json
+import asyncio
+import hmac
+import logging
+import secrets
+import signal
+
+from telegram import Update
+from telegram.ext import Application
+
+# Configuración del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Configuración del modo webhook (BOT_DELIVERY_MODE=webhook).
+# Para probar localmente sin registrar el webhook en Telegram, dejar WEBHOOK_URL vacía
+# y enviar un update grabado con POST:
+#   curl -X POST http://localhost:8443/telegram \
+#        -H "Content-Type: application/json" \
+#        -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET_TOKEN" \
+#        -d @update.json
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+# URL pública (https) con la que se registra el webhook en Telegram.
+# Si está vacía no se registra: útil para probar localmente enviando updates con POST.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+# Obligatorio para las pruebas locales. Con WEBHOOK_URL, si está vacío se genera uno al azar en cada
+# arranque y se registra en Telegram: nunca se aceptan updates sin secret token.
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN") or None
+# Conexiones simultáneas que Telegram abre contra el webhook (1-100) y que atiende el servidor
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_MAX_BODY_BYTES = 1024 * 1024
+# Segundos máximos para recibir una petición completa: las conexiones lentas o inactivas se cierran
+WEBHOOK_READ_TIMEOUT = float(os.getenv("WEBHOOK_READ_TIMEOUT", "10"))
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+
+async def _read_request(reader: asyncio.StreamReader) -> tuple[str, str, dict, bytes]:
+    """Lee una petición HTTP/1.1 simple y devuelve (método, ruta, cabeceras, cuerpo)."""
+    request_line = (await reader.readline()).decode("latin-1").strip()
+    method, path = (request_line.split() + ["", ""])[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length") or 0)
+    if length > WEBHOOK_MAX_BODY_BYTES:
+        raise ValueError(f"Cuerpo demasiado grande ({length} bytes).")
+    body = await reader.readexactly(length) if length else b""
+    return method, path.split("?")[0], headers, body
+
+
+def _response(status: str, body: bytes = b"") -> bytes:
+    return (
+        f"HTTP/1.1 {status}\r\nContent-Type: text/plain; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+    ).encode("latin-1") + body
+
+
+def _build_request_handler(application: Application, semaphore: asyncio.Semaphore, secret_token: str):
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # La lectura tiene tope de tiempo y ocurre antes de tomar un cupo: una conexión
+            # lenta o inactiva no puede ocupar los cupos que necesitan los updates reales
+            try:
+                method, path, headers, body = await asyncio.wait_for(_read_request(reader), WEBHOOK_READ_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Petición al webhook sin completar a tiempo. Se cierra la conexión.")
+                writer.write(_response("408 Request Timeout"))
+                return
+            async with semaphore:
+                if method == "GET" and path == "/healthz":
+                    writer.write(_response("200 OK", b"ok\n"))
+                elif method != "POST" or path != WEBHOOK_PATH:
+                    writer.write(_response("404 Not Found"))
+                elif not hmac.compare_digest(headers.get(SECRET_HEADER, ""), secret_token):
+                    logger.warning("Petición al webhook con secret token inválido. Se rechaza.")
+                    writer.write(_response("403 Forbidden"))
+                else:
+                    update = Update.de_json(json.loads(body), application.bot)
+                    # Se responde en cuanto el update está encolado; lo procesa la Application
+                    await application.update_queue.put(update)
+                    writer.write(_response("200 OK"))
+                await writer.drain()
+        except (ValueError, json.JSONDecodeError, asyncio.IncompleteReadError) as e:
+            logger.warning(f"Petición inválida al webhook: {e}")
+            writer.write(_response("400 Bad Request"))
+        except Exception as e:
+            logger.error(f"Error al atender una petición del webhook: {e}", exc_info=True)
+            writer.write(_response("500 Internal Server Error"))
+        finally:
+            writer.close()
+    return handle
+
+
+async def run_webhook(application: Application, allowed_updates: list[str]):
+    """
+    Arranca la Application recibiendo updates por webhook con un servidor HTTP asíncrono embebido.
+    Ejecuta post_init/post_shutdown igual que run_polling y registra el webhook en Telegram
+    solo si WEBHOOK_URL está configurada. Toda petición debe traer el secret token.
+    """
+    secret_token = WEBHOOK_SECRET_TOKEN
+    if not secret_token:
+        if not WEBHOOK_URL:
+            raise ValueError("WEBHOOK_SECRET_TOKEN es obligatorio para recibir updates por webhook sin WEBHOOK_URL.")
+        secret_token = secrets.token_urlsafe(32)
+        logger.info("WEBHOOK_SECRET_TOKEN no configurado: se generó uno al azar para este arranque.")
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    semaphore = asyncio.Semaphore(WEBHOOK_MAX_CONNECTIONS)
+    server = await asyncio.start_server(_build_request_handler(application, semaphore, secret_token), WEBHOOK_LISTEN, WEBHOOK_PORT)
+    logger.info(f"Webhook escuchando en http://{WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    if WEBHOOK_URL:
+        await application.bot.set_webhook(
+            url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            allowed_updates=allowed_updates,
+            secret_token=secret_token,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        logger.info(f"Webhook registrado en Telegram: {WEBHOOK_URL}{WEBHOOK_PATH}")
+    else:
+        logger.info("WEBHOOK_URL no configurada: el webhook no se registra en Telegram (modo de prueba local).")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass # Windows no soporta add_signal_handler
+
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("Deteniendo el servidor del webhook...")
+        server.close()
+        await server.wait_closed()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
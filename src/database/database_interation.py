@@ -1,14 +1,20 @@
 import logging
-from datetime import datetime
+from datetime import date, datetime, time, timedelta
+from typing import NamedTuple
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
-from sqlalchemy import text
+import sqlalchemy as sa
+from sqlalchemy import text, delete, update
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import joinedload
+from sqlalchemy.dialects.postgresql import insert as pg_insert, ARRAY
 
 # Importar el SessionLocal asíncrono, el motor, y AHORA TAMBIÉN init_db_async desde db_context.py
 from src.database.db_context import AsyncSessionLocal, engine, init_db_async
-from src.database.models import Base, User, DefaultHabit, UserHabit, UserTask
+from src.database.models import (
+    Base, User, DefaultHabit, UserHabit, UserTask, SchedulerCommand, BotPersistence, HabitCheckin,
+    UserDailyStats, GlobalDailyStats
+)
 
 
 # Configuración del logger para este módulo
@@ -19,6 +25,56 @@ db_logger.setLevel(logging.INFO) # Puedes ajustar el nivel aquí
 init_db = init_db_async
 
 
+class TaskRow(NamedTuple):
+    """
+    Fila de solo lectura de una tarea, con las columnas que usan los listados.
+    Se construye directamente desde el resultado de la consulta, sin instancias ORM
+    ni seguimiento en el identity map de la sesión.
+    """
+    id: int
+    description: str
+    due_date: datetime | None
+    frequency: str | None
+    completed: bool
+
+TASK_ROW_COLUMNS = (UserTask.id, UserTask.description, UserTask.due_date, UserTask.frequency, UserTask.completed)
+
+def select_task_rows(user_id: int, incomplete_only: bool = False):
+    """Consulta de solo lectura de las tareas de un usuario ordenadas por due_date (columnas de TaskRow)."""
+    stmt = select(*TASK_ROW_COLUMNS).filter(UserTask.user_id == user_id)
+    if incomplete_only:
+        stmt = stmt.filter(UserTask.completed == False)
+    return stmt.order_by(UserTask.due_date)
+
+# Hora local por defecto del resumen diario de hábitos
+DEFAULT_HABIT_REMINDER_TIME = time(9, 0)
+
+
+def habit_reminder_bucket(reminder_time: time, timezone_str: str, on_date: datetime = None) -> int:
+    """
+    Convierte una hora local del usuario en su minuto del día en UTC (0-1439),
+    que es el índice de bucket usado para despachar el resumen de hábitos.
+    Se calcula con la fecha actual para respetar el horario de verano vigente.
+    """
+    try:
+        user_tz = ZoneInfo(timezone_str or 'UTC')
+    except ZoneInfoNotFoundError:
+        user_tz = ZoneInfo('UTC')
+    local_date = (on_date or datetime.now(user_tz)).astimezone(user_tz).date()
+    local_dt = datetime.combine(local_date, reminder_time, tzinfo=user_tz)
+    utc_dt = local_dt.astimezone(ZoneInfo('UTC'))
+    return utc_dt.hour * 60 + utc_dt.minute
+
+
+def timezone_utc_offset(timezone_str: str, on_date: datetime = None) -> int:
+    """Offset UTC vigente de una zona horaria, en minutos (UTC si la zona no es válida)."""
+    try:
+        user_tz = ZoneInfo(timezone_str or 'UTC')
+    except ZoneInfoNotFoundError:
+        user_tz = ZoneInfo('UTC')
+    return int((on_date or datetime.now(user_tz)).astimezone(user_tz).utcoffset() // timedelta(minutes=1))
+
+
 async def create_user_if_not_exists(db: AsyncSession, telegram_id: int, username: str = None, first_name: str = None, last_name: str = None) -> User:
     """
     Crea un nuevo usuario si no existe, o devuelve el existente.
@@ -35,6 +91,8 @@ async def create_user_if_not_exists(db: AsyncSession, telegram_id: int, username
             username=username,
             first_name=first_name,
             last_name=last_name,
+            habit_reminder_time=DEFAULT_HABIT_REMINDER_TIME,
+            habit_reminder_minute=habit_reminder_bucket(DEFAULT_HABIT_REMINDER_TIME, 'UTC'),
         )
         db.add(user)
         await db.commit() # await para operaciones asíncronas
@@ -122,6 +180,7 @@ async def update_user_timezone(db: AsyncSession, user_id: int, new_timezone: str
                 return False
 
             user.timezone = new_timezone
+            user.habit_reminder_minute = habit_reminder_bucket(user.habit_reminder_time or DEFAULT_HABIT_REMINDER_TIME, new_timezone)
             await db.commit() # await para operaciones asíncronas
             await db.refresh(user) # await para operaciones asíncronas
             db_logger.info(f"Zona horaria para usuario {user_id} actualizada a: {user.timezone}")
@@ -134,6 +193,73 @@ async def update_user_timezone(db: AsyncSession, user_id: int, new_timezone: str
         db_logger.error(f"Error al actualizar la zona horaria para user_id {user_id}: {e}", exc_info=True)
         raise # Re-lanzar para que el llamador pueda manejarlo
 
+async def deactivate_user_by_telegram_id(db: AsyncSession, telegram_id: int) -> list[int]:
+    """
+    Marca como inactivo a un usuario que bloqueó el bot o cuyo chat ya no existe.
+    :param db: La sesión de la base de datos asíncrona.
+    :param telegram_id: El ID de Telegram del usuario.
+    :return: Los IDs de sus tareas pendientes con fecha, para cancelar sus recordatorios.
+    """
+    try:
+        result = await db.execute(
+            update(User)
+            .where(User.telegram_id == telegram_id, User.is_active == True)
+            .values(is_active=False)
+            .returning(User.id)
+        )
+        user_id = result.scalar_one_or_none()
+        if user_id is None:
+            await db.commit()
+            return []
+        result = await db.execute(
+            select(UserTask.id).filter(
+                UserTask.user_id == user_id,
+                UserTask.completed == False,
+                UserTask.due_date != None
+            )
+        )
+        task_ids = list(result.scalars().all())
+        await db.commit()
+        db_logger.info(f"Usuario {telegram_id} marcado como inactivo. {len(task_ids)} tareas con recordatorio afectadas.")
+        return task_ids
+    except Exception as e:
+        await db.rollback()
+        db_logger.error(f"Error al marcar como inactivo al usuario {telegram_id}: {e}", exc_info=True)
+        raise
+
+async def reactivate_user_by_telegram_id(db: AsyncSession, telegram_id: int) -> list[tuple[int, str | None]]:
+    """
+    Vuelve a marcar como activo a un usuario inactivo (por ejemplo, al enviar /start otra vez).
+    :return: Las tuplas (id, frecuencia) de sus tareas pendientes con fecha, para reprogramarlas.
+             Lista vacía si el usuario ya estaba activo o no existe.
+    """
+    try:
+        result = await db.execute(
+            update(User)
+            .where(User.telegram_id == telegram_id, User.is_active == False)
+            .values(is_active=True)
+            .returning(User.id)
+        )
+        user_id = result.scalar_one_or_none()
+        if user_id is None:
+            await db.commit()
+            return []
+        result = await db.execute(
+            select(UserTask.id, UserTask.frequency).filter(
+                UserTask.user_id == user_id,
+                UserTask.completed == False,
+                UserTask.due_date != None
+            )
+        )
+        tasks = [tuple(row) for row in result.all()]
+        await db.commit()
+        db_logger.info(f"Usuario {telegram_id} reactivado. {len(tasks)} tareas para reprogramar.")
+        return tasks
+    except Exception as e:
+        await db.rollback()
+        db_logger.error(f"Error al reactivar al usuario {telegram_id}: {e}", exc_info=True)
+        raise
+
 # Métodos de tareas (ahora todos asíncronos)
 async def set_task(db: AsyncSession, user_id: int, description: str, due_date: datetime = None, frequency: str = None) -> UserTask:
     """
@@ -245,6 +371,19 @@ async def get_incomplete_tasks(db: AsyncSession, user_id: int) -> list[UserTask]
         db_logger.error(f"Error al obtener tareas incompletas para user_id {user_id}: {e}", exc_info=True)
         raise
 
+async def get_user_task_rows(db: AsyncSession, user_id: int, incomplete_only: bool = False) -> list[TaskRow]:
+    """
+    Variante de solo lectura de get_user_tasks/get_incomplete_tasks para listados:
+    selecciona solo las columnas necesarias y devuelve TaskRow en lugar de objetos UserTask.
+    """
+    db_logger.debug(f"Obteniendo filas de tareas para user_id: {user_id} (solo incompletas: {incomplete_only})")
+    try:
+        result = await db.execute(select_task_rows(user_id, incomplete_only))
+        return [TaskRow(*row) for row in result.all()]
+    except Exception as e:
+        db_logger.error(f"Error al obtener filas de tareas para user_id {user_id}: {e}", exc_info=True)
+        raise
+
 async def get_completed_tasks(db: AsyncSession, user_id: int) -> list[UserTask]:
     """
     Obtiene las tareas completadas de un usuario de forma asíncrona.
@@ -276,6 +415,7 @@ async def mark_as_completed(db: AsyncSession, task_id: int) -> bool:
         task = result.scalar_one_or_none()
         if task:
             task.completed = True
+            task.completed_at = datetime.now(ZoneInfo('UTC'))
             await db.commit() # await para operaciones asíncronas
             await db.refresh(task) # await para operaciones asíncronas
             db_logger.info(f"Tarea {task_id} marcada como completada exitosamente.")
@@ -325,6 +465,7 @@ async def complete_task_by_id(db: AsyncSession, task_id: int) -> bool:
         task = result.scalar_one_or_none()
         if task:
             task.completed = True
+            task.completed_at = datetime.now(ZoneInfo('UTC'))
             await db.commit() # await para operaciones asíncronas
             await db.refresh(task) # await para operaciones asíncronas
             db_logger.info(f"Tarea {task_id} marcada como completada exitosamente.")
@@ -338,12 +479,474 @@ async def complete_task_by_id(db: AsyncSession, task_id: int) -> bool:
         raise
 
 
+def _owned_by_telegram_user(telegram_id: int):
+    """Condición: la tarea pertenece al usuario con ese ID de Telegram (subconsulta, sin ida y vuelta extra)."""
+    return UserTask.user_id == select(User.id).where(User.telegram_id == telegram_id).scalar_subquery()
+
+async def complete_user_task(db: AsyncSession, telegram_id: int, task_id: int) -> str | None:
+    """
+    Marca como completada una tarea de una sola vez (no recurrente) verificando en la misma
+    sentencia que pertenezca al usuario.
+    :param db: La sesión de la base de datos asíncrona.
+    :param telegram_id: El ID de Telegram del usuario que pide completarla.
+    :param task_id: El ID de la tarea.
+    :return: La descripción de la tarea, o None si no existe, no es del usuario, es recurrente o ya estaba completada.
+    """
+    try:
+        result = await db.execute(
+            update(UserTask)
+            .where(
+                UserTask.id == task_id,
+                _owned_by_telegram_user(telegram_id),
+                UserTask.completed == False,
+                UserTask.frequency == None
+            )
+            .values(completed=True, completed_at=sa.func.now())
+            .returning(UserTask.description)
+            .execution_options(synchronize_session=False)
+        )
+        description = result.scalar_one_or_none()
+        await db.commit()
+        return description
+    except Exception as e:
+        await db.rollback()
+        db_logger.error(f"Error al completar la tarea {task_id} del usuario {telegram_id}: {e}", exc_info=True)
+        raise
+
+async def delete_user_task(db: AsyncSession, telegram_id: int, task_id: int) -> str | None:
+    """
+    Elimina una tarea verificando en la misma sentencia que pertenezca al usuario.
+    :return: La descripción de la tarea eliminada, o None si no existe o no es del usuario.
+    """
+    try:
+        result = await db.execute(
+            delete(UserTask)
+            .where(UserTask.id == task_id, _owned_by_telegram_user(telegram_id))
+            .returning(UserTask.description)
+            .execution_options(synchronize_session=False)
+        )
+        description = result.scalar_one_or_none()
+        await db.commit()
+        return description
+    except Exception as e:
+        await db.rollback()
+        db_logger.error(f"Error al eliminar la tarea {task_id} del usuario {telegram_id}: {e}", exc_info=True)
+        raise
+
+def _task_id_in(task_ids: list[int]):
+    """Condición `user_tasks.id = ANY(:ids)`: un único parámetro array sin importar cuántos IDs haya."""
+    return UserTask.id == sa.any_(sa.literal(list(task_ids), ARRAY(sa.Integer)))
+
+async def complete_user_tasks(db: AsyncSession, telegram_id: int, task_ids: list[int]) -> list[int]:
+    """
+    Marca como completadas varias tareas de una sola vez (no recurrentes) del usuario en una única sentencia.
+    :return: Los IDs efectivamente completados (los ajenos, recurrentes o ya completados se omiten).
+    """
+    if not task_ids:
+        return []
+    try:
+        result = await db.execute(
+            update(UserTask)
+            .where(
+                _task_id_in(task_ids),
+                _owned_by_telegram_user(telegram_id),
+                UserTask.completed == False,
+                UserTask.frequency == None
+            )
+            .values(completed=True, completed_at=sa.func.now())
+            .returning(UserTask.id)
+            .execution_options(synchronize_session=False)
+        )
+        completed_ids = sorted(result.scalars().all())
+        await db.commit()
+        return completed_ids
+    except Exception as e:
+        await db.rollback()
+        db_logger.error(f"Error al completar las tareas {task_ids[:20]} del usuario {telegram_id}: {e}", exc_info=True)
+        raise
+
+async def delete_user_tasks(db: AsyncSession, telegram_id: int, task_ids: list[int] | None = None, completed_only: bool = False) -> list[int]:
+    """
+    Elimina varias tareas del usuario en una única sentencia DELETE ... RETURNING.
+    :param task_ids: IDs a eliminar; None elimina todas las que cumplan el resto de condiciones.
+    :param completed_only: Solo elimina tareas ya completadas (ej. "/delete_task completadas").
+    :return: Los IDs efectivamente eliminados.
+    """
+    if task_ids is not None and not task_ids:
+        return []
+    conditions = [_owned_by_telegram_user(telegram_id)]
+    if task_ids is not None:
+        conditions.append(_task_id_in(task_ids))
+    if completed_only:
+        conditions.append(UserTask.completed == True)
+    try:
+        result = await db.execute(
+            delete(UserTask)
+            .where(*conditions)
+            .returning(UserTask.id)
+            .execution_options(synchronize_session=False)
+        )
+        deleted_ids = sorted(result.scalars().all())
+        await db.commit()
+        return deleted_ids
+    except Exception as e:
+        await db.rollback()
+        db_logger.error(f"Error al eliminar tareas del usuario {telegram_id}: {e}", exc_info=True)
+        raise
+
+async def get_user_timezone(db: AsyncSession, telegram_id: int) -> tuple[bool, str | None]:
+    """
+    Consulta solo la zona horaria del usuario (sin cargar el objeto User).
+    :return: (registrado, zona horaria o None).
+    """
+    result = await db.execute(select(User.timezone).where(User.telegram_id == telegram_id))
+    row = result.first()
+    return (row is not None, row[0] if row else None)
+
+async def create_user_task(db: AsyncSession, telegram_id: int, description: str, due_date: datetime | None, frequency: str | None) -> int | None:
+    """
+    Crea una tarea con una única sentencia INSERT ... SELECT ... RETURNING: el usuario se
+    resuelve por su ID de Telegram dentro de la misma sentencia.
+    :param due_date: Fecha de vencimiento consciente de zona horaria (se guarda en UTC) o None.
+    :return: El ID de la tarea creada, o None si el usuario no está registrado.
+    """
+    due_date_utc = due_date.astimezone(ZoneInfo('UTC')) if due_date else None
+    try:
+        result = await db.execute(
+            sa.insert(UserTask)
+            .from_select(
+                ["user_id", "description", "due_date", "completed", "frequency"],
+                select(
+                    User.id,
+                    sa.literal(description, sa.String),
+                    sa.literal(due_date_utc, sa.DateTime(timezone=True)),
+                    sa.false(),
+                    sa.literal(frequency, sa.String),
+                ).where(User.telegram_id == telegram_id)
+            )
+            .returning(UserTask.id)
+        )
+        task_id = result.scalar_one_or_none()
+        await db.commit()
+        if task_id is not None:
+            db_logger.info(f"Tarea {task_id} ('{description}') creada para el usuario {telegram_id}. due_date UTC: {due_date_utc}")
+        return task_id
+    except Exception as e:
+        await db.rollback()
+        db_logger.error(f"Error al crear la tarea del usuario {telegram_id}: {e}", exc_info=True)
+        raise
+
+async def get_task_page(
+    db: AsyncSession,
+    telegram_id: int,
+    cursor: tuple[datetime | None, int] | None = None,
+    backwards: bool = False,
+    limit: int = 10,
+    completable_only: bool = False,
+) -> tuple[list[TaskRow], str | None, bool]:
+    """
+    Obtiene una página de tareas de un usuario (pendientes y completadas) para los botones de
+    /complete_task y /delete_task, con la misma keyset pagination sobre (due_date NULLS LAST, id)
+    que get_pending_task_page: completar o eliminar tareas de una página no corre las siguientes.
+    :param completable_only: Si es True, solo tareas pendientes de una sola vez (las que se pueden completar).
+    :return: (filas TaskRow en orden ascendente, zona horaria del usuario, True si hay más en esa dirección).
+    """
+    filters = [User.telegram_id == telegram_id]
+    if completable_only:
+        filters += [UserTask.completed == False, UserTask.frequency == None]
+    return await _keyset_task_page(db, telegram_id, filters, cursor, backwards, limit)
+
+
+async def get_agenda_rows(db: AsyncSession, telegram_id: int, start_utc: datetime, end_utc: datetime) -> list[TaskRow]:
+    """
+    Tareas pendientes del usuario relevantes para la ventana [start_utc, end_utc):
+    - las de una sola vez que vencen dentro de la ventana (rango sobre el índice
+      ix_user_tasks_user_pending_due: user_id y completed por igualdad, due_date por rango);
+    - las recurrentes que empezaron antes del fin de la ventana, para expandir sus
+      ocurrencias en memoria (src/utils/agenda.py) sin crear filas.
+    Ambas partes van en una sola consulta (UNION ALL).
+    """
+    pending = (_owned_by_telegram_user(telegram_id), UserTask.completed == False)
+    one_off = select(*TASK_ROW_COLUMNS).where(
+        *pending, UserTask.frequency == None, UserTask.due_date >= start_utc, UserTask.due_date < end_utc
+    )
+    recurring = select(*TASK_ROW_COLUMNS).where(
+        *pending, UserTask.frequency != None, UserTask.due_date < end_utc
+    )
+    try:
+        result = await db.execute(sa.union_all(one_off, recurring))
+        return [TaskRow(*row) for row in result.all()]
+    except Exception as e:
+        db_logger.error(f"Error al obtener la agenda del usuario {telegram_id}: {e}", exc_info=True)
+        raise
+
+
+# Columna generada tsvector (ver SCHEMA_UPGRADES) y configuración de texto con la que se construye
+_TASK_SEARCH_VECTOR = sa.literal_column("user_tasks.description_tsv")
+_TASK_SEARCH_CONFIG = sa.literal_column("'spanish'::regconfig")
+
+async def search_user_tasks(db: AsyncSession, telegram_id: int, query_text: str, offset: int, limit: int) -> tuple[list[TaskRow], str | None]:
+    """
+    Busca tareas del usuario por texto completo (índice GIN sobre description_tsv), ordenadas
+    por relevancia (ts_rank) y luego por ID descendente.
+    Acepta la sintaxis de websearch_to_tsquery: "frase exacta", -excluir, a or b.
+    :return: (filas TaskRow, zona horaria del usuario). Se piden `limit + 1` filas para saber si hay más.
+    """
+    tsquery = sa.func.websearch_to_tsquery(_TASK_SEARCH_CONFIG, query_text)
+    try:
+        result = await db.execute(
+            select(*TASK_ROW_COLUMNS, User.timezone)
+            .join(UserTask.user)
+            .where(User.telegram_id == telegram_id, _TASK_SEARCH_VECTOR.bool_op("@@")(tsquery))
+            .order_by(sa.func.ts_rank(_TASK_SEARCH_VECTOR, tsquery).desc(), UserTask.id.desc())
+            .offset(offset)
+            .limit(limit + 1)
+        )
+        rows = result.all()
+        timezone_str = rows[0].timezone if rows else None
+        return [TaskRow(*row[:5]) for row in rows], timezone_str
+    except Exception as e:
+        db_logger.error(f"Error al buscar tareas del usuario {telegram_id}: {e}", exc_info=True)
+        raise
+
+
+async def get_pending_task_page(
+    db: AsyncSession,
+    telegram_id: int,
+    cursor: tuple[datetime | None, int] | None = None,
+    backwards: bool = False,
+    limit: int = 10,
+) -> tuple[list[TaskRow], str | None, bool]:
+    """
+    Obtiene una página de tareas pendientes con keyset pagination sobre (due_date NULLS LAST, id),
+    usando el índice ix_user_tasks_user_pending_due: cada página es una lectura acotada
+    sin OFFSET, sin importar cuántas tareas tenga el usuario.
+    :param cursor: (due_date, id) de la tarea límite. None para la primera página.
+    :param backwards: True para la página anterior al cursor.
+    :return: (filas TaskRow en orden ascendente,
+              zona horaria del usuario, True si hay más tareas en esa dirección).
+    """
+    filters = [User.telegram_id == telegram_id, UserTask.completed == False]
+    return await _keyset_task_page(db, telegram_id, filters, cursor, backwards, limit)
+
+
+async def _keyset_task_page(
+    db: AsyncSession,
+    telegram_id: int,
+    filters: list,
+    cursor: tuple[datetime | None, int] | None,
+    backwards: bool,
+    limit: int,
+) -> tuple[list[TaskRow], str | None, bool]:
+    """Página por keyset sobre (due_date NULLS LAST, id) a partir del cursor, con los filtros dados."""
+    filters = list(filters)
+    if cursor is not None:
+        cursor_due, cursor_id = cursor
+        if not backwards:
+            if cursor_due is None:
+                filters.append(sa.and_(UserTask.due_date == None, UserTask.id > cursor_id))
+            else:
+                filters.append(sa.or_(
+                    UserTask.due_date > cursor_due,
+                    sa.and_(UserTask.due_date == cursor_due, UserTask.id > cursor_id),
+                    UserTask.due_date == None,
+                ))
+        else:
+            if cursor_due is None:
+                filters.append(sa.or_(
+                    UserTask.due_date != None,
+                    sa.and_(UserTask.due_date == None, UserTask.id < cursor_id),
+                ))
+            else:
+                filters.append(sa.or_(
+                    UserTask.due_date < cursor_due,
+                    sa.and_(UserTask.due_date == cursor_due, UserTask.id < cursor_id),
+                ))
+
+    if backwards:
+        order_by = (UserTask.due_date.desc().nulls_first(), UserTask.id.desc())
+    else:
+        order_by = (UserTask.due_date.asc().nulls_last(), UserTask.id.asc())
+
+    try:
+        result = await db.execute(
+            select(*TASK_ROW_COLUMNS, User.timezone)
+            .join(UserTask.user)
+            .where(*filters)
+            .order_by(*order_by)
+            .limit(limit + 1)
+        )
+        rows = result.all()
+    except Exception as e:
+        db_logger.error(f"Error al obtener la página de tareas del usuario {telegram_id}: {e}", exc_info=True)
+        raise
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    timezone_str = rows[0].timezone if rows else None
+    if backwards:
+        rows.reverse()
+    return [TaskRow(*row[:5]) for row in rows], timezone_str, has_more
+
+
 # Inserta este bloque de código en src/database/database_interation.py
 
+# Mueve un lote de tareas completadas antes de :cutoff a user_tasks_archive en una sola sentencia.
+# SKIP LOCKED evita esperar (o chocar) con filas que otra transacción está modificando.
+_ARCHIVE_COMPLETED_TASKS_SQL = text("""
+    WITH moved AS (
+        DELETE FROM user_tasks
+        WHERE id IN (
+            SELECT id FROM user_tasks
+            WHERE completed AND completed_at < :cutoff
+            ORDER BY completed_at
+            LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, user_id, description, due_date, frequency, completed_at, created_at
+    )
+    INSERT INTO user_tasks_archive (id, user_id, description, due_date, frequency, completed_at, created_at)
+    SELECT id, user_id, description, due_date, frequency, completed_at, created_at FROM moved
+""")
+
+async def archive_completed_tasks_batch(db: AsyncSession, cutoff: datetime, batch_size: int) -> int:
+    """
+    Archiva hasta `batch_size` tareas completadas antes de `cutoff` (DELETE ... RETURNING + INSERT
+    en la misma transacción). Retorna cuántas se movieron; menos que `batch_size` indica que no quedan más.
+    """
+    try:
+        result = await db.execute(_ARCHIVE_COMPLETED_TASKS_SQL, {"cutoff": cutoff, "batch_size": batch_size})
+        await db.commit()
+        return result.rowcount
+    except Exception as e:
+        await db.rollback()
+        db_logger.error(f"Error al archivar tareas completadas antes de {cutoff}: {e}", exc_info=True)
+        raise
+
+# Recalcula user_daily_stats desde :since (fecha local de cada usuario). Cada fuente entra por un índice:
+# created_at de user_tasks, completed_at de user_tasks y del archivo, y la fecha de habit_checkins.
+# :since_utc es un día antes de :since para cubrir cualquier zona horaria.
+_ROLLUP_USER_DAILY_STATS_SQL = text("""
+    WITH activity AS (
+        SELECT t.user_id, (t.created_at AT TIME ZONE u.timezone)::date AS stat_date,
+               1 AS created, 0 AS completed, 0 AS habits
+        FROM user_tasks t JOIN users u ON u.id = t.user_id
+        WHERE t.created_at >= :since_utc
+        UNION ALL
+        SELECT t.user_id, (t.completed_at AT TIME ZONE u.timezone)::date, 0, 1, 0
+        FROM user_tasks t JOIN users u ON u.id = t.user_id
+        WHERE t.completed AND t.completed_at >= :since_utc
+        UNION ALL
+        -- Una tarea se completa después de crearse: basta con filtrar el archivo por completed_at
+        SELECT a.user_id, (a.completed_at AT TIME ZONE u.timezone)::date, 0, 1, 0
+        FROM user_tasks_archive a JOIN users u ON u.id = a.user_id
+        WHERE a.completed_at >= :since_utc
+        UNION ALL
+        SELECT a.user_id, (a.created_at AT TIME ZONE u.timezone)::date, 1, 0, 0
+        FROM user_tasks_archive a JOIN users u ON u.id = a.user_id
+        WHERE a.completed_at >= :since_utc AND a.created_at >= :since_utc
+        UNION ALL
+        SELECT uh.user_id, c.checkin_date, 0, 0, 1
+        FROM habit_checkins c JOIN user_habits uh ON uh.id = c.user_habit_id
+        WHERE c.checkin_date >= :since
+    )
+    INSERT INTO user_daily_stats (user_id, stat_date, tasks_created, tasks_completed, habits_done)
+    SELECT user_id, stat_date, sum(created), sum(completed), sum(habits)
+    FROM activity
+    WHERE stat_date >= :since
+    GROUP BY user_id, stat_date
+""")
+
+_ROLLUP_GLOBAL_DAILY_STATS_SQL = text("""
+    INSERT INTO global_daily_stats (stat_date, active_users, tasks_created, tasks_completed, habits_done)
+    SELECT stat_date, count(*), sum(tasks_created), sum(tasks_completed), sum(habits_done)
+    FROM user_daily_stats
+    WHERE stat_date >= :since
+    GROUP BY stat_date
+""")
+
+async def rollup_daily_stats(db: AsyncSession, since: date) -> int:
+    """
+    Recalcula las estadísticas diarias por usuario y globales desde `since` (inclusive).
+    Borra y vuelve a insertar las filas del período en una sola transacción, así que es
+    idempotente y refleja también las tareas borradas. Retorna las filas de usuario escritas.
+    """
+    since_utc = datetime.combine(since - timedelta(days=1), time(0, 0), tzinfo=ZoneInfo('UTC'))
+    try:
+        await db.execute(delete(UserDailyStats).where(UserDailyStats.stat_date >= since))
+        result = await db.execute(_ROLLUP_USER_DAILY_STATS_SQL, {"since": since, "since_utc": since_utc})
+        written = result.rowcount
+        await db.execute(delete(GlobalDailyStats).where(GlobalDailyStats.stat_date >= since))
+        await db.execute(_ROLLUP_GLOBAL_DAILY_STATS_SQL, {"since": since})
+        await db.commit()
+        return written
+    except Exception as e:
+        await db.rollback()
+        db_logger.error(f"Error al recalcular las estadísticas diarias desde {since}: {e}", exc_info=True)
+        raise
+
+class StatsSummary(NamedTuple):
+    """Totales de actividad de los últimos 7 y 30 días, leídos de las tablas de estadísticas diarias."""
+    week_created: int
+    week_completed: int
+    week_habits: int
+    month_created: int
+    month_completed: int
+    month_habits: int
+
+def _stats_totals(table, week_start) -> list:
+    """Sumas de la semana (desde `week_start`) y del período consultado de una tabla de estadísticas."""
+    week = table.stat_date >= week_start
+    return [
+        sa.func.coalesce(sa.func.sum(column).filter(week), 0)
+        for column in (table.tasks_created, table.tasks_completed, table.habits_done)
+    ] + [
+        sa.func.coalesce(sa.func.sum(column), 0)
+        for column in (table.tasks_created, table.tasks_completed, table.habits_done)
+    ]
+
+async def get_user_stats(db: AsyncSession, telegram_id: int) -> tuple[StatsSummary, int] | None:
+    """
+    Estadísticas de los últimos 7 y 30 días del usuario (fecha local), desde user_daily_stats:
+    a lo sumo 30 filas por la clave primaria, sin tocar user_tasks ni habit_checkins.
+    :return: (StatsSummary, cantidad actual de hábitos del usuario) o None si no está registrado.
+    """
+    local_today = sa.cast(sa.func.timezone(User.timezone, sa.func.now()), sa.Date)
+    habit_count = (
+        select(sa.func.count()).select_from(UserHabit).where(UserHabit.user_id == User.id).scalar_subquery()
+    )
+    result = await db.execute(
+        select(*_stats_totals(UserDailyStats, local_today - 6), habit_count)
+        .select_from(User)
+        .outerjoin(
+            UserDailyStats,
+            sa.and_(UserDailyStats.user_id == User.id, UserDailyStats.stat_date >= local_today - 29)
+        )
+        .where(User.telegram_id == telegram_id)
+        .group_by(User.id)
+    )
+    row = result.first()
+    return (StatsSummary(*row[:6]), row[6]) if row else None
+
+async def get_global_stats(db: AsyncSession, today: date) -> tuple[StatsSummary, int]:
+    """
+    Totales de todos los usuarios en los 7 y 30 días que terminan en `today`, desde global_daily_stats (≤ 30 filas).
+    :return: (StatsSummary, máximo de usuarios con actividad en un mismo día del período).
+    """
+    result = await db.execute(
+        select(
+            *_stats_totals(GlobalDailyStats, today - timedelta(days=6)),
+            sa.func.coalesce(sa.func.max(GlobalDailyStats.active_users), 0)
+        )
+        .where(GlobalDailyStats.stat_date >= today - timedelta(days=29), GlobalDailyStats.stat_date <= today)
+    )
+    row = result.first()
+    return StatsSummary(*row[:6]), row[6]
+
 async def get_all_users(db: AsyncSession) -> list[User]:
-    """Obtiene todos los usuarios de la base de datos."""
+    """Obtiene todos los usuarios activos (que no bloquearon el bot) de la base de datos."""
     db_logger.debug("[DB] Obteniendo todos los usuarios.")
-    result = await db.execute(select(User))
+    result = await db.execute(select(User).filter(User.is_active == True))
     users = result.scalars().all()
     db_logger.info(f"[DB] Encontrados {len(users)} usuarios.")
     return users
@@ -367,6 +970,156 @@ async def get_user_habits(db: AsyncSession, user_id: int) -> list[UserHabit]:
     result = await db.execute(select(UserHabit).filter(UserHabit.user_id == user_id))
     return result.scalars().all()
 
+async def set_habit_reminder_time(db: AsyncSession, user_id: int, reminder_time: time) -> bool:
+    """
+    Guarda la hora local del resumen diario de hábitos de un usuario y recalcula su bucket UTC.
+    :param db: La sesión de la base de datos asíncrona.
+    :param user_id: El ID interno del usuario (no el telegram_id).
+    :param reminder_time: La hora local elegida por el usuario.
+    :return: True si se actualizó, False si el usuario no se encontró.
+    """
+    db_logger.info(f"Actualizando la hora del resumen de hábitos para user_id {user_id} a {reminder_time.strftime('%H:%M')}")
+    try:
+        result = await db.execute(select(User).filter(User.id == user_id))
+        user = result.scalar_one_or_none()
+        if not user:
+            db_logger.warning(f"No se encontró el usuario con user_id {user_id} para actualizar la hora de hábitos.")
+            return False
+        user.habit_reminder_time = reminder_time
+        user.habit_reminder_minute = habit_reminder_bucket(reminder_time, user.timezone)
+        await db.commit()
+        db_logger.info(f"Resumen de hábitos de user_id {user_id} en el bucket UTC {user.habit_reminder_minute}.")
+        return True
+    except Exception as e:
+        await db.rollback()
+        db_logger.error(f"Error al actualizar la hora de hábitos para user_id {user_id}: {e}", exc_info=True)
+        raise
+
+async def get_user_timezones(db: AsyncSession) -> list[str]:
+    """Zonas horarias distintas en uso por los usuarios (unas pocas decenas, vía ix_users_timezone)."""
+    result = await db.execute(select(User.timezone).distinct())
+    return list(result.scalars().all())
+
+_REFRESH_HABIT_BUCKETS_SQL = text("""
+    UPDATE users u
+    SET habit_reminder_minute = b.minute
+    FROM (
+        SELECT u2.id,
+               ((extract(hour FROM u2.habit_reminder_time) * 60 + extract(minute FROM u2.habit_reminder_time))::int
+                - z.offset_minutes + 1440) % 1440 AS minute
+        FROM users u2
+        JOIN unnest(CAST(:zones AS text[]), CAST(:offsets AS int[])) AS z(timezone, offset_minutes)
+          ON u2.timezone = z.timezone
+    ) b
+    WHERE u.id = b.id AND u.habit_reminder_minute IS DISTINCT FROM b.minute
+""")
+
+async def refresh_habit_reminder_buckets(db: AsyncSession, zone_offsets: dict[str, int]) -> int:
+    """
+    Recalcula en la base de datos, con un único UPDATE, el bucket UTC del resumen de hábitos
+    de los usuarios de las zonas indicadas (las que cambiaron de offset por el horario de verano).
+    Solo escribe las filas cuyo bucket cambió. Retorna la cantidad de filas actualizadas.
+    :param zone_offsets: Zona horaria -> offset UTC vigente en minutos (ver timezone_utc_offset).
+    """
+    if not zone_offsets:
+        return 0
+    try:
+        result = await db.execute(
+            _REFRESH_HABIT_BUCKETS_SQL,
+            {"zones": list(zone_offsets), "offsets": list(zone_offsets.values())},
+        )
+        await db.commit()
+        db_logger.info(
+            f"[DB] Buckets de resumen de hábitos recalculados en {len(zone_offsets)} zonas: "
+            f"{result.rowcount} usuarios actualizados."
+        )
+        return result.rowcount
+    except Exception as e:
+        await db.rollback()
+        db_logger.error(f"Error al recalcular los buckets de hábitos: {e}", exc_info=True)
+        raise
+
+async def get_habit_digest_rows(db: AsyncSession, reminder_minute: int) -> list[tuple[int, int, str]]:
+    """
+    Obtiene, en una sola consulta indexada por bucket, los hábitos de los usuarios
+    activos cuyo resumen diario toca en el minuto UTC indicado.
+    :return: Lista de tuplas (telegram_id, ID de user_habit, descripción del hábito) ordenada por usuario.
+    """
+    result = await db.execute(
+        select(User.telegram_id, UserHabit.id, DefaultHabit.description)
+        .join(UserHabit, UserHabit.user_id == User.id)
+        .join(DefaultHabit, DefaultHabit.id == UserHabit.habit_id)
+        .filter(User.habit_reminder_minute == reminder_minute, User.is_active == True)
+        .order_by(User.telegram_id, DefaultHabit.id)
+    )
+    return [tuple(row) for row in result.all()]
+
+async def record_habit_checkin(db: AsyncSession, telegram_id: int, user_habit_id: int) -> tuple[int, int] | None:
+    """
+    Registra el check-in de hoy (fecha local del usuario) y actualiza las rachas de forma incremental:
+    si el último check-in fue ayer la racha actual suma uno, si no vuelve a empezar en 1.
+    Todo en una transacción: INSERT ... ON CONFLICT DO NOTHING (un check-in por día) y un UPDATE del hábito.
+    :return: (racha actual, mejor racha), o None si el hábito no es del usuario o ya se registró hoy.
+    """
+    local_today = sa.cast(sa.func.timezone(User.timezone, sa.func.now()), sa.Date)
+    try:
+        result = await db.execute(
+            pg_insert(HabitCheckin)
+            .from_select(
+                ["user_habit_id", "checkin_date"],
+                select(UserHabit.id, local_today)
+                .join(User, User.id == UserHabit.user_id)
+                .where(UserHabit.id == user_habit_id, User.telegram_id == telegram_id)
+            )
+            .on_conflict_do_nothing()
+            .returning(HabitCheckin.checkin_date)
+        )
+        checkin_date = result.scalar_one_or_none()
+        if checkin_date is None:
+            await db.rollback()
+            return None
+
+        continues = UserHabit.last_checkin_date == checkin_date - timedelta(days=1)
+        new_streak = sa.case((continues, UserHabit.current_streak + 1), else_=1)
+        result = await db.execute(
+            update(UserHabit)
+            .where(
+                UserHabit.id == user_habit_id,
+                sa.or_(UserHabit.last_checkin_date == None, UserHabit.last_checkin_date < checkin_date)
+            )
+            .values(
+                current_streak=new_streak,
+                best_streak=sa.func.greatest(UserHabit.best_streak, new_streak),
+                last_checkin_date=checkin_date
+            )
+            .returning(UserHabit.current_streak, UserHabit.best_streak)
+            .execution_options(synchronize_session=False)
+        )
+        row = result.first()
+        await db.commit()
+        return tuple(row) if row else None
+    except Exception as e:
+        await db.rollback()
+        db_logger.error(f"Error al registrar el check-in del hábito {user_habit_id} del usuario {telegram_id}: {e}", exc_info=True)
+        raise
+
+async def get_habit_streaks(db: AsyncSession, telegram_id: int) -> tuple[list[tuple[str, int, int, datetime | None]], str | None]:
+    """
+    Rachas de los hábitos del usuario, leídas de las columnas mantenidas en cada check-in (O(hábitos)).
+    :return: ([(descripción, racha actual guardada, mejor racha, fecha del último check-in)], zona horaria).
+    """
+    result = await db.execute(
+        select(DefaultHabit.description, UserHabit.current_streak, UserHabit.best_streak,
+               UserHabit.last_checkin_date, User.timezone)
+        .join(UserHabit, UserHabit.user_id == User.id)
+        .join(DefaultHabit, DefaultHabit.id == UserHabit.habit_id)
+        .where(User.telegram_id == telegram_id)
+        .order_by(DefaultHabit.id)
+    )
+    rows = result.all()
+    timezone_str = rows[0].timezone if rows else None
+    return [tuple(row[:4]) for row in rows], timezone_str
+
 async def add_user_habit(db: AsyncSession, user_id: int, habit_id: int) -> UserHabit | None:
     """Añade un hábito a la lista de un usuario."""
     db_logger.info(f"Añadiendo hábito {habit_id} al usuario {user_id}")
@@ -384,3 +1137,88 @@ async def add_user_habit(db: AsyncSession, user_id: int, habit_id: int) -> UserH
     return new_user_habit
 
 
+# Cola de órdenes para el proceso dispatcher
+
+async def enqueue_scheduler_commands(db: AsyncSession, action: str, task_ids: list[int]) -> None:
+    """
+    Registra órdenes de programación ('schedule') o cancelación ('unschedule') de tareas
+    para que las aplique el proceso dispatcher.
+    :param db: La sesión de la base de datos asíncrona.
+    :param action: 'schedule' o 'unschedule'.
+    :param task_ids: Los IDs de las tareas afectadas.
+    """
+    if not task_ids:
+        return
+    db_logger.debug(f"[DB] Encolando orden '{action}' para las tareas {task_ids}.")
+    try:
+        db.add_all([SchedulerCommand(action=action, task_id=task_id) for task_id in task_ids])
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        db_logger.error(f"Error al encolar la orden '{action}' para las tareas {task_ids}: {e}", exc_info=True)
+        raise
+
+async def claim_scheduler_commands(db: AsyncSession, limit: int = 100) -> list[tuple[int, str, int]]:
+    """
+    Toma (y elimina de la cola) hasta `limit` órdenes pendientes en orden de llegada.
+    Usa SKIP LOCKED para que varios dispatchers no procesen la misma orden.
+    :return: Lista de tuplas (id, action, task_id).
+    """
+    try:
+        pending_ids = (
+            select(SchedulerCommand.id)
+            .order_by(SchedulerCommand.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        result = await db.execute(
+            delete(SchedulerCommand)
+            .where(SchedulerCommand.id.in_(pending_ids))
+            .returning(SchedulerCommand.id, SchedulerCommand.action, SchedulerCommand.task_id)
+        )
+        commands = sorted(tuple(row) for row in result.all())
+        await db.commit()
+        if commands:
+            db_logger.debug(f"[DB] Tomadas {len(commands)} órdenes de la cola del scheduler.")
+        return commands
+    except Exception as e:
+        await db.rollback()
+        db_logger.error(f"Error al tomar órdenes de la cola del scheduler: {e}", exc_info=True)
+        raise
+
+async def load_persistence_rows(db: AsyncSession) -> list[tuple[str, str, bytes]]:
+    """Obtiene todo el estado persistido de la Application como tuplas (kind, key, data)."""
+    try:
+        result = await db.execute(select(BotPersistence.kind, BotPersistence.key, BotPersistence.data))
+        return [tuple(row) for row in result.all()]
+    except Exception as e:
+        db_logger.error(f"Error al cargar el estado persistido del bot: {e}", exc_info=True)
+        raise
+
+async def save_persistence_rows(db: AsyncSession, upserts: list[tuple[str, str, bytes]], deletes: list[tuple[str, str]]) -> None:
+    """
+    Guarda en una sola transacción un lote de cambios del estado persistido.
+    :param upserts: Filas (kind, key, data) a insertar o actualizar.
+    :param deletes: Claves (kind, key) a eliminar.
+    """
+    try:
+        if upserts:
+            stmt = pg_insert(BotPersistence).values(
+                [{"kind": kind, "key": key, "data": data} for kind, key, data in upserts]
+            )
+            await db.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[BotPersistence.kind, BotPersistence.key],
+                    set_={"data": stmt.excluded.data, "updated_at": sa.func.now()}
+                )
+            )
+        if deletes:
+            await db.execute(
+                delete(BotPersistence).where(sa.tuple_(BotPersistence.kind, BotPersistence.key).in_(deletes))
+            )
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        db_logger.error(f"Error al guardar el estado persistido del bot: {e}", exc_info=True)
+        raise
@@ -3,6 +3,7 @@
 import os
 import logging
 from contextlib import asynccontextmanager # ¡IMPORTAR ESTO!
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
@@ -38,6 +39,38 @@ AsyncSessionLocal = sessionmaker(
 
 Base = declarative_base() # Esta Base es la que deben usar todos tus modelos
 
+# Cambios de esquema sobre tablas ya existentes que create_all no aplica.
+# Deben ser idempotentes: se ejecutan en cada arranque después de create_all.
+SCHEMA_UPGRADES = [
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS habit_reminder_time TIME NOT NULL DEFAULT '09:00'",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS habit_reminder_minute SMALLINT",
+    "CREATE INDEX IF NOT EXISTS ix_users_habit_reminder_minute ON users (habit_reminder_minute)",
+    "CREATE INDEX IF NOT EXISTS ix_users_timezone ON users (timezone)",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS is_active BOOLEAN NOT NULL DEFAULT TRUE",
+    "CREATE INDEX IF NOT EXISTS ix_user_tasks_user_pending_due ON user_tasks (user_id, completed, due_date, id)",
+    # Búsqueda de texto completo en las tareas (/buscar): reemplaza al btree sobre description, que ninguna consulta usaba
+    "DROP INDEX IF EXISTS ix_user_tasks_description",
+    "ALTER TABLE user_tasks ADD COLUMN IF NOT EXISTS description_tsv tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('spanish', coalesce(description, ''))) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_user_tasks_description_tsv ON user_tasks USING GIN (description_tsv)",
+    # Archivado de tareas completadas (user_tasks_archive la crea create_all)
+    "ALTER TABLE user_tasks ADD COLUMN IF NOT EXISTS completed_at TIMESTAMPTZ",
+    "CREATE INDEX IF NOT EXISTS ix_user_tasks_completed_at ON user_tasks (completed_at) WHERE completed",
+    # Las completadas antes de existir completed_at toman su vencimiento (o el momento de la migración)
+    "UPDATE user_tasks SET completed_at = coalesce(due_date, now()) WHERE completed AND completed_at IS NULL",
+    # Rachas de hábitos (habit_checkins la crea create_all)
+    "ALTER TABLE user_habits ADD COLUMN IF NOT EXISTS current_streak INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE user_habits ADD COLUMN IF NOT EXISTS best_streak INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE user_habits ADD COLUMN IF NOT EXISTS last_checkin_date DATE",
+    # Estadísticas diarias (user_daily_stats y global_daily_stats las crea create_all).
+    # Las tareas existentes quedan sin created_at: no cuentan como creadas en ningún día.
+    "ALTER TABLE user_tasks ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ",
+    "ALTER TABLE user_tasks ALTER COLUMN created_at SET DEFAULT now()",
+    "CREATE INDEX IF NOT EXISTS ix_user_tasks_created_at ON user_tasks (created_at)",
+    "ALTER TABLE user_tasks_archive ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ",
+    "CREATE INDEX IF NOT EXISTS ix_user_tasks_archive_completed_at ON user_tasks_archive (completed_at)",
+]
+
 @asynccontextmanager # ¡AÑADIR ESTE DECORADOR!
 async def get_db():
     """
@@ -54,15 +87,24 @@ async def get_db():
             await session.close()
 
 
+# Evita repetir create_all y SCHEMA_UPGRADES si varios componentes inicializan la DB al arrancar
+_db_initialized = False
+
 async def init_db_async():
     """
     Inicializa la base de datos de forma asíncrona, creando todas las tablas
-    definidas en los modelos si no existen.
+    definidas en los modelos si no existen y aplicando SCHEMA_UPGRADES.
+    Solo tiene efecto la primera vez que se llama en el proceso.
     """
+    global _db_initialized
+    if _db_initialized:
+        return
     async with engine.begin() as conn:
         # Importación local para evitar circularidad si models.py también importara algo de db_context.
         # Asegúrate de que todos los modelos estén importados en algún lugar
         # antes de llamar a create_all si no es aquí.
         from .models import Base as ModelsBase # Usamos el alias para evitar conflicto con la 'Base' definida arriba
         await conn.run_sync(ModelsBase.metadata.create_all)
-
+        for statement in SCHEMA_UPGRADES:
+            await conn.execute(text(statement))
+    _db_initialized = True
@@ -1,10 +1,10 @@
 # src/database/models.py
 
 import sqlalchemy as sa
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, BigInteger
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, BigInteger, SmallInteger, Time, LargeBinary, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
-from datetime import datetime
+from datetime import datetime, time
 
 # Importar la Base desde db_context.py para asegurar que todos los modelos usan la Base correcta
 # Esta importación es crucial y debe ser la primera para evitar problemas de definición.
@@ -19,9 +19,17 @@ class User(Base):
     last_name = Column(String, nullable=True)
     
     # La zona horaria del usuario para mostrar y programar
-    timezone = Column(String, default="UTC", nullable=False) 
+    timezone = Column(String, default="UTC", nullable=False, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now()) 
 
+    # Hora local (en la zona horaria del usuario) del resumen diario de hábitos
+    habit_reminder_time = Column(Time, default=time(9, 0), server_default="09:00", nullable=False)
+    # Minuto del día en UTC (0-1439) en que toca enviar el resumen: índice de "bucket"
+    # para que cada tick del scheduler solo lea a los usuarios de ese minuto.
+    habit_reminder_minute = Column(SmallInteger, nullable=True, index=True)
+    # False cuando el usuario bloqueó el bot o el chat ya no existe: se excluye de los envíos
+    is_active = Column(Boolean, default=True, server_default=sa.true(), nullable=False)
+
     user_tasks = relationship("UserTask", back_populates="user")
     user_habits = relationship("UserHabit", back_populates="user")
 
@@ -49,6 +57,11 @@ class UserHabit(Base):
     id = Column(Integer, primary_key=True)
     user_id = Column(BigInteger, ForeignKey("users.id"))
     habit_id = Column(Integer, ForeignKey("default_habits.id"))
+    # Rachas mantenidas de forma incremental en cada check-in (ver record_habit_checkin):
+    # /streaks las lee directamente, sin recorrer el historial de habit_checkins.
+    current_streak = Column(Integer, default=0, server_default="0", nullable=False)
+    best_streak = Column(Integer, default=0, server_default="0", nullable=False)
+    last_checkin_date = Column(sa.Date, nullable=True) # Fecha local del usuario del último check-in
 
     user = relationship("User", back_populates="user_habits")
     default_habit = relationship("DefaultHabit", back_populates="user_habits")
@@ -56,6 +69,15 @@ class UserHabit(Base):
     def __repr__(self):
         return f"<UserHabit(id={self.id}, user_id={self.user_id}, habit_id={self.habit_id})>"
 
+class HabitCheckin(Base):
+    """Un check-in de un hábito en una fecha local del usuario (a lo sumo uno por día)."""
+    __tablename__ = "habit_checkins"
+    user_habit_id = Column(Integer, ForeignKey("user_habits.id", ondelete="CASCADE"), primary_key=True)
+    checkin_date = Column(sa.Date, primary_key=True)
+
+    def __repr__(self):
+        return f"<HabitCheckin(user_habit_id={self.user_habit_id}, checkin_date='{self.checkin_date}')>"
+
 class UserTask(Base):
     """
     Representa una tarea individual creada por un usuario.
@@ -63,15 +85,118 @@ class UserTask(Base):
     __tablename__ = "user_tasks"
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(BigInteger, ForeignKey('users.id'), nullable=False)
-    description = Column(String, index=True)
+    # La búsqueda usa la columna generada description_tsv (tsvector en español) con un índice GIN.
+    # Se crea en SCHEMA_UPGRADES (db_context.py) y no se mapea aquí para no cargarla en cada tarea.
+    description = Column(String)
     # Importante: Usa DateTime(timezone=True) si tu DB soporta y almacenas la TZ
     # Esto es ideal para fechas guardadas en UTC y luego convertidas.
     due_date = sa.Column(sa.DateTime(timezone=True), nullable=True) 
     completed = Column(Boolean, default=False)
     frequency = Column(String, nullable=True) # Ej: 'daily', 'weekly', 'monthly', 'yearly', 'once' o None
+    # Momento en que se completó: define cuándo la tarea pasa a user_tasks_archive
+    completed_at = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=True)
 
     user = relationship("User", back_populates="user_tasks")
 
+    # Listado paginado de tareas pendientes por (due_date, id) con keyset pagination
+    __table_args__ = (
+        Index("ix_user_tasks_user_pending_due", "user_id", "completed", "due_date", "id"),
+        # Selección de lotes a archivar: solo las completadas, por antigüedad
+        Index("ix_user_tasks_completed_at", "completed_at", postgresql_where=sa.text("completed")),
+        # Recalculo de las estadísticas diarias: tareas creadas en los últimos días
+        Index("ix_user_tasks_created_at", "created_at"),
+    )
+
     def __repr__(self):
         return f"<UserTask(id={self.id}, user_id={self.user_id}, description='{self.description}', due_date='{self.due_date}', frequency='{self.frequency}')>"
 
+
+class UserTaskArchive(Base):
+    """
+    Tareas completadas hace más de TASK_ARCHIVE_AFTER_DAYS, movidas fuera de user_tasks por el
+    job nocturno de archivado. Conservan su ID original y quedan disponibles para estadísticas.
+    """
+    __tablename__ = "user_tasks_archive"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, nullable=False)
+    description = Column(String)
+    due_date = Column(DateTime(timezone=True), nullable=True)
+    frequency = Column(String, nullable=True)
+    completed_at = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(DateTime(timezone=True), nullable=True)
+    archived_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_user_tasks_archive_user_completed", "user_id", "completed_at"),
+        Index("ix_user_tasks_archive_completed_at", "completed_at"),
+    )
+
+    def __repr__(self):
+        return f"<UserTaskArchive(id={self.id}, user_id={self.user_id}, completed_at='{self.completed_at}')>"
+
+
+class UserDailyStats(Base):
+    """
+    Resumen diario de actividad por usuario (fecha local del usuario). Lo recalcula el job
+    periódico de estadísticas a partir de user_tasks, user_tasks_archive y habit_checkins;
+    /stats lee solo estas filas (a lo sumo una por día).
+    """
+    __tablename__ = "user_daily_stats"
+    user_id = Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    stat_date = Column(sa.Date, primary_key=True)
+    tasks_created = Column(Integer, default=0, server_default="0", nullable=False)
+    tasks_completed = Column(Integer, default=0, server_default="0", nullable=False)
+    habits_done = Column(Integer, default=0, server_default="0", nullable=False)
+
+    __table_args__ = (
+        # Recalculo por rango de fechas y agregado global por día
+        Index("ix_user_daily_stats_stat_date", "stat_date"),
+    )
+
+    def __repr__(self):
+        return f"<UserDailyStats(user_id={self.user_id}, stat_date='{self.stat_date}')>"
+
+
+class GlobalDailyStats(Base):
+    """Totales diarios de todos los usuarios, agregados desde user_daily_stats para el resumen de operadores."""
+    __tablename__ = "global_daily_stats"
+    stat_date = Column(sa.Date, primary_key=True)
+    active_users = Column(Integer, default=0, server_default="0", nullable=False) # Usuarios con alguna actividad ese día
+    tasks_created = Column(Integer, default=0, server_default="0", nullable=False)
+    tasks_completed = Column(Integer, default=0, server_default="0", nullable=False)
+    habits_done = Column(Integer, default=0, server_default="0", nullable=False)
+
+    def __repr__(self):
+        return f"<GlobalDailyStats(stat_date='{self.stat_date}', active_users={self.active_users})>"
+
+
+class SchedulerCommand(Base):
+    """
+    Cola de órdenes para el proceso dispatcher.
+    Cuando el bot interactivo corre separado del scheduler, registra aquí las tareas
+    que hay que (re)programar o cancelar y el dispatcher las aplica en su propio proceso.
+    """
+    __tablename__ = "scheduler_commands"
+    id = Column(BigInteger, primary_key=True)
+    action = Column(String, nullable=False) # 'schedule' o 'unschedule'
+    task_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return f"<SchedulerCommand(id={self.id}, action='{self.action}', task_id={self.task_id})>"
+
+
+class BotPersistence(Base):
+    """
+    Estado persistido de la Application de Telegram (user_data y estados de conversación),
+    para no perder las conversaciones a medio terminar al reiniciar el bot.
+    """
+    __tablename__ = "bot_persistence"
+    kind = Column(String, primary_key=True) # 'user_data' o 'conversation:<nombre>'
+    key = Column(String, primary_key=True) # ID del usuario o clave de la conversación en JSON
+    data = Column(LargeBinary, nullable=False) # Valor serializado con pickle
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<BotPersistence(kind='{self.kind}', key='{self.key}')>"
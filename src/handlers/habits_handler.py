@@ -1,9 +1,14 @@
-from telegram.ext import ConversationHandler, CommandHandler, MessageHandler, filters
+from telegram.ext import ConversationHandler, CommandHandler, MessageHandler, CallbackQueryHandler, filters
 from src.utils.habits_api import (
     start_habits_conversation,
     add_habit, # Asegúrate de importar add_habit
-    cancel_habits_conversation
+    cancel_habits_conversation,
+    set_habit_time_command,
+    habit_checkin_callback,
+    habit_checkin_done_callback,
+    streaks_command
 )
+from src.utils.conversation_state import CONVERSATION_TIMEOUT, timeout_handlers
 
 # Definimos el mismo estado aquí para que coincida
 SELECTING_HABIT_ID = 1
@@ -17,8 +22,27 @@ def get_habits_conversation_handler():
             SELECTING_HABIT_ID: [MessageHandler(filters.Regex(r'^\d+$'), add_habit)],
             # También podrías usar `MessageHandler(filters.TEXT & ~filters.COMMAND, add_habit)`
             # pero `filters.Regex(r'^\d+$')` es mejor si solo esperas dígitos.
+            ConversationHandler.TIMEOUT: timeout_handlers(conversation="habits"),
         },
         fallbacks=[CommandHandler("cancel", cancel_habits_conversation)],
         # Esto es útil para depuración:
-        allow_reentry=True # Permite reentrar a la conversación si el usuario manda el entry_point de nuevo
-    )
\ No newline at end of file
+        allow_reentry=True, # Permite reentrar a la conversación si el usuario manda el entry_point de nuevo
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        name="habits",
+        persistent=True,
+    )
+
+def get_habit_time_handler():
+    """Devuelve el handler del comando /habit_time (hora local del resumen de hábitos)."""
+    return CommandHandler("habit_time", set_habit_time_command)
+
+def get_habit_checkin_handlers():
+    """Devuelve los handlers de los botones de check-in del resumen diario de hábitos."""
+    return [
+        CallbackQueryHandler(habit_checkin_callback, pattern=r'^hc:\d+$'),
+        CallbackQueryHandler(habit_checkin_done_callback, pattern=r'^hcd:\d+$'),
+    ]
+
+def get_streaks_handler():
+    """Devuelve el handler del comando /streaks (rachas de hábitos)."""
+    return CommandHandler("streaks", streaks_command)
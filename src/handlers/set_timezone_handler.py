@@ -6,12 +6,17 @@ from telegram.ext import (
     CommandHandler,
     ConversationHandler,
     CallbackQueryHandler,
+    MessageHandler,
+    filters,
 )
 import math
 
 # Importar las funciones de base de datos
 from src.database.database_interation import get_user_by_telegram_id, update_user_timezone
 from src.database.db_context import get_db
+from src.utils.conversation_state import CONVERSATION_TIMEOUT, timeout_handlers
+from src.utils.timezone_index import get_timezone_index
+from src.utils.agenda import invalidate_today_agenda
 
 logger = logging.getLogger(__name__)
 
@@ -19,7 +24,15 @@ logger = logging.getLogger(__name__)
 SELECT_CONTINENT, SELECT_COUNTRY, SELECT_TIMEZONE = range(3)
 COUNTRIES_PER_PAGE = 8 # Puedes ajustar cuántos países mostrar por página
 
-# --- Funciones auxiliares ---
+# --- Datos precalculados ---
+# Todo el selector se arma una sola vez al importar el módulo. Los callbacks llevan solo
+# ids numéricos cortos (muy por debajo del límite de 64 bytes de Telegram):
+#   tzc:<continente>            continente elegido
+#   tzp:<continente>:<página>   página de países
+#   tzk:<continente>:<país>     país elegido
+#   tzz:<zona>                  zona horaria elegida
+#   tzb                         volver a continentes
+#   tzn                         botón informativo (no hace nada)
 
 def get_timezones_data():
     """Crea una estructura de datos anidada de zonas horarias."""
@@ -37,92 +50,183 @@ def get_timezones_data():
 
 TIMEZONES_DATA = get_timezones_data()
 
-# --- Funciones de la Conversación ---
-
-async def start_set_timezone_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Inicia la conversación y muestra la lista de continentes."""
-    logger.info(f"Comando /set_timezone recibido de usuario: {update.effective_user.id}")
-    continents = sorted(TIMEZONES_DATA.keys())
-    keyboard = [[InlineKeyboardButton(c, callback_data=f"continent_{c}")] for c in continents]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Paso 1/3: Por favor, selecciona tu continente:", reply_markup=reply_markup)
-    return SELECT_CONTINENT
-
-async def handle_continent_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Muestra la primera página de países para el continente seleccionado."""
-    query = update.callback_query
-    await query.answer()
-    continent = query.data.split('_', 1)[1]
-    context.user_data['selected_continent'] = continent
-
-    country_list = sorted(TIMEZONES_DATA[continent].keys())
-    context.user_data['country_list'] = country_list
-
-    # Construir y enviar la primera página
-    await send_paginated_countries(query, context, page=0)
-    return SELECT_COUNTRY
-
-async def send_paginated_countries(query, context: ContextTypes.DEFAULT_TYPE, page: int):
-    """Función reutilizable para enviar una página de países."""
-    continent = context.user_data['selected_continent']
-    country_list = context.user_data['country_list']
+# continente id -> nombre
+CONTINENTS = tuple(sorted(TIMEZONES_DATA))
+# continente id -> tupla de (nombre del país, tupla de ids de zona)
+COUNTRIES = []
+# zona id -> nombre IANA, y su inversa
+ZONES = []
+ZONE_IDS = {}
+for _continent in CONTINENTS:
+    _countries = []
+    for _country in sorted(TIMEZONES_DATA[_continent]):
+        _zone_ids = []
+        for _tz in sorted(TIMEZONES_DATA[_continent][_country]):
+            if _tz not in ZONE_IDS:
+                ZONE_IDS[_tz] = len(ZONES)
+                ZONES.append(_tz)
+            _zone_ids.append(ZONE_IDS[_tz])
+        _countries.append((_country, tuple(_zone_ids)))
+    COUNTRIES.append(tuple(_countries))
+COUNTRIES = tuple(COUNTRIES)
+ZONES = tuple(ZONES)
+
+CONTINENT_TEXT = (
+    "Escribe tu ciudad o zona horaria (ej. \"Madrid\" o \"Buenos Aires\") o comparte tu ubicación 📎.\n"
+    "O elige paso a paso. Paso 1/3: Por favor, selecciona tu continente:"
+)
+CONTINENT_KEYBOARD = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(name, callback_data=f"tzc:{ci}")] for ci, name in enumerate(CONTINENTS)]
+)
 
+def _build_country_page(ci: int, page: int) -> InlineKeyboardMarkup:
+    countries = COUNTRIES[ci]
     start_index = page * COUNTRIES_PER_PAGE
     end_index = start_index + COUNTRIES_PER_PAGE
-
-    keyboard = []
-    for country in country_list[start_index:end_index]:
-        keyboard.append([InlineKeyboardButton(country, callback_data=f"country_{country}")])
+    keyboard = [
+        [InlineKeyboardButton(name, callback_data=f"tzk:{ci}:{ki}")]
+        for ki, (name, _) in enumerate(countries[start_index:end_index], start=start_index)
+    ]
 
     # --- Lógica de botones de paginación ---
-    total_pages = math.ceil(len(country_list) / COUNTRIES_PER_PAGE)
+    total_pages = math.ceil(len(countries) / COUNTRIES_PER_PAGE)
     pagination_buttons = []
     if page > 0:
-        pagination_buttons.append(InlineKeyboardButton("◀️ Anterior", callback_data=f"page_country_{page - 1}"))
+        pagination_buttons.append(InlineKeyboardButton("◀️ Anterior", callback_data=f"tzp:{ci}:{page - 1}"))
+    pagination_buttons.append(InlineKeyboardButton(f"Pág {page + 1}/{total_pages}", callback_data="tzn"))
+    if end_index < len(countries):
+        pagination_buttons.append(InlineKeyboardButton("Siguiente ▶️", callback_data=f"tzp:{ci}:{page + 1}"))
+    keyboard.append(pagination_buttons)
+
+    keyboard.append([InlineKeyboardButton("⬅️ Volver a Continentes", callback_data="tzb")])
+    return InlineKeyboardMarkup(keyboard)
+
+def _build_zone_keyboard(ci: int, ki: int) -> InlineKeyboardMarkup:
+    _, zone_ids = COUNTRIES[ci][ki]
+    keyboard = [
+        [InlineKeyboardButton(ZONES[zid].split('/', 1)[1].replace('_', ' '), callback_data=f"tzz:{zid}")]
+        for zid in zone_ids
+    ]
+    # Vuelve a la página de países donde estaba el país elegido
+    keyboard.append([InlineKeyboardButton("⬅️ Volver a Países", callback_data=f"tzp:{ci}:{ki // COUNTRIES_PER_PAGE}")])
+    return InlineKeyboardMarkup(keyboard)
+
+# (continente, página) -> teclado, y (continente, país) -> teclado
+COUNTRY_PAGE_KEYBOARDS = {
+    (ci, page): _build_country_page(ci, page)
+    for ci in range(len(CONTINENTS))
+    for page in range(math.ceil(len(COUNTRIES[ci]) / COUNTRIES_PER_PAGE))
+}
+ZONE_KEYBOARDS = {
+    (ci, ki): _build_zone_keyboard(ci, ki)
+    for ci in range(len(CONTINENTS))
+    for ki in range(len(COUNTRIES[ci]))
+}
+
+def _callback_ids(data: str) -> tuple[int, ...]:
+    """Extrae los ids numéricos de un callback (ej. 'tzk:3:12' -> (3, 12))."""
+    return tuple(int(part) for part in data.split(':')[1:])
 
-    pagination_buttons.append(InlineKeyboardButton(f"Pág {page + 1}/{total_pages}", callback_data="noop")) # Botón que no hace nada
+# --- Funciones de la Conversación ---
 
-    if end_index < len(country_list):
-        pagination_buttons.append(InlineKeyboardButton("Siguiente ▶️", callback_data=f"page_country_{page + 1}"))
+async def start_set_timezone_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Inicia la conversación y muestra la lista de continentes."""
+    logger.info(f"Comando /set_timezone recibido de usuario: {update.effective_user.id}")
+    if context.args:
+        # /set_timezone Madrid: se resuelve en el mismo mensaje
+        return await _resolve_timezone_text(update, " ".join(context.args))
+    await update.message.reply_text(CONTINENT_TEXT, reply_markup=CONTINENT_KEYBOARD)
+    return SELECT_CONTINENT
 
-    if pagination_buttons: keyboard.append(pagination_buttons)
+async def _save_timezone(user_telegram_id: int, timezone_str: str) -> str:
+    """Guarda la zona horaria del usuario y devuelve el mensaje de resultado."""
+    try:
+        async with get_db() as db:
+            user = await get_user_by_telegram_id(db, user_telegram_id)
+            if not user:
+                return "Error: No estás registrado. Usa /start primero."
+            success = await update_user_timezone(db, user.id, timezone_str)
+    except Exception as e:
+        logger.error(f"Error al guardar la zona horaria para {user_telegram_id}: {e}", exc_info=True)
+        return "Ocurrió un error al guardar tu zona horaria."
+    if success:
+        # La agenda de hoy cacheada se calculó con la zona anterior
+        invalidate_today_agenda(user_telegram_id)
+        return f"✅ ¡Listo! Tu zona horaria ha sido establecida a `{timezone_str}`."
+    return "⚠️ Hubo un problema al guardar tu zona horaria."
+
+async def _resolve_timezone_text(update: Update, text: str) -> int:
+    """
+    Resuelve una ciudad, país o fragmento de zona con el índice en memoria.
+    Una única coincidencia exacta se guarda directamente; si hay varias se ofrecen como botones.
+    """
+    zones, exact = get_timezone_index().search(text)
+    zones = [zone for zone in zones if zone in ZONE_IDS]
+    if exact and len(zones) == 1:
+        await update.message.reply_text(await _save_timezone(update.effective_user.id, zones[0]))
+        return ConversationHandler.END
+    if not zones:
+        await update.message.reply_text(
+            f"No encontré una zona horaria para '{text[:60]}'. Prueba con otra ciudad, comparte tu ubicación "
+            "o elige tu continente:",
+            reply_markup=CONTINENT_KEYBOARD
+        )
+        return SELECT_CONTINENT
+    keyboard = [[InlineKeyboardButton(zone.replace('_', ' '), callback_data=f"tzz:{ZONE_IDS[zone]}")] for zone in zones]
+    keyboard.append([InlineKeyboardButton("⬅️ Elegir por continente", callback_data="tzb")])
+    await update.message.reply_text("¿Cuál es tu zona horaria?", reply_markup=InlineKeyboardMarkup(keyboard))
+    return SELECT_TIMEZONE
 
-    keyboard.append([InlineKeyboardButton("⬅️ Volver a Continentes", callback_data="back_to_continents")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+async def handle_timezone_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Resuelve la zona horaria a partir de texto libre (ciudad, país o nombre de zona)."""
+    return await _resolve_timezone_text(update, update.message.text.strip())
+
+async def handle_timezone_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Resuelve la zona horaria a partir de una ubicación compartida (zona más cercana, sin servicios externos)."""
+    location = update.message.location
+    timezone_str = get_timezone_index().nearest_zone(location.latitude, location.longitude)
+    if timezone_str is None:
+        await update.message.reply_text("No pude determinar tu zona horaria. Por favor, elige tu continente:", reply_markup=CONTINENT_KEYBOARD)
+        return SELECT_CONTINENT
+    await update.message.reply_text(await _save_timezone(update.effective_user.id, timezone_str))
+    return ConversationHandler.END
 
+async def _show_country_page(query, ci: int, page: int) -> int:
+    reply_markup = COUNTRY_PAGE_KEYBOARDS.get((ci, page))
+    if reply_markup is None:
+        await query.edit_message_text("La selección no es válida. Usa /set_timezone para volver a empezar.")
+        return ConversationHandler.END
     await query.edit_message_text(
-        text=f"Paso 2/3: Has seleccionado '{continent}'. Ahora, selecciona tu país:",
+        text=f"Paso 2/3: Has seleccionado '{CONTINENTS[ci]}'. Ahora, selecciona tu país:",
         reply_markup=reply_markup
     )
+    return SELECT_COUNTRY
 
-async def handle_country_pagination(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Maneja los clics en los botones de paginación de países."""
+async def handle_continent_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Muestra la primera página de países para el continente seleccionado."""
     query = update.callback_query
     await query.answer()
+    (ci,) = _callback_ids(query.data)
+    return await _show_country_page(query, ci, 0)
 
-    page = int(query.data.split('_')[-1])
-    await send_paginated_countries(query, context, page=page)
-
-    return SELECT_COUNTRY
-
+async def handle_country_pagination(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Maneja los clics en los botones de paginación de países (y la vuelta desde las zonas)."""
+    query = update.callback_query
+    await query.answer()
+    ci, page = _callback_ids(query.data)
+    return await _show_country_page(query, ci, page)
 
 async def handle_country_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Maneja la selección del país y muestra las zonas horarias disponibles."""
     query = update.callback_query
     await query.answer()
-    country = query.data.split('_', 1)[1]
-    continent = context.user_data['selected_continent']
-    timezones = sorted(TIMEZONES_DATA[continent][country])
-
-    keyboard = []
-    for tz in timezones:
-        city_region = tz.split('/', 1)[1].replace('_', ' ')
-        keyboard.append([InlineKeyboardButton(city_region, callback_data=f"tz_{tz}")])
-
-    keyboard.append([InlineKeyboardButton("⬅️ Volver a Países", callback_data=f"back_to_countries_{continent}")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    ci, ki = _callback_ids(query.data)
+    reply_markup = ZONE_KEYBOARDS.get((ci, ki))
+    if reply_markup is None:
+        await query.edit_message_text("La selección no es válida. Usa /set_timezone para volver a empezar.")
+        return ConversationHandler.END
     await query.edit_message_text(
-        text=f"Paso 3/3: Has seleccionado '{country}'. Ahora, selecciona tu zona horaria:",
+        text=f"Paso 3/3: Has seleccionado '{COUNTRIES[ci][ki][0]}'. Ahora, selecciona tu zona horaria:",
         reply_markup=reply_markup
     )
     return SELECT_TIMEZONE
@@ -131,66 +235,62 @@ async def handle_timezone_selection(update: Update, context: ContextTypes.DEFAUL
     """Maneja la selección final y guarda la zona horaria."""
     query = update.callback_query
     await query.answer()
-    timezone_str = query.data.split('_', 1)[1]
-    user_telegram_id = query.from_user.id
-    try:
-        async with get_db() as db:
-            user = await get_user_by_telegram_id(db, user_telegram_id)
-            if not user:
-                await query.edit_message_text("Error: No estás registrado. Usa /start primero.")
-                return ConversationHandler.END
-            success = await update_user_timezone(db, user.id, timezone_str)
-            if success:
-                await query.edit_message_text(f"✅ ¡Listo! Tu zona horaria ha sido establecida a `{timezone_str}`.")
-            else:
-                await query.edit_message_text("⚠️ Hubo un problema al guardar tu zona horaria.")
-    except Exception as e:
-        logger.error(f"Error al guardar la zona horaria para {user_telegram_id}: {e}", exc_info=True)
-        await query.edit_message_text("Ocurrió un error al guardar tu zona horaria.")
-    context.user_data.clear()
+    (zid,) = _callback_ids(query.data)
+    if not 0 <= zid < len(ZONES):
+        await query.edit_message_text("La selección no es válida. Usa /set_timezone para volver a empezar.")
+        return ConversationHandler.END
+    timezone_str = ZONES[zid]
+    await query.edit_message_text(await _save_timezone(query.from_user.id, timezone_str))
     return ConversationHandler.END
 
 async def handle_back_to_continents(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Regresa a la selección de continentes."""
     query = update.callback_query
     await query.answer()
-    continents = sorted(TIMEZONES_DATA.keys())
-    keyboard = [[InlineKeyboardButton(c, callback_data=f"continent_{c}")] for c in continents]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Paso 1/3: Por favor, selecciona tu continente:", reply_markup=reply_markup)
+    await query.edit_message_text(CONTINENT_TEXT, reply_markup=CONTINENT_KEYBOARD)
     return SELECT_CONTINENT
 
-async def handle_back_to_countries(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Regresa a la selección de países (a la primera página)."""
-    query = update.callback_query
-    await query.answer()
-    # Volvemos a mostrar la primera página de países del continente guardado
-    await send_paginated_countries(query, context, page=0)
-    return SELECT_COUNTRY
+async def handle_noop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Responde al botón informativo de la página actual."""
+    await update.callback_query.answer()
 
 async def cancel_set_timezone_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancela la conversación."""
     await update.message.reply_text("Configuración de zona horaria cancelada.")
-    context.user_data.clear()
     return ConversationHandler.END
 
 def get_set_timezone_conversation_handler():
     """Crea y devuelve el ConversationHandler con paginación."""
+    noop_handler = CallbackQueryHandler(handle_noop, pattern=r"^tzn$")
+    # En cualquier paso se puede escribir una ciudad o compartir la ubicación
+    free_input_handlers = [
+        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_timezone_text),
+        MessageHandler(filters.LOCATION, handle_timezone_location),
+    ]
     return ConversationHandler(
         entry_points=[CommandHandler("set_timezone", start_set_timezone_conversation)],
         states={
             SELECT_CONTINENT: [
-                CallbackQueryHandler(handle_continent_selection, pattern="^continent_"),
+                CallbackQueryHandler(handle_continent_selection, pattern=r"^tzc:\d+$"),
+                *free_input_handlers,
             ],
             SELECT_COUNTRY: [
-                CallbackQueryHandler(handle_country_pagination, pattern="^page_country_"),
-                CallbackQueryHandler(handle_country_selection, pattern="^country_"),
-                CallbackQueryHandler(handle_back_to_continents, pattern="^back_to_continents$"),
+                CallbackQueryHandler(handle_country_pagination, pattern=r"^tzp:\d+:\d+$"),
+                CallbackQueryHandler(handle_country_selection, pattern=r"^tzk:\d+:\d+$"),
+                CallbackQueryHandler(handle_back_to_continents, pattern=r"^tzb$"),
+                noop_handler,
+                *free_input_handlers,
             ],
             SELECT_TIMEZONE: [
-                CallbackQueryHandler(handle_timezone_selection, pattern="^tz_"),
-                CallbackQueryHandler(handle_back_to_countries, pattern="^back_to_countries_"),
+                CallbackQueryHandler(handle_timezone_selection, pattern=r"^tzz:\d+$"),
+                CallbackQueryHandler(handle_country_pagination, pattern=r"^tzp:\d+:\d+$"),
+                CallbackQueryHandler(handle_back_to_continents, pattern=r"^tzb$"),
+                *free_input_handlers,
             ],
+            ConversationHandler.TIMEOUT: timeout_handlers(conversation="set_timezone"),
         },
         fallbacks=[CommandHandler("cancelar", cancel_set_timezone_conversation)],
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        name="set_timezone",
+        persistent=True,
     )
@@ -0,0 +1,10 @@
+from telegram.ext import CommandHandler
+from src.utils.stats_api import stats_command, admin_stats_command
+
+def get_stats_handler():
+    """Devuelve el handler del comando /stats (estadísticas del usuario)."""
+    return CommandHandler("stats", stats_command)
+
+def get_admin_stats_handler():
+    """Devuelve el handler del comando /admin_stats (resumen global para operadores)."""
+    return CommandHandler("admin_stats", admin_stats_command)
@@ -1,11 +1,15 @@
-from telegram.ext import ConversationHandler, CommandHandler, MessageHandler, filters
+from telegram.ext import ConversationHandler, CommandHandler, MessageHandler, CallbackQueryHandler, filters
 
 # Importa las funciones lógicas desde utils/weather_api.py
 from src.utils.weather_api import (
+    WEATHER_CITY_INPUT,
+    WEATHER_CITY_SELECT,
     start_weather_conversation,
     get_weather,
+    select_weather_city,
     cancel_weather_conversation
 )
+from src.utils.conversation_state import CONVERSATION_TIMEOUT, timeout_handlers
 
 def get_weather_conversation_handler():
     """
@@ -14,7 +18,16 @@ def get_weather_conversation_handler():
     return ConversationHandler(
         entry_points=[CommandHandler("clima", start_weather_conversation)],
         states={
-            0: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_weather)],
+            WEATHER_CITY_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_weather)],
+            WEATHER_CITY_SELECT: [
+                CallbackQueryHandler(select_weather_city, pattern=r"^wcity_"),
+                # Escribir otra ciudad en lugar de elegir una sugerencia inicia una nueva búsqueda
+                MessageHandler(filters.TEXT & ~filters.COMMAND, get_weather),
+            ],
+            ConversationHandler.TIMEOUT: timeout_handlers('weather_query', conversation="weather"),
         },
         fallbacks=[CommandHandler("cancelar", cancel_weather_conversation)],
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        name="weather",
+        persistent=True,
     )
\ No newline at end of file
@@ -0,0 +1,181 @@
+import os
+import calendar
+import logging
+from datetime import date, datetime, timedelta
+from typing import NamedTuple
+from zoneinfo import ZoneInfo
+
+from src.database.database_interation import TaskRow
+from src.utils.cache import AsyncTTLCache
+
+# Configuración del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Días máximos de una ventana de /agenda (acota la expansión de tareas recurrentes)
+AGENDA_MAX_DAYS = 62
+# Tope de caracteres de un mensaje de Telegram
+AGENDA_MESSAGE_LIMIT = 4096
+AGENDA_DESCRIPTION_MAX = 120
+
+# Caché de la agenda de /hoy por usuario: vence a la medianoche local del usuario.
+# AGENDA_CACHE_MAX_TTL (segundos) la acota además; 0 = solo hasta la medianoche.
+AGENDA_CACHE_MAX_TTL = float(os.getenv("AGENDA_CACHE_MAX_TTL", "0"))
+AGENDA_CACHE_MAX_ENTRIES = int(os.getenv("AGENDA_CACHE_MAX_ENTRIES", "10000"))
+# Con BOT_MODE=bot los recordatorios (que completan las tareas únicas) corren en el dispatcher,
+# que no puede invalidar esta caché: la agenda cacheada vence cuando toca el próximo de ellos.
+REMINDERS_RUN_REMOTELY = os.getenv("BOT_MODE", "all").strip().lower() == "bot"
+# Segundos de vigencia, en ese modo, de una agenda con tareas únicas vencidas cuyo recordatorio aún puede llegar
+AGENDA_CACHE_OVERDUE_TTL = float(os.getenv("AGENDA_CACHE_OVERDUE_TTL", "60"))
+# Igual al misfire_grace_time de los recordatorios: pasado ese plazo ya no se envían (ni completan la tarea)
+_REMINDER_GRACE = timedelta(hours=1)
+
+_WEEKDAY_NAMES = ("Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo")
+
+
+class AgendaItem(NamedTuple):
+    """Una ocurrencia de una tarea dentro de la ventana, en la hora local del usuario."""
+    when: datetime
+    task: TaskRow
+
+
+class RenderedAgenda(NamedTuple):
+    """Agenda ya renderizada con sus ocurrencias. `expires_at` es el fin de la ventana (None: no cachear)."""
+    text: str
+    items: list[AgendaItem]
+    expires_at: datetime | None
+
+
+def _remote_change_at(agenda: RenderedAgenda, now: datetime) -> datetime | None:
+    """
+    Primer instante en que el dispatcher puede completar una tarea única de la agenda al enviar su
+    recordatorio: la próxima por vencer, o en AGENDA_CACHE_OVERDUE_TTL si hay alguna vencida hace
+    menos de _REMINDER_GRACE (su recordatorio puede estar atrasado). None si no hay ninguna.
+    """
+    for item in agenda.items:
+        if item.task.frequency and item.task.frequency != "una vez":
+            continue
+        if item.when > now:
+            return item.when
+        if item.when > now - _REMINDER_GRACE:
+            return now + timedelta(seconds=AGENDA_CACHE_OVERDUE_TTL)
+    return None
+
+
+def _seconds_until_expiry(agenda: RenderedAgenda) -> float:
+    """
+    Vigencia en la caché: hasta el fin de la ventana (medianoche local), acotada por AGENDA_CACHE_MAX_TTL.
+    Con BOT_MODE=bot, además, hasta el próximo recordatorio que puede completar una de sus tareas.
+    """
+    if agenda.expires_at is None:
+        return 0.0
+    now = datetime.now(agenda.expires_at.tzinfo)
+    expires_at = agenda.expires_at
+    if REMINDERS_RUN_REMOTELY:
+        expires_at = min(expires_at, _remote_change_at(agenda, now) or expires_at)
+    seconds = (expires_at - now).total_seconds()
+    if AGENDA_CACHE_MAX_TTL > 0:
+        seconds = min(seconds, AGENDA_CACHE_MAX_TTL)
+    return max(0.0, seconds)
+
+
+# telegram_id -> RenderedAgenda de hoy. Las vistas repetidas no tocan la DB; cualquier
+# alta, completado o borrado de tareas y el cambio de zona horaria la invalidan.
+today_agenda_cache = AsyncTTLCache("today_agenda", ttl=_seconds_until_expiry, max_entries=AGENDA_CACHE_MAX_ENTRIES)
+
+
+def invalidate_today_agenda(telegram_id: int):
+    """Descarta la agenda de hoy cacheada del usuario (llamar tras modificar sus tareas o su zona horaria)."""
+    today_agenda_cache.invalidate(telegram_id)
+
+
+def local_day_window(user_tz: ZoneInfo, first_day: date, days: int) -> tuple[datetime, datetime]:
+    """Ventana [00:00 de first_day, 00:00 de first_day + days) en la zona del usuario."""
+    start = datetime.combine(first_day, datetime.min.time(), tzinfo=user_tz)
+    end = datetime.combine(first_day + timedelta(days=days), datetime.min.time(), tzinfo=user_tz)
+    return start, end
+
+
+def _occurrences(base: datetime, frequency: str, start: datetime, end: datetime):
+    """
+    Ocurrencias de una tarea recurrente dentro de [start, end), calculadas sobre la hora local
+    (la misma hora de reloj aunque cambie el horario de verano). Se salta directamente cerca
+    del inicio de la ventana en lugar de recorrer desde la primera fecha de la tarea.
+    """
+    if frequency in ("diaria", "semanal"):
+        step_days = 1 if frequency == "diaria" else 7
+        k = max(0, (start.date() - base.date()).days // step_days - 1)
+        while True:
+            occurrence = datetime.combine(base.date() + timedelta(days=k * step_days), base.time())
+            if occurrence >= end:
+                return
+            if occurrence >= start:
+                yield occurrence
+            k += 1
+    elif frequency in ("mensual", "anual"):
+        step_months = 1 if frequency == "mensual" else 12
+        months_to_start = (start.year - base.year) * 12 + start.month - base.month
+        k = max(0, months_to_start // step_months - 1)
+        while True:
+            month_index = base.month - 1 + k * step_months
+            year, month = base.year + month_index // 12, month_index % 12 + 1
+            k += 1
+            if datetime(year, month, 1) >= end:
+                return
+            # Día inexistente en ese mes (ej. 31 de abril): como en el CronTrigger, no hay ocurrencia
+            if base.day > calendar.monthrange(year, month)[1]:
+                continue
+            occurrence = base.replace(year=year, month=month)
+            if occurrence >= end:
+                return
+            if occurrence >= start:
+                yield occurrence
+
+
+def expand_agenda(rows: list[TaskRow], user_tz: ZoneInfo, start: datetime, end: datetime) -> list[AgendaItem]:
+    """
+    Convierte las filas de get_agenda_rows en las ocurrencias de la ventana ordenadas por hora:
+    las tareas de una sola vez tal cual y las recurrentes expandidas en memoria.
+    """
+    items = []
+    for task in rows:
+        if task.due_date is None:
+            continue
+        due_date = task.due_date if task.due_date.tzinfo else task.due_date.replace(tzinfo=ZoneInfo('UTC'))
+        local_due = due_date.astimezone(user_tz)
+        if not task.frequency or task.frequency == "una vez":
+            if start <= local_due < end:
+                items.append(AgendaItem(local_due, task))
+            continue
+        # Hora de reloj local sin fijar el offset, para que el cambio de horario no la corra
+        base = local_due.replace(tzinfo=None)
+        for occurrence in _occurrences(base, task.frequency, start.replace(tzinfo=None), end.replace(tzinfo=None)):
+            items.append(AgendaItem(occurrence.replace(tzinfo=user_tz), task))
+    items.sort(key=lambda item: (item.when, item.task.id))
+    return items
+
+
+def render_agenda(title: str, items: list[AgendaItem]) -> str:
+    """Texto de la agenda agrupado por día, recortado al tope de un mensaje de Telegram."""
+    if not items:
+        return f"{title}\n\nNo tienes tareas pendientes en este período. 🎉"
+    lines = [f"{title}\n"]
+    current_day = None
+    used = len(lines[0])
+    for index, item in enumerate(items):
+        day = item.when.date()
+        block = ""
+        if day != current_day:
+            current_day = day
+            block += f"\n📅 {_WEEKDAY_NAMES[day.weekday()]} {day.strftime('%d/%m')}\n"
+        description = item.task.description
+        if len(description) > AGENDA_DESCRIPTION_MAX:
+            description = description[:AGENDA_DESCRIPTION_MAX - 1] + "…"
+        repeat = " 🔁" if item.task.frequency else ""
+        block += f"  {item.when.strftime('%H:%M')} · {description} (ID: {item.task.id}){repeat}\n"
+        remaining = len(items) - index
+        if used + len(block) > AGENDA_MESSAGE_LIMIT - 40:
+            lines.append(f"\n… y {remaining} más.")
+            break
+        lines.append(block)
+        used += len(block)
+    return "".join(lines)
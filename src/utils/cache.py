@@ -0,0 +1,131 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+from src.utils import metrics
+
+# Configuración del logger para este módulo
+logger = logging.getLogger(__name__)
+
+metrics.describe("cache_requests_total", "Consultas a cachés en memoria por resultado (hit, stale, miss, coalesced).")
+metrics.describe("cache_loads_total", "Cargas desde el origen hechas por cada caché, por resultado.")
+metrics.describe("cache_hit_ratio", "Proporción de consultas servidas desde la caché (incluye valores vencidos).")
+metrics.describe("cache_entries", "Entradas guardadas actualmente en cada caché.")
+
+
+class AsyncTTLCache:
+    """
+    Caché en memoria con vencimiento por entrada para cargas asíncronas.
+    - Un valor vigente se devuelve directamente (hit).
+    - Un valor vencido hace menos de `stale_ttl` segundos se devuelve igual y se
+      recarga en segundo plano (stale-while-revalidate).
+    - Las consultas simultáneas de una misma clave sin valor comparten una única carga.
+    Los errores de la carga no se guardan: se propagan a todos los que la esperaban.
+    """
+
+    def __init__(self, name: str, ttl: float, stale_ttl: float = 0.0, max_entries: int = 1024):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        # clave -> (valor, instante de vencimiento en time.monotonic)
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._hits = 0
+        self._lookups = 0
+
+    def _record(self, result: str):
+        self._lookups += 1
+        if result in ("hit", "stale"):
+            self._hits += 1
+        metrics.increment("cache_requests_total", {"cache": self.name, "result": result})
+        metrics.set_gauge("cache_hit_ratio", self._hits / self._lookups, {"cache": self.name})
+
+    def _expires_at(self, value: Any, ttl) -> float:
+        if ttl is None:
+            ttl = self.ttl
+        if callable(ttl):
+            ttl = ttl(value)
+        return time.monotonic() + max(0.0, ttl)
+
+    def set(self, key: Hashable, value: Any, ttl: float | Callable[[Any], float] = None):
+        """Guarda un valor. `ttl` puede ser un número de segundos o una función del valor."""
+        self._entries[key] = (value, self._expires_at(value, ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        metrics.set_gauge("cache_entries", len(self._entries), {"cache": self.name})
+
+    def invalidate(self, key: Hashable):
+        """Elimina una clave. Una carga en curso para esa clave no vuelve a guardarla."""
+        self._entries.pop(key, None)
+        task = self._inflight.pop(key, None)
+        if task is not None:
+            task.invalidated = True
+        metrics.set_gauge("cache_entries", len(self._entries), {"cache": self.name})
+
+    def clear(self):
+        for key in list(self._inflight):
+            self.invalidate(key)
+        self._entries.clear()
+        metrics.set_gauge("cache_entries", 0, {"cache": self.name})
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]], ttl) -> Any:
+        task = asyncio.current_task()
+        try:
+            value = await loader()
+        except Exception:
+            metrics.increment("cache_loads_total", {"cache": self.name, "result": "error"})
+            raise
+        finally:
+            if self._inflight.get(key) is task:
+                del self._inflight[key]
+        metrics.increment("cache_loads_total", {"cache": self.name, "result": "ok"})
+        if not getattr(task, "invalidated", False):
+            self.set(key, value, ttl)
+        return value
+
+    def _start_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]], ttl) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, loader, ttl))
+            # Evita el aviso de "excepción no recuperada" si nadie quedó esperando la carga
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[key] = task
+        return task
+
+    async def get_or_load(
+        self,
+        key: Hashable,
+        loader: Callable[[], Awaitable[Any]],
+        ttl: float | Callable[[Any], float] = None,
+    ) -> Any:
+        """
+        Devuelve el valor de `key`, cargándolo con `loader()` si no está o venció.
+        :param ttl: Segundos de vigencia (o función del valor cargado). Por defecto, el de la caché.
+        """
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if now < expires_at:
+                self._entries.move_to_end(key)
+                self._record("hit")
+                return value
+            if now < expires_at + self.stale_ttl:
+                self._record("stale")
+                if key not in self._inflight:
+                    task = self._start_load(key, loader, ttl)
+                    task.add_done_callback(self._log_refresh_error)
+                return value
+            del self._entries[key]
+
+        self._record("coalesced" if key in self._inflight else "miss")
+        # shield: si se cancela quien espera, la carga sigue para el resto
+        return await asyncio.shield(self._start_load(key, loader, ttl))
+
+    def _log_refresh_error(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Error al recargar en segundo plano la caché '{self.name}': {task.exception()}")
@@ -0,0 +1,60 @@
+import time
+import logging
+
+# Configuración del logger para este módulo
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Se lanza cuando el circuito está abierto y no se intenta la petición."""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker simple para un servicio externo.
+    Tras `failure_threshold` fallos seguidos se abre y rechaza peticiones durante
+    `reset_timeout` segundos; luego deja pasar una petición de prueba (semiabierto)
+    y se cierra si tiene éxito.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_request(self):
+        """Lanza CircuitOpenError si no se debe intentar la petición."""
+        state = self.state
+        if state == "open" or (state == "half_open" and self._probe_in_flight):
+            raise CircuitOpenError(f"Circuito '{self.name}' abierto.")
+        if state == "half_open":
+            self._probe_in_flight = True
+
+    def abort_request(self):
+        """Libera la petición de prueba si se canceló sin resultado."""
+        self._probe_in_flight = False
+
+    def record_success(self):
+        if self._opened_at is not None:
+            logger.info(f"Circuito '{self.name}' cerrado nuevamente.")
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self._failures += 1
+        self._probe_in_flight = False
+        if self._opened_at is not None or self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            logger.warning(f"Circuito '{self.name}' abierto por {self.reset_timeout:.0f}s tras {self._failures} fallos.")
@@ -0,0 +1,154 @@
+import os
+import re
+import csv
+import bisect
+import difflib
+import logging
+import unicodedata
+from functools import lru_cache
+from typing import NamedTuple
+
+# Configuración del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Índice de ciudades incluido con el bot (name,country,lat,lon,alt_names). Se armó a partir
+# de las ciudades de la base de zonas horarias (zone.tab) más capitales de provincia y
+# ciudades grandes de habla hispana. Para un índice más completo se puede apuntar
+# CITY_INDEX_PATH a un volcado de GeoNames (por ejemplo cities15000.txt).
+DEFAULT_CITY_INDEX_PATH = os.path.join(os.path.dirname(__file__), "..", "data", "cities.csv")
+CITY_INDEX_PATH = os.getenv("CITY_INDEX_PATH") or DEFAULT_CITY_INDEX_PATH
+
+# Similitud mínima (0-1) para sugerir una ciudad escrita con errores
+FUZZY_CUTOFF = 0.75
+
+
+def normalize_city(city: str) -> str:
+    """Normaliza el nombre de una ciudad: minúsculas, sin tildes ni espacios extra."""
+    decomposed = unicodedata.normalize("NFKD", city.casefold())
+    without_accents = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return re.sub(r"\s+", " ", without_accents).strip()
+
+
+class City(NamedTuple):
+    name: str
+    country: str
+    lat: float
+    lon: float
+    population: int = 0
+
+    @property
+    def label(self) -> str:
+        return f"{self.name}, {self.country}"
+
+
+def _read_bundled_csv(path: str):
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            alt_names = [name for name in (row.get("alt_names") or "").split("|") if name]
+            yield City(row["name"], row["country"], float(row["lat"]), float(row["lon"])), alt_names
+
+
+def _read_geonames(path: str):
+    """Lee un volcado de GeoNames (columnas separadas por tabulaciones, sin encabezado)."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            cols = line.rstrip("\n").split("\t")
+            if len(cols) < 15:
+                continue
+            alt_names = [name for name in cols[3].split(",") if name][:20]
+            city = City(cols[1], cols[8], float(cols[4]), float(cols[5]), int(cols[14] or 0))
+            yield city, [cols[2]] + alt_names
+
+
+class CityIndex:
+    """
+    Índice en memoria de ciudades para autocompletar y desambiguar.
+    Guarda los nombres normalizados (y sus alias) en una lista ordenada para buscar
+    por prefijo con bisect; los errores de tipeo se resuelven con difflib sobre los
+    nombres que empiezan con la misma letra.
+    """
+
+    def __init__(self, entries):
+        self.cities = []
+        keys = set()
+        for city, alt_names in entries:
+            idx = len(self.cities)
+            self.cities.append(city)
+            for name in [city.name, *alt_names]:
+                key = normalize_city(name)
+                if key:
+                    keys.add((key, idx))
+        self._keys = sorted(keys)
+        self._names = [key for key, _ in self._keys]
+        # Nombres distintos agrupados por primera letra, para la búsqueda aproximada
+        self._by_initial = {}
+        for name in dict.fromkeys(self._names):
+            self._by_initial.setdefault(name[0], []).append(name)
+
+    def __len__(self):
+        return len(self.cities)
+
+    def _indices_named(self, name: str) -> list[int]:
+        start = bisect.bisect_left(self._keys, (name, -1))
+        result = []
+        for found_name, idx in self._keys[start:]:
+            if found_name != name:
+                break
+            result.append(idx)
+        return result
+
+    def _indices_with_prefix(self, prefix: str) -> list[int]:
+        start = bisect.bisect_left(self._names, prefix)
+        result = []
+        for name, idx in self._keys[start:]:
+            if not name.startswith(prefix):
+                break
+            result.append(idx)
+        return result
+
+    def _rank(self, indices) -> list[int]:
+        """Quita duplicados y ordena por población (si el índice la tiene)."""
+        unique = list(dict.fromkeys(indices))
+        return sorted(unique, key=lambda idx: -self.cities[idx].population)
+
+    def search(self, query: str, limit: int = 5) -> tuple[list[int], bool]:
+        """
+        Busca ciudades por nombre.
+        :return: (índices de las ciudades, True si son coincidencias exactas del nombre).
+        """
+        key = normalize_city(query)
+        if not key:
+            return [], False
+        exact = self._indices_named(key)
+        if exact:
+            return self._rank(exact)[:limit], True
+
+        matches = self._rank(self._indices_with_prefix(key))
+        if len(matches) < limit:
+            candidates = self._by_initial.get(key[0], [])
+            for name in difflib.get_close_matches(key, candidates, n=limit, cutoff=FUZZY_CUTOFF):
+                matches.extend(self._rank(self._indices_named(name)))
+        return list(dict.fromkeys(matches))[:limit], False
+
+    def iter_names(self):
+        """Recorre todos los nombres indexados (normalizados, incluidos los alias) como (nombre, índice)."""
+        return iter(self._keys)
+
+    def get(self, idx: int) -> City | None:
+        if 0 <= idx < len(self.cities):
+            return self.cities[idx]
+        return None
+
+
+@lru_cache(maxsize=1)
+def get_city_index() -> CityIndex:
+    """Carga (una sola vez) el índice de ciudades configurado."""
+    path = CITY_INDEX_PATH
+    reader = _read_geonames if path.endswith(".txt") else _read_bundled_csv
+    try:
+        index = CityIndex(reader(path))
+    except OSError as e:
+        logger.error(f"No se pudo cargar el índice de ciudades '{path}': {e}. Se usará la búsqueda directa.")
+        return CityIndex([])
+    logger.info(f"Índice de ciudades cargado: {len(index)} ciudades desde '{path}'.")
+    return index
@@ -0,0 +1,103 @@
+import os
+import time
+import logging
+from collections import OrderedDict
+from typing import Any, Hashable
+
+from telegram import Update
+from telegram.ext import ContextTypes, TypeHandler
+
+# Configuración del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Segundos sin respuesta tras los que una conversación se da por abandonada
+CONVERSATION_TIMEOUT = float(os.getenv("CONVERSATION_TIMEOUT", "600"))
+# Máximo de conversaciones abiertas guardadas en un TTLStateStore
+CONVERSATION_STATE_MAX_ENTRIES = int(os.getenv("CONVERSATION_STATE_MAX_ENTRIES", "10000"))
+
+# Nombre de conversación persistente -> claves de user_data que se limpian al vencer.
+# Lo llena timeout_handlers(conversation=...) y lo usa la persistencia con las conversaciones restauradas.
+CONVERSATION_USER_DATA_KEYS: dict[str, tuple[str, ...]] = {}
+
+
+class TTLStateStore:
+    """
+    Estado de conversación por usuario con vencimiento y tamaño acotado.
+    Pensado para guardar ids y valores primitivos (no objetos ORM): cada entrada vence
+    `ttl` segundos después de su última escritura y, si se llega a `max_entries`,
+    se descarta la menos usada.
+    """
+
+    def __init__(self, ttl: float = CONVERSATION_TIMEOUT, max_entries: int = CONVERSATION_STATE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # clave -> (dict de estado, instante de vencimiento en time.monotonic)
+        self._entries = OrderedDict()
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        # Las entradas están ordenadas por última escritura: las vencidas quedan al principio
+        while self._entries:
+            key, (_, expires_at) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            del self._entries[key]
+
+    def get(self, key: Hashable) -> dict | None:
+        """Devuelve el estado de la clave, o None si no existe o venció."""
+        self._evict_expired()
+        entry = self._entries.get(key)
+        return entry[0] if entry else None
+
+    def update(self, key: Hashable, **values: Any) -> dict:
+        """Crea o actualiza el estado de la clave y renueva su vencimiento."""
+        self._evict_expired()
+        state = self._entries.pop(key, (None, 0))[0] or {}
+        state.update(values)
+        self._entries[key] = (state, time.monotonic() + self.ttl)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return state
+
+    def pop(self, key: Hashable) -> dict | None:
+        """Elimina y devuelve el estado de la clave."""
+        entry = self._entries.pop(key, None)
+        return entry[0] if entry else None
+
+    def __len__(self):
+        self._evict_expired()
+        return len(self._entries)
+
+
+def release_user_data(context: ContextTypes.DEFAULT_TYPE, user_id: int | None, *keys: str):
+    """
+    Quita de user_data las claves de una conversación y, si no queda nada,
+    libera el diccionario del usuario en la Application.
+    """
+    if user_id is None:
+        return
+    user_data = context.application.user_data.get(user_id)
+    if user_data is None:
+        return
+    for key in keys:
+        user_data.pop(key, None)
+    if not user_data:
+        context.application.drop_user_data(user_id)
+
+
+def timeout_handlers(*keys: str, conversation: str = None) -> list:
+    """
+    Handlers para el estado ConversationHandler.TIMEOUT: al vencer una conversación
+    abandonada limpian sus claves de user_data. Con `conversation` (el `name` de un
+    ConversationHandler persistente) las claves también se limpian cuando la conversación
+    vence tras un reinicio, donde PTB no vuelve a programar su timeout.
+    """
+    if conversation:
+        CONVERSATION_USER_DATA_KEYS[conversation] = keys
+
+    async def on_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id if isinstance(update, Update) and update.effective_user else None
+        logger.debug(f"Conversación vencida para el usuario {user_id}. Limpiando {keys or 'nada'}.")
+        release_user_data(context, user_id, *keys)
+
+    return [TypeHandler(Update, on_timeout)]
@@ -0,0 +1,312 @@
+import os
+import re
+import logging
+import unicodedata
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from typing import NamedTuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# Configuración del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Cantidad de textos de fecha ya interpretados que se recuerdan
+DATE_PARSER_CACHE_SIZE = int(os.getenv("DATE_PARSER_CACHE_SIZE", "4096"))
+
+# Respuestas que significan "sin fecha" / "sin hora"
+NO_DATE_WORDS = frozenset({"ninguna", "ninguno", "sin fecha", "sin hora", "no"})
+
+_WEEKDAYS = {
+    "lunes": 0, "martes": 1, "miercoles": 2, "jueves": 3, "viernes": 4, "sabado": 5, "domingo": 6,
+}
+_MONTHS = {
+    "enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6, "julio": 7,
+    "agosto": 8, "septiembre": 9, "setiembre": 9, "octubre": 10, "noviembre": 11, "diciembre": 12,
+}
+_UNIT_DAYS = {"dia": 1, "dias": 1, "semana": 7, "semanas": 7}
+
+# Hora: "18:00", "18.30", "18h", "6pm", "6:30 pm", "a las 9", "9 de la noche"
+_TIME_RE = re.compile(
+    r"(?:a\s+las?\s+)?(?P<h>\d{1,2})(?:[:.](?P<m>\d{2}))?\s*"
+    r"(?P<suffix>a\.?m\.?|p\.?m\.?|h|hs|de la manana|de la tarde|de la noche)?$"
+)
+# Fecha numérica: "25/12/2025", "25-12-25", "25/12"
+_NUMERIC_DATE_RE = re.compile(r"(?P<d>\d{1,2})[/-](?P<m>\d{1,2})(?:[/-](?P<y>\d{2}|\d{4}))?")
+# Fecha con mes en texto: "25 de diciembre", "25 de diciembre de 2025"
+_TEXT_DATE_RE = re.compile(r"(?P<d>\d{1,2})\s+(?:de\s+)?(?P<month>[a-z]+)(?:\s+(?:de\s+)?(?P<y>\d{4}))?")
+# Relativo en días o semanas: "en 3 dias", "dentro de 2 semanas"
+_RELATIVE_DAYS_RE = re.compile(r"(?:en|dentro de)\s+(?P<n>\d{1,3}|un|una)\s+(?P<unit>dias?|semanas?)")
+# Relativo en horas o minutos: depende del instante actual, no se guarda en caché
+_RELATIVE_TIME_RE = re.compile(r"^(?:en|dentro de)\s+(?P<n>\d{1,4}|un|una|media)\s+(?P<unit>horas?|minutos?|min)$")
+_WEEKDAY_RE = re.compile(
+    r"(?:el\s+|este\s+|proximo\s+|el proximo\s+)?(?P<day>" + "|".join(_WEEKDAYS) + r")(?:\s+que viene|\s+proximo)?"
+)
+# Pistas de que el texto menciona una hora (para el resultado del parser de respaldo)
+_TIME_HINT_RE = re.compile(r"\d{1,2}[:.]\d{2}|\d\s*(?:a\.?m\b|p\.?m\b|h\b|hs\b)|a las? \d|mediodia|medianoche")
+# Horas escritas en el texto, para comprobar la que devuelve el parser de respaldo
+_CLOCK_RE = re.compile(r"(?<!\d)(?P<h>\d{1,2})[:.](?P<m>\d{2})(?!\d)")
+_HOUR_RE = re.compile(r"(?<!\d)(?P<h>\d{1,2})\s*(?:a\.?m\b|p\.?m\b|h\b|hs\b)|a las? (?P<h2>\d{1,2})(?!\d)")
+# Palabras que hacen que el resultado dependa de la hora actual
+_NOW_DEPENDENT_RE = re.compile(r"\b(?:hora|horas|minuto|minutos|segundo|segundos|ahora)\b")
+# Rangos de fechas: "20/10 | 25/10", "lunes a viernes", "del 1 de nov al 15 de nov"
+_RANGE_SEPARATOR_RE = re.compile(r"\s*\|\s*|\s+(?:a|al|hasta)\s+")
+_RANGE_PREFIX_RE = re.compile(r"^(?:del|de|desde)\s+")
+
+
+class ParsedDueDate(NamedTuple):
+    """Fecha interpretada en la hora local del usuario. `time` es None si el texto no indicaba hora."""
+    date: date
+    time: time | None
+
+
+def normalize_date_text(text: str) -> str:
+    """Minúsculas, sin tildes, sin puntuación final ni espacios extra."""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    without_accents = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return re.sub(r"\s+", " ", without_accents).strip(" ,.;!¡¿?")
+
+
+def is_no_date(text: str) -> bool:
+    """True si el usuario indicó que la tarea no tiene fecha (u hora)."""
+    return normalize_date_text(text) in NO_DATE_WORDS
+
+
+def _user_tz(timezone_str: str | None) -> ZoneInfo:
+    try:
+        return ZoneInfo(timezone_str or "UTC")
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.warning(f"Zona horaria '{timezone_str}' no válida. Usando UTC para parsear la fecha.")
+        return ZoneInfo("UTC")
+
+
+def _count(word: str) -> int:
+    return 1 if word in ("un", "una") else int(word)
+
+
+def _parse_time_normalized(text: str) -> time | None:
+    """Interpreta una hora ya normalizada ("18:00", "6pm", "a las 9", "mediodia")."""
+    if text == "mediodia":
+        return time(12, 0)
+    if text == "medianoche":
+        return time(0, 0)
+    match = _TIME_RE.fullmatch(text)
+    if not match:
+        return None
+    hour, minute = int(match.group("h")), int(match.group("m") or 0)
+    # "p.m." llega como "p.m" porque normalize_date_text quita el punto final
+    suffix = (match.group("suffix") or "").replace(".", "")
+    if suffix in ("pm", "de la tarde", "de la noche") and hour < 12:
+        hour += 12
+    elif suffix in ("am", "de la manana", "de la noche") and hour == 12:
+        hour = 0 # "12 de la noche" es medianoche
+    if hour > 23 or minute > 59:
+        return None
+    return time(hour, minute)
+
+
+def _split_date_and_time(text: str) -> tuple[str, time | None]:
+    """
+    Separa la hora del final del texto ("manana a las 9" -> ("manana", 09:00)).
+    Si no hay una hora reconocible devuelve el texto entero y None.
+    """
+    words = text.split(" ")
+    # Se prueba primero el sufijo más largo: "a las 6 de la tarde" antes que "tarde"
+    for start in range(max(0, len(words) - 5), len(words)):
+        candidate = " ".join(words[start:])
+        parsed = _parse_time_normalized(candidate)
+        if parsed is None:
+            continue
+        rest = re.sub(r"\s*(?:,|\ba\b)$", "", " ".join(words[:start])).strip()
+        # Un número suelto ("15") es más probablemente un día del mes que una hora
+        if rest or not candidate.isdigit():
+            return rest, parsed
+    return text, None
+
+
+def _fast_parse_date(text: str, today: date) -> date | None:
+    """Formas frecuentes en español sin pasar por el parser genérico."""
+    if text in ("", "hoy"):
+        return today
+    if text == "manana":
+        return today + timedelta(days=1)
+    if text == "pasado manana":
+        return today + timedelta(days=2)
+
+    match = _RELATIVE_DAYS_RE.fullmatch(text)
+    if match:
+        return today + timedelta(days=_count(match.group("n")) * _UNIT_DAYS[match.group("unit")])
+
+    match = _WEEKDAY_RE.fullmatch(text)
+    if match:
+        # Siempre la próxima ocurrencia: "lunes" dicho un lunes es el lunes siguiente
+        days_ahead = (_WEEKDAYS[match.group("day")] - today.weekday() - 1) % 7 + 1
+        return today + timedelta(days=days_ahead)
+
+    match = _NUMERIC_DATE_RE.fullmatch(text)
+    if match:
+        return _build_date(int(match.group("d")), int(match.group("m")), match.group("y"), today)
+
+    match = _TEXT_DATE_RE.fullmatch(text)
+    if match and match.group("month") in _MONTHS:
+        return _build_date(int(match.group("d")), _MONTHS[match.group("month")], match.group("y"), today)
+    return None
+
+
+def _build_date(day: int, month: int, year: str | None, today: date) -> date | None:
+    """Arma la fecha; sin año se toma la próxima ocurrencia (este año o el siguiente)."""
+    try:
+        if year is None:
+            candidate = date(today.year, month, day)
+            return candidate if candidate >= today else date(today.year + 1, month, day)
+        full_year = int(year) + 2000 if len(year) == 2 else int(year)
+        return date(full_year, month, day)
+    except ValueError:
+        return None
+
+
+def _hinted_time_matches(text: str, parsed: time) -> bool:
+    """
+    True si la hora que devolvió el parser de respaldo es la que está escrita en el texto.
+    Con una hora inválida ("25:00") dateparser la descarta y deja la hora de RELATIVE_BASE.
+    """
+    if "mediodia" in text:
+        return parsed == time(12, 0)
+    if "medianoche" in text:
+        return parsed == time(0, 0)
+    clocks = [(int(m.group("h")), int(m.group("m"))) for m in _CLOCK_RE.finditer(text)]
+    if clocks:
+        return any(h <= 23 and m <= 59 and h % 12 == parsed.hour % 12 and m == parsed.minute for h, m in clocks)
+    hours = [int(m.group("h") or m.group("h2")) for m in _HOUR_RE.finditer(text)]
+    return any(h <= 23 and h % 12 == parsed.hour % 12 for h in hours)
+
+
+def _fallback_parse(text: str, now: datetime) -> ParsedDueDate | None:
+    """Parser genérico (dateparser) para lo que no cubren las formas rápidas. Se importa solo si hace falta."""
+    import dateparser # Import pesado (carga datos de idiomas): se difiere hasta el primer uso
+    parsed = dateparser.parse(
+        text,
+        languages=["es", "en"],
+        settings={
+            "PREFER_DATES_FROM": "future",
+            "RELATIVE_BASE": now.replace(tzinfo=None),
+            "DATE_ORDER": "DMY",
+            "RETURN_AS_TIMEZONE_AWARE": False,
+        },
+    )
+    if parsed is None:
+        return None
+    if not _TIME_HINT_RE.search(text):
+        return ParsedDueDate(parsed.date(), None)
+    parsed_time = parsed.time().replace(second=0, microsecond=0)
+    if not _hinted_time_matches(text, parsed_time):
+        logger.info(f"Hora no válida en '{text}': el parser de respaldo la ignoró. Se rechaza el texto.")
+        return None
+    return ParsedDueDate(parsed.date(), parsed_time)
+
+
+def _parse_uncached(text: str, now: datetime, fallback: bool = True) -> ParsedDueDate | None:
+    date_text, parsed_time = _split_date_and_time(text)
+    parsed_date = _fast_parse_date(date_text, now.date())
+    if parsed_date is not None:
+        return ParsedDueDate(parsed_date, parsed_time)
+    return _fallback_parse(text, now) if fallback else None
+
+
+@lru_cache(maxsize=DATE_PARSER_CACHE_SIZE)
+def _parse_cached(text: str, timezone_str: str, reference_date: date, fallback: bool = True) -> ParsedDueDate | None:
+    """
+    Resultado memoizado por (texto normalizado, zona horaria, fecha de referencia).
+    Solo se usa para textos cuyo resultado no depende de la hora actual, así que el
+    mediodía de la fecha de referencia sirve como "ahora" para el parser de respaldo.
+    """
+    now = datetime.combine(reference_date, time(12, 0), tzinfo=_user_tz(timezone_str))
+    return _parse_uncached(text, now, fallback)
+
+
+def parse_date_text(text: str, timezone_str: str | None, now: datetime = None, fallback: bool = True) -> ParsedDueDate | None:
+    """
+    Interpreta una fecha (opcionalmente con hora) escrita por el usuario, en su hora local.
+    Formas rápidas: "hoy", "mañana 9am", "pasado mañana", "en 3 días", "lunes", "el viernes a las 18",
+    "25/12/2025 18:00", "25 de diciembre". El resto pasa por dateparser (salvo con fallback=False).
+    :return: ParsedDueDate o None si no se entiende (o si es "ninguna"; ver is_no_date).
+    """
+    normalized = normalize_date_text(text)
+    if not normalized or normalized in NO_DATE_WORDS:
+        return None
+    user_tz = _user_tz(timezone_str)
+    now = now.astimezone(user_tz) if now else datetime.now(user_tz)
+
+    match = _RELATIVE_TIME_RE.fullmatch(normalized)
+    if match:
+        amount = 0.5 if match.group("n") == "media" else _count(match.group("n"))
+        unit_minutes = 60 if match.group("unit").startswith("hora") else 1
+        target = now + timedelta(minutes=amount * unit_minutes)
+        return ParsedDueDate(target.date(), target.time().replace(second=0, microsecond=0))
+    if _NOW_DEPENDENT_RE.search(normalized):
+        return _parse_uncached(normalized, now, fallback)
+    return _parse_cached(normalized, timezone_str or "UTC", now.date(), fallback)
+
+
+def _resolve_range(start_text: str, end_text: str, timezone_str: str | None, now: datetime,
+                   fallback: bool) -> tuple[date, date] | None:
+    """
+    Interpreta los extremos de un rango. El final se resuelve primero como siempre y, si queda
+    antes del inicio ("lunes a viernes" dicho un miércoles), como la próxima ocurrencia desde el inicio.
+    """
+    start = parse_date_text(start_text, timezone_str, now, fallback)
+    if start is None:
+        return None
+    end = parse_date_text(end_text, timezone_str, now, fallback)
+    if end is not None and end.date < start.date:
+        day_before_start = datetime.combine(start.date - timedelta(days=1), time(12, 0), tzinfo=_user_tz(timezone_str))
+        end = parse_date_text(end_text, timezone_str, day_before_start, fallback) or end
+    return (start.date, end.date) if end is not None else None
+
+
+def parse_date_range(text: str, timezone_str: str | None, now: datetime = None) -> tuple[date, date] | None:
+    """
+    Interpreta un período de fechas: "20/10 25/10", "lunes a viernes", "1 de nov | 15 de nov",
+    o una sola fecha ("pasado mañana", "el viernes"), que da un rango de un día.
+    Sin separador explícito, el texto se corta en dos solo si entero no es una fecha.
+    :return: (primer día, último día) o None si no se entiende. El último puede quedar antes del primero.
+    """
+    normalized = normalize_date_text(text)
+    parts = [part for part in _RANGE_SEPARATOR_RE.split(normalized) if part]
+    if not parts or len(parts) > 2:
+        return None
+    parts[0] = _RANGE_PREFIX_RE.sub("", parts[0])
+    if now is None:
+        now = datetime.now(_user_tz(timezone_str))
+
+    # Primero solo las formas rápidas, para que el parser de respaldo no se lleve un "20/10 25/10" entero
+    for fallback in (False, True):
+        if len(parts) == 2:
+            resolved = _resolve_range(parts[0], parts[1], timezone_str, now, fallback)
+            if resolved:
+                return resolved
+            continue
+        single = parse_date_text(parts[0], timezone_str, now, fallback)
+        if single is not None:
+            return single.date, single.date
+        words = parts[0].split(" ")
+        for cut in range(1, len(words)):
+            resolved = _resolve_range(" ".join(words[:cut]), " ".join(words[cut:]), timezone_str, now, fallback)
+            if resolved:
+                return resolved
+    return None
+
+
+def parse_time_text(text: str) -> time | None:
+    """Interpreta una hora suelta: "18:00", "18", "6pm", "18h", "a las 9", "mediodía"."""
+    return _parse_time_normalized(normalize_date_text(text))
+
+
+def to_aware_datetime(parsed: ParsedDueDate, timezone_str: str | None, default_time: time = time(0, 0)) -> datetime:
+    """Combina fecha y hora locales en un datetime con la zona horaria del usuario."""
+    return datetime.combine(parsed.date, parsed.time or default_time, tzinfo=_user_tz(timezone_str))
+
+
+def parse_due_datetime(text: str, timezone_str: str | None, now: datetime = None) -> datetime | None:
+    """Atajo: interpreta el texto y devuelve el datetime en la zona del usuario (00:00 si no hay hora)."""
+    parsed = parse_date_text(text, timezone_str, now)
+    return to_aware_datetime(parsed, timezone_str) if parsed else None
@@ -1,13 +1,34 @@
-from telegram import Update
+import os
+import asyncio
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
 import logging
-from src.database.database_interation import get_user_by_telegram_id, get_habits, add_user_habit, get_all_users, get_user_habits
+from src.database.database_interation import (
+    get_user_by_telegram_id, get_habits, add_user_habit,
+    set_habit_reminder_time, refresh_habit_reminder_buckets, get_habit_digest_rows,
+    get_user_timezones, timezone_utc_offset,
+    record_habit_checkin, get_habit_streaks
+)
 from src.database.db_context import get_db
+from src.utils.outbound import get_outbound_bot, send_message_safely, SEND_OK
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 SELECTING_HABIT_ID = 1
+# Largo máximo de la descripción en los botones de check-in
+CHECKIN_BUTTON_LABEL_MAX = 40
+# Minutos hacia atrás que el tick de resúmenes recupera si se saltó o atrasó alguna ejecución
+HABIT_DIGEST_MAX_CATCHUP_MINUTES = int(os.getenv("HABIT_DIGEST_MAX_CATCHUP_MINUTES", "30"))
+
+# Último minuto UTC (truncado) cuyo bucket ya se despachó en este proceso
+_last_digest_minute: datetime | None = None
+# Envíos de buckets en curso (referencias fuertes para que las tareas no se recolecten)
+_digest_sends: set[asyncio.Task] = set()
+# Offset UTC (minutos) de cada zona horaria con el que se recalcularon los buckets por última vez
+_bucket_zone_offsets: dict[str, int] = {}
 
 async def start_habits_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Inicia la conversación para añadir hábitos y lista los disponibles desde la BD."""
@@ -63,45 +84,209 @@ async def cancel_habits_conversation(update: Update, context: ContextTypes.DEFAU
     return ConversationHandler.END
 
 
-async def send_daily_habits(context: ContextTypes.DEFAULT_TYPE):
+async def set_habit_time_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    Envía un recordatorio diario con la lista de hábitos a cada usuario.
+    Maneja el comando /habit_time HH:MM. Guarda la hora local a la que el usuario
+    quiere recibir su resumen diario de hábitos.
     """
-    logger.info("Iniciando el envío de recordatorios de hábitos.")
-    async with get_db() as db:
-        # Obtener todos los usuarios registrados
-        users = await get_all_users(db)
+    telegram_user_id = update.effective_user.id
+    if not context.args:
+        await update.message.reply_text(
+            "Indica la hora a la que quieres recibir tu resumen diario de hábitos, en tu zona horaria.\n"
+            "Ejemplo: /habit_time 08:30"
+        )
+        return
+
+    time_str = context.args[0].strip()
+    try:
+        reminder_time = datetime.strptime(time_str, '%H:%M').time()
+    except ValueError:
+        await update.message.reply_text('Formato de hora inválido. Usa "HH:MM" (ej: "08:30").')
+        return
+
+    try:
+        async with get_db() as db:
+            user = await get_user_by_telegram_id(db, telegram_user_id)
+            if not user:
+                await update.message.reply_text("Error: No estás registrado. Por favor, usa /start primero.")
+                return
+            await set_habit_reminder_time(db, user.id, reminder_time)
+        await update.message.reply_text(
+            f"✅ Recibirás tu resumen de hábitos todos los días a las {reminder_time.strftime('%H:%M')} ({user.timezone})."
+        )
+        logger.info(f"Usuario {telegram_user_id} configuró su resumen de hábitos a las {reminder_time.strftime('%H:%M')}.")
+    except Exception as e:
+        logger.error(f"Error al configurar la hora de hábitos para el usuario {telegram_user_id}: {e}", exc_info=True)
+        await update.message.reply_text("Lo siento, hubo un error al guardar la hora de tu resumen de hábitos.")
 
-        for user in users:
-            # Para cada usuario, obtener sus hábitos personales
-            user_habits_records = await get_user_habits(db, user.id)
 
-            if not user_habits_records:
-                logger.info(f"Usuario {user.telegram_id} no tiene hábitos registrados. Saltando.")
-                continue
+def _button_label(description: str) -> str:
+    if len(description) > CHECKIN_BUTTON_LABEL_MAX:
+        return description[:CHECKIN_BUTTON_LABEL_MAX - 1] + "…"
+    return description
 
-            habits_descriptions = []
-            for user_habit in user_habits_records:
-                # Obtener la descripción de cada hábito
-                default_habits = await get_habits(db, user_habit.habit_id)
-                if default_habits:
-                    habits_descriptions.append(f"  - {default_habits[0].description}")
 
-            if habits_descriptions:
-                message_text = "🔔 Recordatorio Diario de Hábitos\n\nRecuerda practicar hoy:\n" + "\n".join(habits_descriptions)
-                try:
-                    await context.bot.send_message(
-                        chat_id=user.telegram_id,
-                        text=message_text,
-                        parse_mode='Markdown'
-                    )
-                    logger.info(f"Recordatorio de hábitos enviado a {user.telegram_id}.")
-                except Exception as e:
-                    logger.error(f"Error al enviar recordatorio de hábitos al usuario {user.telegram_id}: {e}")
+async def habit_checkin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Botón de check-in del resumen diario (callback 'hc:<id de user_habit>').
+    Registra el hábito como hecho hoy y marca el botón con la racha actual.
+    """
+    query = update.callback_query
+    telegram_user_id = update.effective_user.id
+    user_habit_id = int(query.data.split(":", 1)[1])
 
-    logger.info("Envío de recordatorios de hábitos finalizado.")
+    try:
+        async with get_db() as db:
+            streaks = await record_habit_checkin(db, telegram_user_id, user_habit_id)
+    except Exception as e:
+        logger.error(f"Error al registrar el check-in del hábito {user_habit_id} del usuario {telegram_user_id}: {e}", exc_info=True)
+        await query.answer("Hubo un error al registrar el hábito. Inténtalo de nuevo.", show_alert=True)
+        return
 
+    if streaks is None:
+        await query.answer("Ya registraste este hábito hoy (o ya no está en tu lista).")
+        return
+    current_streak, best_streak = streaks
+    await query.answer(f"🔥 ¡Racha de {current_streak} día(s)! Mejor racha: {best_streak}.")
+    logger.info(f"Check-in del hábito {user_habit_id} del usuario {telegram_user_id} (racha {current_streak}).")
+
+    # Se marca solo el botón pulsado; el resto del teclado queda igual
+    markup = query.message.reply_markup if query.message else None
+    if not markup:
+        return
+    keyboard = []
+    for row in markup.inline_keyboard:
+        keyboard.append([
+            InlineKeyboardButton(f"✔️ {button.text[2:]} ({current_streak}🔥)", callback_data=f"hcd:{user_habit_id}")
+            if button.callback_data == query.data else button
+            for button in row
+        ])
+    try:
+        await query.edit_message_reply_markup(InlineKeyboardMarkup(keyboard))
+    except Exception as e:
+        logger.warning(f"No se pudo actualizar el teclado del resumen de hábitos de {telegram_user_id}: {e}")
 
 
+async def habit_checkin_done_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Botón de un hábito ya registrado hoy: solo lo recuerda."""
+    await update.callback_query.answer("Este hábito ya está registrado hoy. ¡Sigue así!")
 
 
+async def streaks_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Maneja el comando /streaks: racha actual y mejor racha de cada hábito del usuario.
+    Lee las rachas ya mantenidas en cada check-in, sin recorrer el historial.
+    """
+    telegram_user_id = update.effective_user.id
+    try:
+        async with get_db() as db:
+            streaks, timezone_str = await get_habit_streaks(db, telegram_user_id)
+    except Exception as e:
+        logger.error(f"Error al obtener las rachas del usuario {telegram_user_id}: {e}", exc_info=True)
+        await update.message.reply_text("Lo siento, hubo un error al obtener tus rachas.")
+        return
+
+    if not streaks:
+        await update.message.reply_text("Todavía no tienes hábitos. Usa /habits para añadir alguno.")
+        return
+
+    try:
+        user_tz = ZoneInfo(timezone_str or 'UTC')
+    except (ZoneInfoNotFoundError, ValueError):
+        user_tz = ZoneInfo('UTC')
+    today = datetime.now(user_tz).date()
+    lines = ["🔥 Tus rachas de hábitos\n"]
+    for description, current_streak, best_streak, last_checkin_date in streaks:
+        # La racha guardada sigue viva solo si el último check-in fue hoy o ayer
+        if last_checkin_date is None or last_checkin_date < today - timedelta(days=1):
+            current_streak = 0
+        done_today = " ✅" if last_checkin_date == today else ""
+        lines.append(f"• {description}: {current_streak} día(s) (mejor: {best_streak}){done_today}")
+    await update.message.reply_text("\n".join(lines))
+
+
+async def dispatch_habit_digests():
+    """
+    Tick por minuto del scheduler: lanza el envío de cada bucket desde el último minuto despachado
+    hasta el actual (hasta HABIT_DIGEST_MAX_CATCHUP_MINUTES atrás). Si una ejecución se saltó o
+    empezó tarde, los minutos intermedios se recuperan en vez de perderse. Los envíos corren
+    en tareas aparte, así que el tick termina enseguida aunque haya flood waits.
+    """
+    global _last_digest_minute
+    current = datetime.now(ZoneInfo('UTC')).replace(second=0, microsecond=0)
+    first = current - timedelta(minutes=max(0, HABIT_DIGEST_MAX_CATCHUP_MINUTES - 1))
+    if _last_digest_minute is None:
+        first = current # Al arrancar no se sabe qué se despachó antes: solo el minuto actual
+    elif _last_digest_minute >= first:
+        first = _last_digest_minute + timedelta(minutes=1)
+    elif first > _last_digest_minute + timedelta(minutes=1):
+        logger.warning(f"Resúmenes de hábitos: se omiten los buckets entre {_last_digest_minute:%H:%M} y {first:%H:%M} UTC (atraso excesivo).")
+
+    minute = first
+    while minute <= current:
+        if minute != current:
+            logger.info(f"Recuperando el bucket de resúmenes de hábitos de las {minute:%H:%M} UTC.")
+        task = asyncio.create_task(send_daily_habits(minute.hour * 60 + minute.minute))
+        _digest_sends.add(task)
+        task.add_done_callback(_digest_send_done)
+        _last_digest_minute = minute
+        minute += timedelta(minutes=1)
+
+
+def _digest_send_done(task: asyncio.Task):
+    _digest_sends.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Error al enviar un bucket de resúmenes de hábitos: {task.exception()}", exc_info=task.exception())
+
+
+async def send_daily_habits(reminder_minute: int):
+    """
+    Envía el resumen diario de hábitos a los usuarios de un bucket (minuto UTC del día).
+    Lo lanza dispatch_habit_digests; usa el bot de envíos salientes y solo toca a los
+    usuarios que eligieron ese minuto.
+    """
+    async with get_db() as db:
+        rows = await get_habit_digest_rows(db, reminder_minute)
+    if not rows:
+        return
+
+    habits_by_user = {}
+    for telegram_id, user_habit_id, description in rows:
+        habits_by_user.setdefault(telegram_id, []).append((user_habit_id, description))
+
+    logger.info(f"Enviando recordatorios de hábitos del bucket {reminder_minute} a {len(habits_by_user)} usuarios.")
+    bot = await get_outbound_bot()
+    for telegram_id, habits in habits_by_user.items():
+        message_text = (
+            "🔔 Recordatorio Diario de Hábitos\n\nRecuerda practicar hoy:\n"
+            + "\n".join(f"  - {description}" for _, description in habits)
+            + "\n\nToca un hábito cuando lo hayas hecho para sumar a tu racha."
+        )
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"✅ {_button_label(description)}", callback_data=f"hc:{user_habit_id}")]
+            for user_habit_id, description in habits
+        ])
+        status = await send_message_safely(
+            telegram_id, message_text, bot=bot, source="habit_digest", parse_mode='Markdown', reply_markup=keyboard
+        )
+        if status == SEND_OK:
+            logger.info(f"Recordatorio de hábitos enviado a {telegram_id}.")
+        else:
+            logger.warning(f"Recordatorio de hábitos para {telegram_id} no entregado ({status}).")
+
+    logger.info(f"Envío de recordatorios de hábitos del bucket {reminder_minute} finalizado.")
+
+
+async def refresh_habit_digest_buckets():
+    """
+    Recalcula los buckets UTC de los resúmenes de hábitos (cambios de horario de verano).
+    Solo toca las zonas horarias cuyo offset cambió desde la última pasada (todas en la primera
+    del proceso); la mayoría de las horas no escribe nada y no lee ninguna fila de usuario.
+    """
+    global _bucket_zone_offsets
+    async with get_db() as db:
+        offsets = {zone: timezone_utc_offset(zone) for zone in await get_user_timezones(db)}
+        changed = {zone: offset for zone, offset in offsets.items() if _bucket_zone_offsets.get(zone) != offset}
+        if changed:
+            await refresh_habit_reminder_buckets(db, changed)
+    _bucket_zone_offsets = offsets
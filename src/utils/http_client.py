@@ -0,0 +1,48 @@
+import os
+import logging
+
+import httpx
+
+# El circuit breaker vive aparte (sin dependencias) para poder probarlo sin httpx; se reexporta aquí
+from src.utils.circuit_breaker import CircuitBreaker, CircuitOpenError
+
+# Configuración del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Límites del pool compartido y timeouts estrictos (en segundos) para APIs externas
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "5"))
+
+# Cliente HTTP asíncrono compartido: reutiliza conexiones (keep-alive) entre peticiones
+_http_client: httpx.AsyncClient | None = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Devuelve el cliente HTTP asíncrono compartido, creándolo la primera vez."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+            timeout=httpx.Timeout(
+                connect=HTTP_CONNECT_TIMEOUT,
+                read=HTTP_READ_TIMEOUT,
+                write=HTTP_READ_TIMEOUT,
+                pool=HTTP_CONNECT_TIMEOUT,
+            ),
+        )
+        logger.info("Cliente HTTP compartido inicializado.")
+    return _http_client
+
+
+async def close_http_client():
+    """Cierra el cliente HTTP compartido y su pool de conexiones."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+        logger.info("Cliente HTTP compartido cerrado.")
@@ -0,0 +1,201 @@
+import os
+import asyncio
+import logging
+import math
+from collections import deque
+
+# Configuración del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Puerto del endpoint HTTP de métricas (formato texto de Prometheus). 0 lo desactiva.
+# Por defecto solo escucha en localhost; para exponerlo (ej. a Prometheus en otro contenedor) usar METRICS_HOST=0.0.0.0.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Segundos máximos para recibir la petición completa; las conexiones lentas o inactivas se cierran
+METRICS_READ_TIMEOUT = float(os.getenv("METRICS_READ_TIMEOUT", "5"))
+# Cada cuántos segundos se escribe el resumen de métricas en el log. 0 lo desactiva.
+METRICS_LOG_INTERVAL = int(os.getenv("METRICS_LOG_INTERVAL", "300"))
+# Cantidad de muestras recientes que se guardan por histograma para calcular percentiles
+METRICS_RESERVOIR_SIZE = int(os.getenv("METRICS_RESERVOIR_SIZE", "2048"))
+
+# Registro en memoria de este proceso. Las claves son (nombre, etiquetas ordenadas).
+_counters = {}
+_gauges = {}
+_histograms = {}
+_help = {}
+
+_server = None
+
+
+def _key(name: str, labels: dict = None) -> tuple:
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def describe(name: str, help_text: str):
+    """Registra el texto de ayuda de una métrica para el endpoint de Prometheus."""
+    _help[name] = help_text
+
+
+def increment(name: str, labels: dict = None, value: float = 1):
+    """Incrementa un contador."""
+    key = _key(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, labels: dict = None):
+    """Fija el valor actual de un gauge."""
+    _gauges[_key(name, labels)] = value
+
+
+def clear_gauges(name: str):
+    """Elimina todas las series de un gauge (útil antes de volver a calcularlo completo)."""
+    for key in [key for key in _gauges if key[0] == name]:
+        del _gauges[key]
+
+
+def add_gauge(name: str, delta: float, labels: dict = None):
+    """Suma (o resta) al valor actual de un gauge."""
+    key = _key(name, labels)
+    _gauges[key] = _gauges.get(key, 0) + delta
+
+
+def observe(name: str, value: float, labels: dict = None):
+    """Registra una observación en un histograma (conteo, suma y muestras recientes)."""
+    key = _key(name, labels)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = {"count": 0, "sum": 0.0, "samples": deque(maxlen=METRICS_RESERVOIR_SIZE)}
+        _histograms[key] = histogram
+    histogram["count"] += 1
+    histogram["sum"] += value
+    histogram["samples"].append(value)
+
+
+def _percentile(sorted_samples: list, q: float) -> float:
+    if not sorted_samples:
+        return 0.0
+    index = max(0, math.ceil(q * len(sorted_samples)) - 1)
+    return sorted_samples[index]
+
+
+def get_counter(name: str, labels: dict = None) -> float:
+    return _counters.get(_key(name, labels), 0)
+
+
+def get_percentiles(name: str, labels: dict = None, quantiles=(0.5, 0.95, 0.99)) -> dict:
+    """Devuelve los percentiles de las muestras recientes de un histograma."""
+    histogram = _histograms.get(_key(name, labels))
+    samples = sorted(histogram["samples"]) if histogram else []
+    return {q: _percentile(samples, q) for q in quantiles}
+
+
+def _format_labels(labels: tuple, extra: dict = None) -> str:
+    items = list(labels) + list((extra or {}).items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def render_prometheus() -> str:
+    """Serializa todas las métricas en el formato de texto de Prometheus."""
+    lines = []
+    emitted_headers = set()
+
+    def header(name, metric_type):
+        if name in emitted_headers:
+            return
+        emitted_headers.add(name)
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} {metric_type}")
+
+    for (name, labels), value in sorted(_counters.items()):
+        header(name, "counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), value in sorted(_gauges.items()):
+        header(name, "gauge")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), histogram in sorted(_histograms.items()):
+        header(name, "summary")
+        samples = sorted(histogram["samples"])
+        for q in (0.5, 0.95, 0.99):
+            lines.append(f"{name}{_format_labels(labels, {'quantile': q})} {_percentile(samples, q)}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def summary_lines() -> list[str]:
+    """Genera un resumen legible de contadores, gauges y percentiles para el log."""
+    lines = []
+    for (name, labels), histogram in sorted(_histograms.items()):
+        samples = sorted(histogram["samples"])
+        lines.append(
+            f"{name}{_format_labels(labels)} n={histogram['count']} "
+            f"p50={_percentile(samples, 0.5):.3f} p95={_percentile(samples, 0.95):.3f} p99={_percentile(samples, 0.99):.3f}"
+        )
+    for (name, labels), value in sorted(_counters.items()):
+        lines.append(f"{name}{_format_labels(labels)} {value:g}")
+    for (name, labels), value in sorted(_gauges.items()):
+        lines.append(f"{name}{_format_labels(labels)} {value:g}")
+    return lines
+
+
+def log_metrics_summary():
+    """Escribe en el log el resumen periódico de métricas."""
+    lines = summary_lines()
+    if lines:
+        logger.info("Resumen de métricas:\n  " + "\n  ".join(lines))
+
+
+async def _read_request_line(reader: asyncio.StreamReader) -> bytes:
+    request_line = await reader.readline()
+    # Descartar las cabeceras de la petición
+    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+        pass
+    return request_line
+
+
+async def _handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(_read_request_line(reader), METRICS_READ_TIMEOUT)
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            body = render_prometheus().encode("utf-8")
+            status = "200 OK"
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body = b"Not Found\n"
+            status = "404 Not Found"
+            content_type = "text/plain; charset=utf-8"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.debug(f"Error al atender una petición de métricas: {e}")
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str = None, port: int = None):
+    """
+    Inicia el endpoint HTTP GET /metrics en el event loop actual.
+    No hace nada si el puerto configurado es 0 o si ya está iniciado.
+    """
+    global _server
+    port = METRICS_PORT if port is None else port
+    if not port or _server is not None:
+        return
+    _server = await asyncio.start_server(_handle_metrics_request, host or METRICS_HOST, port)
+    logger.info(f"Endpoint de métricas disponible en http://{host or METRICS_HOST}:{port}/metrics")
+
+
+async def stop_metrics_server():
+    """Detiene el endpoint HTTP de métricas, si está iniciado."""
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
@@ -0,0 +1,167 @@
+import os
+import asyncio
+import logging
+import time
+
+from telegram import Bot
+from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError, TelegramError
+from dotenv import load_dotenv
+
+from src.database.db_context import get_db
+from src.database.database_interation import deactivate_user_by_telegram_id
+from src.utils import metrics
+
+load_dotenv()
+
+# Configuración del logger para este módulo
+logger = logging.getLogger(__name__)
+
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+
+# Reintentos ante errores transitorios (flood control, timeouts, red)
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+OUTBOUND_BACKOFF_BASE = float(os.getenv("OUTBOUND_BACKOFF_BASE", "1.0"))
+
+# Resultados de send_message_safely
+SEND_OK = "ok"
+SEND_FAILED = "failed"
+SEND_UNREACHABLE = "unreachable" # El usuario bloqueó el bot o el chat no existe
+
+# Mensajes de BadRequest que indican que el chat no volverá a aceptar mensajes
+_UNREACHABLE_BAD_REQUESTS = ("chat not found", "user is deactivated", "peer_id_invalid")
+
+# Instante (time.monotonic) hasta el que Telegram pidió no enviar (RetryAfter).
+# Es compartido por todos los envíos del proceso para que una ráfaga respete el flood control.
+_flood_wait_until = 0.0
+
+# Funciones a llamar cuando un usuario pasa a inactivo: reciben (chat_id, task_ids)
+_unreachable_listeners = []
+
+metrics.describe("outbound_send_seconds", "Duración de cada envío saliente, incluyendo reintentos y esperas.")
+metrics.describe("outbound_sends_total", "Envíos salientes por origen y resultado.")
+metrics.describe("outbound_errors_total", "Errores de la API de Telegram en envíos salientes por clase de error.")
+
+# Instancia compartida del bot para los envíos salientes (recordatorios y hábitos).
+# Se reutiliza entre envíos para no abrir un pool de conexiones nuevo por mensaje.
+_outbound_bot: Bot | None = None
+
+
+async def get_outbound_bot(bot_token: str = None) -> Bot:
+    """
+    Devuelve la instancia compartida de Bot usada para los envíos salientes,
+    creándola e inicializándola la primera vez que se pide.
+    """
+    global _outbound_bot
+    token = bot_token or TELEGRAM_BOT_TOKEN
+    if _outbound_bot is None or _outbound_bot.token != token:
+        if not token:
+            raise ValueError("TELEGRAM_BOT_TOKEN no está configurado. No se pueden enviar mensajes.")
+        bot = Bot(token=token)
+        await bot.initialize()
+        _outbound_bot = bot
+        logger.info("Bot de envíos salientes inicializado.")
+    return _outbound_bot
+
+
+async def shutdown_outbound_bot():
+    """Cierra las conexiones del bot de envíos salientes, si existe."""
+    global _outbound_bot
+    if _outbound_bot is not None:
+        await _outbound_bot.shutdown()
+        _outbound_bot = None
+        logger.info("Bot de envíos salientes cerrado.")
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    """Devuelve los segundos de espera pedidos por Telegram (int o timedelta según la versión)."""
+    retry_after = error.retry_after
+    if hasattr(retry_after, "total_seconds"):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+async def _wait_for_flood_control():
+    """Espera si algún envío anterior recibió un RetryAfter que todavía está vigente."""
+    delay = _flood_wait_until - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+def add_unreachable_listener(listener):
+    """
+    Registra una función que se llama con (chat_id, task_ids) cuando un usuario
+    se marca como inactivo, por ejemplo para cancelar sus recordatorios.
+    """
+    if listener not in _unreachable_listeners:
+        _unreachable_listeners.append(listener)
+
+
+async def _mark_chat_unreachable(chat_id: int, reason: str):
+    """Marca al usuario como inactivo para excluirlo de futuros envíos."""
+    logger.warning(f"El chat {chat_id} no acepta mensajes ({reason}). Marcando al usuario como inactivo.")
+    try:
+        async with get_db() as db:
+            task_ids = await deactivate_user_by_telegram_id(db, chat_id)
+    except Exception as e:
+        logger.error(f"Error al marcar como inactivo al usuario {chat_id}: {e}", exc_info=True)
+        return
+    for listener in _unreachable_listeners:
+        try:
+            listener(chat_id, task_ids)
+        except Exception as e:
+            logger.error(f"Error en el listener de usuario inactivo {chat_id}: {e}", exc_info=True)
+
+
+async def send_message_safely(chat_id: int, text: str, bot: Bot = None, source: str = "otro", **kwargs) -> str:
+    """
+    Envía un mensaje respetando el flood control de Telegram.
+    - RetryAfter: espera lo indicado (para todos los envíos del proceso) y reintenta.
+    - TimedOut/NetworkError: reintenta con backoff exponencial.
+    - Forbidden o chat inexistente: marca al usuario como inactivo y no reintenta.
+    `source` identifica el origen del envío en las métricas (ej. 'reminder', 'habit_digest').
+    :return: SEND_OK, SEND_FAILED o SEND_UNREACHABLE.
+    """
+    started = time.monotonic()
+    status = await _send_with_retries(chat_id, text, bot, **kwargs)
+    metrics.observe("outbound_send_seconds", time.monotonic() - started, {"source": source})
+    metrics.increment("outbound_sends_total", {"source": source, "result": status})
+    return status
+
+
+async def _send_with_retries(chat_id: int, text: str, bot: Bot = None, **kwargs) -> str:
+    global _flood_wait_until
+    bot = bot or await get_outbound_bot()
+
+    for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+        await _wait_for_flood_control()
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            return SEND_OK
+        except RetryAfter as e:
+            metrics.increment("outbound_errors_total", {"error": type(e).__name__})
+            delay = _retry_after_seconds(e)
+            _flood_wait_until = max(_flood_wait_until, time.monotonic() + delay)
+            logger.warning(f"Flood control al enviar a {chat_id}: esperando {delay:.0f}s (intento {attempt + 1}).")
+        except Forbidden as e:
+            metrics.increment("outbound_errors_total", {"error": type(e).__name__})
+            await _mark_chat_unreachable(chat_id, str(e))
+            return SEND_UNREACHABLE
+        except BadRequest as e:
+            metrics.increment("outbound_errors_total", {"error": type(e).__name__})
+            if any(reason in str(e).lower() for reason in _UNREACHABLE_BAD_REQUESTS):
+                await _mark_chat_unreachable(chat_id, str(e))
+                return SEND_UNREACHABLE
+            logger.error(f"Solicitud inválida al enviar mensaje a {chat_id}: {e}")
+            return SEND_FAILED
+        except (TimedOut, NetworkError) as e:
+            metrics.increment("outbound_errors_total", {"error": type(e).__name__})
+            delay = OUTBOUND_BACKOFF_BASE * (2 ** attempt)
+            logger.warning(f"Error de red al enviar a {chat_id}: {e}. Reintentando en {delay:.1f}s (intento {attempt + 1}).")
+            await asyncio.sleep(delay)
+        except TelegramError as e:
+            metrics.increment("outbound_errors_total", {"error": type(e).__name__})
+            logger.error(f"Error de Telegram al enviar mensaje a {chat_id}: {e}")
+            return SEND_FAILED
+
+    logger.error(f"No se pudo enviar el mensaje a {chat_id} después de {OUTBOUND_MAX_RETRIES + 1} intentos.")
+    return SEND_FAILED
@@ -1,24 +1,33 @@
 import asyncio
 import datetime
 import os
+import time
 import logging
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-from telegram import Bot
-
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm import Session, contains_eager
 from dotenv import load_dotenv
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.executors.asyncio import AsyncIOExecutor
 from apscheduler.triggers.date import DateTrigger
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED
 
 from src.database.db_context import AsyncSessionLocal, get_db
-from src.database.database_interation import get_task_by_id, get_user_by_telegram_id, mark_as_completed
+from src.database.database_interation import (
+    get_task_by_id, get_user_by_telegram_id, mark_as_completed,
+    enqueue_scheduler_commands, claim_scheduler_commands, archive_completed_tasks_batch,
+    rollup_daily_stats
+)
 from src.database.models import UserTask, User
+from src.utils.outbound import send_message_safely, add_unreachable_listener, SEND_OK
+from src.utils.habits_api import dispatch_habit_digests, refresh_habit_digest_buckets
+from src.utils.agenda import invalidate_today_agenda
+from src.utils import metrics
 import sqlalchemy as sa
 from sqlalchemy import select
 
@@ -48,6 +57,41 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
 SQLALCHEMY_JOBSTORE_DATABASE_URL = os.getenv("DATABASE_URL").replace("+asyncpg", "")
 
+# Modo de despliegue:
+#   'all'        -> un único proceso con el bot interactivo y el scheduler (por defecto)
+#   'bot'        -> solo el bot interactivo; la programación se delega al dispatcher vía DB
+#   'dispatcher' -> solo el scheduler y los envíos salientes (src/bot/dispatcher.py)
+BOT_MODE = os.getenv("BOT_MODE", "all").strip().lower()
+SCHEDULER_IS_REMOTE = BOT_MODE == "bot"
+
+RECURRING_FREQUENCIES = ['diaria', 'semanal', 'mensual', 'anual']
+
+# Minutos hacia adelante que se miran para el gauge de jobs pendientes por minuto
+METRICS_HORIZON_MINUTES = int(os.getenv("METRICS_HORIZON_MINUTES", "15"))
+
+# Archivado nocturno: las tareas completadas hace más de TASK_ARCHIVE_AFTER_DAYS días pasan a
+# user_tasks_archive en lotes de TASK_ARCHIVE_BATCH_SIZE, con una pausa entre lotes. 0 días lo desactiva.
+TASK_ARCHIVE_AFTER_DAYS = int(os.getenv("TASK_ARCHIVE_AFTER_DAYS", "30"))
+TASK_ARCHIVE_BATCH_SIZE = int(os.getenv("TASK_ARCHIVE_BATCH_SIZE", "500"))
+TASK_ARCHIVE_BATCH_PAUSE = float(os.getenv("TASK_ARCHIVE_BATCH_PAUSE", "0.5"))
+TASK_ARCHIVE_MAX_BATCHES = int(os.getenv("TASK_ARCHIVE_MAX_BATCHES", "200"))
+TASK_ARCHIVE_HOUR = int(os.getenv("TASK_ARCHIVE_HOUR", "4"))
+
+# Estadísticas diarias: cada STATS_ROLLUP_INTERVAL_MINUTES se recalculan los últimos STATS_ROLLUP_DAYS
+# días y al arrancar los últimos STATS_BACKFILL_DAYS (0 lo omite). Intervalo 0 desactiva el recalculo.
+STATS_ROLLUP_INTERVAL_MINUTES = int(os.getenv("STATS_ROLLUP_INTERVAL_MINUTES", "60"))
+STATS_ROLLUP_DAYS = int(os.getenv("STATS_ROLLUP_DAYS", "2"))
+STATS_BACKFILL_DAYS = int(os.getenv("STATS_BACKFILL_DAYS", "35"))
+
+metrics.describe("scheduler_job_lag_seconds", "Retraso entre la hora programada de un job y su disparo real.")
+metrics.describe("scheduler_job_runs_total", "Ejecuciones de jobs del scheduler por tipo y resultado.")
+metrics.describe("scheduler_jobstore_jobs", "Cantidad de jobs en cada jobstore.")
+metrics.describe("scheduler_pending_jobs", "Jobs con disparo previsto en cada uno de los próximos minutos.")
+metrics.describe("dispatcher_commands_total", "Órdenes de la cola del dispatcher aplicadas por acción.")
+metrics.describe("tasks_archived_total", "Tareas completadas movidas a user_tasks_archive.")
+metrics.describe("task_archive_run_seconds", "Duración de cada pasada del archivado de tareas.")
+metrics.describe("stats_rollup_run_seconds", "Duración de cada recalculo de las estadísticas diarias.")
+
 if not TELEGRAM_BOT_TOKEN:
     logger.warning("Advertencia: TELEGRAM_BOT_TOKEN no está configurado en scheduler.py. Esto podría causar fallos al enviar mensajes.")
 if not SQLALCHEMY_JOBSTORE_DATABASE_URL:
@@ -70,6 +114,10 @@ def setup_scheduler():
                 "default": {
                     'type': 'sqlalchemy',
                     'url': SQLALCHEMY_JOBSTORE_DATABASE_URL
+                },
+                # Jobs periódicos propios del proceso (no se persisten en la DB)
+                "volatile": {
+                    'type': 'memory'
                 }
             },
             executors={
@@ -83,6 +131,10 @@ def setup_scheduler():
         )
         logger.info("APScheduler persistente configurado exitosamente.")
 
+        # Cuando un usuario bloquea el bot se cancelan sus recordatorios pendientes
+        add_unreachable_listener(_unschedule_unreachable_user)
+        scheduler.add_listener(_record_job_event, EVENT_JOB_SUBMITTED | EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+
         if not scheduler.running:
             scheduler.start()
             logger.info("APScheduler persistente iniciado.")
@@ -100,13 +152,91 @@ def get_scheduler():
     return persistent_scheduler
 
 
+# --- Métricas del scheduler ---
+
+def _job_kind(job_id: str) -> str:
+    """Agrupa los IDs de jobs por tipo para que las métricas no tengan una serie por tarea."""
+    if job_id.startswith("instant_reminder_"):
+        return "instant_reminder"
+    if job_id.startswith("recurring_task_"):
+        return "recurring_task"
+    return job_id
+
+
+def _record_job_event(event):
+    """Listener de APScheduler: registra el retraso de disparo y el resultado de cada job."""
+    kind = _job_kind(event.job_id)
+    if event.code == EVENT_JOB_SUBMITTED:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for run_time in event.scheduled_run_times:
+            metrics.observe("scheduler_job_lag_seconds", (now - run_time).total_seconds(), {"job": kind})
+    elif event.code == EVENT_JOB_EXECUTED:
+        metrics.increment("scheduler_job_runs_total", {"job": kind, "outcome": "ok"})
+    elif event.code == EVENT_JOB_ERROR:
+        metrics.increment("scheduler_job_runs_total", {"job": kind, "outcome": type(event.exception).__name__})
+    elif event.code == EVENT_JOB_MISSED:
+        metrics.increment("scheduler_job_runs_total", {"job": kind, "outcome": "missed"})
+
+
+def collect_scheduler_metrics():
+    """Actualiza los gauges de tamaño de los jobstores y de jobs pendientes por minuto."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    horizon = [0] * METRICS_HORIZON_MINUTES
+    metrics.clear_gauges("scheduler_jobstore_jobs")
+    for jobstore in ("default", "volatile"):
+        jobs = persistent_scheduler.get_jobs(jobstore=jobstore)
+        metrics.set_gauge("scheduler_jobstore_jobs", len(jobs), {"jobstore": jobstore})
+        for job in jobs:
+            if job.next_run_time is None:
+                continue
+            minute = int((job.next_run_time - now).total_seconds() // 60)
+            if 0 <= minute < METRICS_HORIZON_MINUTES:
+                horizon[minute] += 1
+    for minute, count in enumerate(horizon):
+        metrics.set_gauge("scheduler_pending_jobs", count, {"minute": f"+{minute}"})
+
+
+def schedule_metrics_jobs():
+    """
+    Programa en el jobstore en memoria la recolección periódica de métricas del scheduler
+    y el resumen periódico en el log.
+    """
+    persistent_scheduler.add_job(
+        collect_scheduler_metrics,
+        IntervalTrigger(seconds=60),
+        id="metrics_collect",
+        jobstore='volatile',
+        replace_existing=True,
+        coalesce=True,
+        next_run_time=datetime.datetime.now(datetime.timezone.utc)
+    )
+    if metrics.METRICS_LOG_INTERVAL > 0:
+        persistent_scheduler.add_job(
+            metrics.log_metrics_summary,
+            IntervalTrigger(seconds=metrics.METRICS_LOG_INTERVAL),
+            id="metrics_log_summary",
+            jobstore='volatile',
+            replace_existing=True,
+            coalesce=True
+        )
+    logger.info("Programada la recolección periódica de métricas del scheduler.")
+
+
 # --- Funciones de recordatorio para APScheduler ---
 
+def _unschedule_unreachable_user(chat_id: int, task_ids: list[int]):
+    """Cancela los recordatorios de un usuario que bloqueó el bot o cuyo chat no existe."""
+    removed = unschedule_task_jobs(task_ids)
+    logger.info(f"Cancelados {removed} jobs del usuario inactivo {chat_id}.")
+
+
 async def send_reminder(bot_token: str, chat_id: int, message: str, task_id: int = None):
     """Envía un recordatorio de una tarea al usuario."""
-    bot = Bot(token=bot_token)
     try:
-        await bot.send_message(chat_id=chat_id, text=message)
+        status = await send_message_safely(chat_id, message, source="reminder")
+        if status != SEND_OK:
+            logger.warning(f"Recordatorio para el chat {chat_id} no entregado ({status}).")
+            return
         logger.info(f"Recordatorio enviado a {chat_id}: {message}")
 
         if task_id:
@@ -115,6 +245,7 @@ async def send_reminder(bot_token: str, chat_id: int, message: str, task_id: int
 
                 if task and (task.frequency is None or task.frequency == 'una vez'):
                     await mark_as_completed(db, task_id)
+                    invalidate_today_agenda(chat_id)
                     logger.info(f"Tarea única {task_id} marcada como completada después de enviar recordatorio.")
                     job_id_prefix_once = f"instant_reminder_{task_id}"
                     
@@ -131,7 +262,6 @@ async def send_reminder(bot_token: str, chat_id: int, message: str, task_id: int
                     logger.warning(f"Tarea {task_id} no encontrada o ya procesada al intentar marcar como completada.")
     except Exception as e:
         logger.error(f"Error al enviar el recordatorio al chat {chat_id}: {e}", exc_info=True)
-    # ELIMINADA LA LÍNEA: finally: await bot.session.close()
 
 
 async def schedule_all_due_tasks_for_persistence():
@@ -158,8 +288,10 @@ async def schedule_all_due_tasks_for_persistence():
 
         result = await db.execute(
             select(UserTask)
-            .options(joinedload(UserTask.user))
+            .join(UserTask.user)
+            .options(contains_eager(UserTask.user))
             .filter(
+                User.is_active == True,
                 UserTask.completed == False,
                 UserTask.due_date != None,
                 UserTask.due_date > now_aware_scheduler_tz.astimezone(ZoneInfo('UTC')),
@@ -177,11 +309,13 @@ async def schedule_all_due_tasks_for_persistence():
 
         result = await db.execute(
             select(UserTask)
-            .options(joinedload(UserTask.user))
+            .join(UserTask.user)
+            .options(contains_eager(UserTask.user))
             .filter(
+                User.is_active == True,
                 UserTask.completed == False,
                 UserTask.due_date != None,
-                UserTask.frequency.in_(['diaria', 'semanal', 'mensual', 'anual'])
+                UserTask.frequency.in_(RECURRING_FREQUENCIES)
             )
         )
         recurring_tasks = result.scalars().all()
@@ -200,7 +334,9 @@ async def schedule_instant_reminder(task_id: int):
     async with get_db() as db:
         task = await get_task_by_id(db, task_id)
 
-        if task and task.due_date and task.user and task.user.telegram_id:
+        if task and task.user and not task.user.is_active:
+            logger.info(f"El usuario de la tarea {task_id} está inactivo. No se programa recordatorio.")
+        elif task and task.due_date and task.user and task.user.telegram_id:
             task_due_datetime_utc_aware = task.due_date
 
             run_date_in_scheduler_tz = task_due_datetime_utc_aware.astimezone(persistent_scheduler.timezone)
@@ -265,7 +401,9 @@ async def schedule_recurring_task(task_id: int, frequency: str):
     async with get_db() as db:
         task = await get_task_by_id(db, task_id)
 
-        if task and task.due_date and task.user and task.user.telegram_id:
+        if task and task.user and not task.user.is_active:
+            logger.info(f"El usuario de la tarea {task_id} está inactivo. No se programa recordatorio.")
+        elif task and task.due_date and task.user and task.user.telegram_id:
             chat_id = task.user.telegram_id
             
             task_due_datetime_utc_aware = task.due_date
@@ -349,5 +487,221 @@ async def schedule_recurring_task(task_id: int, frequency: str):
             except Exception as e:
                 logger.error(f"Error al añadir job recurrente {job_id} al scheduler: {e}", exc_info=True)
         else:
-            logger.warning(f"No se pudo programar el recordatorio recurrente para la tarea {task.id}: no encontrado, sin fecha, o el usuario/telegram_id no disponible.")
+            logger.warning(f"No se pudo programar el recordatorio recurrente para la tarea {task_id}: no encontrado, sin fecha, o el usuario/telegram_id no disponible.")
     logger.debug(f"DEBUG: async with block exited successfully for recurring task {task_id}.")
+
+
+# --- Programación/cancelación de tareas independiente del proceso ---
+
+async def schedule_task_reminders(task_id: int):
+    """
+    Programa el recordatorio que corresponda a la tarea (único o recurrente)
+    según su frecuencia guardada en la base de datos.
+    """
+    async with get_db() as db:
+        task = await get_task_by_id(db, task_id)
+    if not task or not task.due_date or task.completed:
+        logger.debug(f"Tarea {task_id} inexistente, sin fecha o completada. No se programa recordatorio.")
+        return
+    if not task.frequency or task.frequency == 'una vez':
+        await schedule_instant_reminder(task.id)
+    elif task.frequency in RECURRING_FREQUENCIES:
+        await schedule_recurring_task(task.id, task.frequency)
+
+
+def unschedule_task_jobs(task_ids: list[int]) -> int:
+    """
+    Elimina del scheduler local todos los jobs (únicos y recurrentes) de las tareas indicadas.
+    Retorna la cantidad de jobs eliminados.
+    """
+    instant_ids = {f"instant_reminder_{task_id}" for task_id in task_ids}
+    recurring_prefixes = tuple(f"recurring_task_{task_id}_" for task_id in task_ids)
+    removed = 0
+    for job in list(persistent_scheduler.get_jobs()):
+        if job.id and (job.id in instant_ids or job.id.startswith(recurring_prefixes)):
+            try:
+                persistent_scheduler.remove_job(job.id)
+                removed += 1
+                logger.info(f"Job {job.id} eliminado del scheduler.")
+            except Exception as e:
+                logger.error(f"Error al eliminar el job {job.id} del scheduler: {e}", exc_info=True)
+    return removed
+
+
+async def request_task_schedule(task_id: int, frequency: str = None):
+    """
+    Punto de entrada para que los handlers programen el recordatorio de una tarea.
+    En modo 'bot' se encola la orden para el dispatcher; en otro caso se programa localmente.
+    """
+    if SCHEDULER_IS_REMOTE:
+        async with get_db() as db:
+            await enqueue_scheduler_commands(db, 'schedule', [task_id])
+        logger.info(f"Programación de la tarea {task_id} delegada al dispatcher.")
+    elif not frequency or frequency == 'una vez':
+        await schedule_instant_reminder(task_id)
+    elif frequency in RECURRING_FREQUENCIES:
+        await schedule_recurring_task(task_id, frequency)
+
+
+async def request_task_unschedule(task_ids: list[int]):
+    """
+    Punto de entrada para que los handlers cancelen los recordatorios de tareas.
+    En modo 'bot' se encola la orden para el dispatcher; en otro caso se cancela localmente.
+    """
+    if not task_ids:
+        return
+    if SCHEDULER_IS_REMOTE:
+        async with get_db() as db:
+            await enqueue_scheduler_commands(db, 'unschedule', list(task_ids))
+        logger.info(f"Cancelación de recordatorios de las tareas {list(task_ids)} delegada al dispatcher.")
+    else:
+        unschedule_task_jobs(list(task_ids))
+
+
+async def process_scheduler_commands(limit: int = 100) -> int:
+    """
+    Aplica en el scheduler local las órdenes encoladas por el bot interactivo.
+    Se usa desde el proceso dispatcher. Retorna la cantidad de órdenes procesadas.
+    """
+    async with get_db() as db:
+        commands = await claim_scheduler_commands(db, limit)
+
+    # Las cancelaciones se aplican juntas en una sola pasada por los jobs (ej. /delete_task 1-50).
+    # Se aplican antes que las programaciones del mismo lote para no cancelar un job recién creado.
+    unschedule_ids = []
+    for command_id, action, task_id in commands:
+        metrics.increment("dispatcher_commands_total", {"action": action})
+        if action == 'unschedule':
+            unschedule_ids.append(task_id)
+        elif action != 'schedule':
+            logger.warning(f"Orden {command_id} con acción desconocida '{action}'. Se descarta.")
+    if unschedule_ids:
+        try:
+            unschedule_task_jobs(unschedule_ids)
+        except Exception as e:
+            logger.error(f"Error al cancelar los jobs de las tareas {unschedule_ids[:20]}: {e}", exc_info=True)
+
+    for command_id, action, task_id in commands:
+        if action != 'schedule':
+            continue
+        try:
+            await schedule_task_reminders(task_id)
+        except Exception as e:
+            logger.error(f"Error al aplicar la orden {command_id} ('{action}' tarea {task_id}): {e}", exc_info=True)
+    return len(commands)
+
+
+async def schedule_habit_digests():
+    """
+    Programa en el scheduler local el despacho de los resúmenes diarios de hábitos.
+    Un job corre cada minuto y lanza el envío del bucket de ese minuto (y de los que se
+    hayan saltado, ver dispatch_habit_digests); otro recalcula los buckets cada hora para seguir los cambios de horario de verano.
+    Los jobs viven en el jobstore en memoria para que cada proceso que corre
+    el scheduler los registre al iniciar.
+    """
+    await refresh_habit_digest_buckets()
+
+    persistent_scheduler.add_job(
+        dispatch_habit_digests,
+        CronTrigger(second=0, timezone=ZoneInfo('UTC')),
+        id="habit_digest_tick",
+        jobstore='volatile',
+        replace_existing=True,
+        coalesce=True,
+        misfire_grace_time=50
+    )
+    persistent_scheduler.add_job(
+        refresh_habit_digest_buckets,
+        CronTrigger(minute=1, timezone=ZoneInfo('UTC')),
+        id="habit_digest_bucket_refresh",
+        jobstore='volatile',
+        replace_existing=True,
+        coalesce=True
+    )
+    logger.info("Programado el despacho por minuto de los resúmenes diarios de hábitos.")
+
+
+async def archive_completed_tasks() -> int:
+    """
+    Mueve a user_tasks_archive las tareas completadas hace más de TASK_ARCHIVE_AFTER_DAYS días.
+    Trabaja en lotes cortos (cada uno en su propia transacción) con una pausa entre ellos para
+    no competir con el tráfico del bot, y se detiene tras TASK_ARCHIVE_MAX_BATCHES lotes;
+    lo que quede se archiva en la pasada siguiente. Retorna la cantidad de tareas archivadas.
+    """
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=TASK_ARCHIVE_AFTER_DAYS)
+    started = time.monotonic()
+    archived = 0
+    for batch in range(TASK_ARCHIVE_MAX_BATCHES):
+        if batch:
+            await asyncio.sleep(TASK_ARCHIVE_BATCH_PAUSE)
+        async with get_db() as db:
+            moved = await archive_completed_tasks_batch(db, cutoff, TASK_ARCHIVE_BATCH_SIZE)
+        archived += moved
+        metrics.increment("tasks_archived_total", value=moved)
+        if moved < TASK_ARCHIVE_BATCH_SIZE:
+            break
+    metrics.observe("task_archive_run_seconds", time.monotonic() - started)
+    logger.info(f"Archivado de tareas: {archived} tareas completadas antes de {cutoff:%Y-%m-%d} movidas a user_tasks_archive.")
+    return archived
+
+
+def schedule_task_archiving():
+    """Programa en el jobstore en memoria el archivado nocturno de tareas completadas."""
+    if TASK_ARCHIVE_AFTER_DAYS <= 0:
+        logger.info("Archivado de tareas desactivado (TASK_ARCHIVE_AFTER_DAYS=0).")
+        return
+    persistent_scheduler.add_job(
+        archive_completed_tasks,
+        CronTrigger(hour=TASK_ARCHIVE_HOUR, minute=17),
+        id="task_archive",
+        jobstore='volatile',
+        replace_existing=True,
+        coalesce=True,
+        misfire_grace_time=3600
+    )
+    logger.info(f"Programado el archivado diario de tareas completadas hace más de {TASK_ARCHIVE_AFTER_DAYS} días.")
+
+
+async def rollup_stats(days: int = STATS_ROLLUP_DAYS) -> int:
+    """
+    Recalcula user_daily_stats y global_daily_stats de los últimos `days` días.
+    Se cuenta desde la fecha UTC más un día de margen, para cubrir a los usuarios
+    cuya fecha local todavía no llegó (o ya pasó) la de UTC.
+    """
+    since = datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=days)
+    started = time.monotonic()
+    async with get_db() as db:
+        written = await rollup_daily_stats(db, since)
+    metrics.observe("stats_rollup_run_seconds", time.monotonic() - started)
+    logger.info(f"Estadísticas diarias recalculadas desde {since:%Y-%m-%d}: {written} filas de usuario.")
+    return written
+
+
+def schedule_stats_rollup():
+    """
+    Programa en el jobstore en memoria el recalculo periódico de las estadísticas diarias
+    y, al arrancar, una pasada más larga que cubre el último mes.
+    """
+    if STATS_ROLLUP_INTERVAL_MINUTES <= 0:
+        logger.info("Recalculo de estadísticas desactivado (STATS_ROLLUP_INTERVAL_MINUTES=0).")
+        return
+    persistent_scheduler.add_job(
+        rollup_stats,
+        IntervalTrigger(minutes=STATS_ROLLUP_INTERVAL_MINUTES),
+        id="stats_rollup",
+        jobstore='volatile',
+        replace_existing=True,
+        coalesce=True,
+        max_instances=1
+    )
+    if STATS_BACKFILL_DAYS > 0:
+        persistent_scheduler.add_job(
+            rollup_stats,
+            DateTrigger(run_date=datetime.datetime.now(datetime.timezone.utc)),
+            args=[STATS_BACKFILL_DAYS],
+            id="stats_rollup_backfill",
+            jobstore='volatile',
+            replace_existing=True,
+            misfire_grace_time=3600
+        )
+    logger.info(f"Programado el recalculo de estadísticas diarias cada {STATS_ROLLUP_INTERVAL_MINUTES} minutos.")
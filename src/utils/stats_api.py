@@ -0,0 +1,89 @@
+import os
+import logging
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from telegram import Update
+from telegram.ext import ContextTypes
+from src.database.database_interation import StatsSummary, get_user_stats, get_global_stats
+from src.database.db_context import get_db
+
+logger = logging.getLogger(__name__)
+
+# IDs de Telegram de los operadores que pueden ver /admin_stats, separados por comas
+ADMIN_TELEGRAM_IDS = frozenset(
+    int(value) for value in os.getenv("ADMIN_TELEGRAM_IDS", "").replace(" ", "").split(",") if value
+)
+
+
+def _percent(part: int, total: int) -> str:
+    return f"{min(100, round(100 * part / total))}%" if total else "—"
+
+
+def _period_lines(label: str, created: int, completed: int, habits: int, possible_habits: int | None) -> list[str]:
+    lines = [
+        f"{label}",
+        f"  • Tareas creadas: {created}",
+        f"  • Tareas completadas: {completed} ({_percent(completed, created)} de las creadas)",
+    ]
+    if possible_habits is None:
+        lines.append(f"  • Hábitos cumplidos: {habits}")
+    else:
+        lines.append(f"  • Hábitos cumplidos: {habits} de {possible_habits} ({_percent(habits, possible_habits)})")
+    return lines
+
+
+def render_stats(title: str, summary: StatsSummary, habit_count: int | None = None) -> str:
+    """Texto del informe de la última semana y el último mes. Con `habit_count` muestra el cumplimiento de hábitos."""
+    lines = [title, ""]
+    lines += _period_lines(
+        "📅 Últimos 7 días", summary.week_created, summary.week_completed, summary.week_habits,
+        habit_count * 7 if habit_count else None
+    )
+    lines.append("")
+    lines += _period_lines(
+        "🗓️ Últimos 30 días", summary.month_created, summary.month_completed, summary.month_habits,
+        habit_count * 30 if habit_count else None
+    )
+    return "\n".join(lines)
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Maneja el comando /stats: actividad del usuario en la última semana y el último mes.
+    Lee solo los resúmenes diarios ya calculados (se actualizan periódicamente).
+    """
+    telegram_user_id = update.effective_user.id
+    try:
+        async with get_db() as db:
+            stats = await get_user_stats(db, telegram_user_id)
+    except Exception as e:
+        logger.error(f"Error al obtener las estadísticas del usuario {telegram_user_id}: {e}", exc_info=True)
+        await update.message.reply_text("Lo siento, hubo un error al obtener tus estadísticas.")
+        return
+
+    if stats is None:
+        await update.message.reply_text("Error: No estás registrado. Por favor, usa /start primero.")
+        return
+    summary, habit_count = stats
+    text = render_stats("📊 Tus estadísticas", summary, habit_count)
+    await update.message.reply_text(text + "\n\nLas estadísticas se actualizan periódicamente: lo de las últimas horas puede no aparecer todavía.")
+
+
+async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Maneja el comando /admin_stats: resumen de todos los usuarios, solo para ADMIN_TELEGRAM_IDS."""
+    telegram_user_id = update.effective_user.id
+    if telegram_user_id not in ADMIN_TELEGRAM_IDS:
+        logger.warning(f"Usuario {telegram_user_id} intentó usar /admin_stats sin permiso.")
+        await update.message.reply_text("Este comando está reservado a los operadores del bot.")
+        return
+
+    try:
+        async with get_db() as db:
+            summary, max_active_users = await get_global_stats(db, datetime.now(ZoneInfo('UTC')).date())
+    except Exception as e:
+        logger.error(f"Error al obtener las estadísticas globales: {e}", exc_info=True)
+        await update.message.reply_text("Lo siento, hubo un error al obtener las estadísticas globales.")
+        return
+
+    text = render_stats("📈 Estadísticas globales", summary)
+    await update.message.reply_text(f"{text}\n\n👥 Máximo de usuarios activos en un día (30 días): {max_active_users}")
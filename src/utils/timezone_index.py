@@ -0,0 +1,135 @@
+import math
+import logging
+from functools import lru_cache
+
+import pytz
+
+from src.utils.city_index import City, CityIndex, get_city_index
+
+# Configuración del logger para este módulo
+logger = logging.getLogger(__name__)
+
+# Nombres en español de los países (pytz.country_names solo los trae en inglés).
+# Cubre los países de habla hispana y los más consultados; el resto se busca en inglés.
+SPANISH_COUNTRY_NAMES = {
+    "AR": ["Argentina"], "BO": ["Bolivia"], "CL": ["Chile"], "CO": ["Colombia"], "CR": ["Costa Rica"],
+    "CU": ["Cuba"], "DO": ["República Dominicana"], "EC": ["Ecuador"], "SV": ["El Salvador"],
+    "GQ": ["Guinea Ecuatorial"], "GT": ["Guatemala"], "HN": ["Honduras"], "MX": ["México", "Mejico"],
+    "NI": ["Nicaragua"], "PA": ["Panamá"], "PY": ["Paraguay"], "PE": ["Perú"], "PR": ["Puerto Rico"],
+    "ES": ["España"], "UY": ["Uruguay"], "VE": ["Venezuela"],
+    "US": ["Estados Unidos", "EEUU", "EE UU", "USA"], "CA": ["Canadá"], "BR": ["Brasil"],
+    "GB": ["Reino Unido", "Inglaterra", "Gran Bretaña"], "IE": ["Irlanda"], "FR": ["Francia"],
+    "DE": ["Alemania"], "IT": ["Italia"], "PT": ["Portugal"], "NL": ["Países Bajos", "Holanda"],
+    "BE": ["Bélgica"], "CH": ["Suiza"], "AT": ["Austria"], "SE": ["Suecia"], "NO": ["Noruega"],
+    "DK": ["Dinamarca"], "FI": ["Finlandia"], "PL": ["Polonia"], "CZ": ["Chequia", "República Checa"],
+    "GR": ["Grecia"], "TR": ["Turquía"], "RU": ["Rusia"], "UA": ["Ucrania"], "RO": ["Rumanía", "Rumania"],
+    "HU": ["Hungría"], "MA": ["Marruecos"], "DZ": ["Argelia"], "EG": ["Egipto"], "ZA": ["Sudáfrica"],
+    "NG": ["Nigeria"], "KE": ["Kenia"], "IL": ["Israel"], "SA": ["Arabia Saudita", "Arabia Saudí"],
+    "AE": ["Emiratos Árabes Unidos"], "IN": ["India"], "CN": ["China"], "JP": ["Japón"],
+    "KR": ["Corea del Sur"], "PH": ["Filipinas"], "TH": ["Tailandia"], "ID": ["Indonesia"],
+    "AU": ["Australia"], "NZ": ["Nueva Zelanda"], "JM": ["Jamaica"], "HT": ["Haití"],
+}
+
+
+def _parse_zone_tab_coordinate(text: str, degree_digits: int) -> float:
+    """Convierte una coordenada de zone.tab (±DDMM o ±DDMMSS) a grados decimales."""
+    sign = -1 if text[0] == "-" else 1
+    digits = text[1:]
+    degrees = int(digits[:degree_digits])
+    minutes = int(digits[degree_digits:degree_digits + 2])
+    seconds = int(digits[degree_digits + 2:] or 0)
+    return sign * (degrees + minutes / 60 + seconds / 3600)
+
+
+def load_zone_tab() -> list[City]:
+    """
+    Lee zone.tab de pytz: una entrada por zona IANA con el país y las coordenadas
+    de su ciudad principal (name=zona, country=código ISO).
+    """
+    zones = []
+    with pytz.open_resource("zone.tab") as f:
+        for raw_line in f:
+            line = raw_line.decode("utf-8").strip()
+            if not line or line.startswith("#"):
+                continue
+            country, coordinates, zone = line.split("\t")[:3]
+            split_at = max(coordinates.rfind("+"), coordinates.rfind("-"))
+            lat = _parse_zone_tab_coordinate(coordinates[:split_at], 2)
+            lon = _parse_zone_tab_coordinate(coordinates[split_at:], 3)
+            zones.append(City(zone, country, lat, lon))
+    return zones
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distancia en km sobre la esfera terrestre entre dos coordenadas."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(a))
+
+
+class TimezoneIndex:
+    """
+    Índice en memoria para resolver una zona horaria desde texto libre o coordenadas.
+    Cada zona IANA se indexa por su nombre completo, su ciudad, su país y los nombres
+    (y alias en español) de las ciudades del índice de ciudades más cercanas a ella.
+    """
+
+    def __init__(self, zones: list[City], city_index: CityIndex = None):
+        self.zones = zones
+        self._by_country = {}
+        for zi, zone in enumerate(zones):
+            self._by_country.setdefault(zone.country, []).append(zi)
+
+        aliases = []
+        for zone in zones:
+            readable = zone.name.replace("_", " ")
+            names = [readable, readable.rsplit("/", 1)[-1]]
+            country_name = pytz.country_names.get(zone.country)
+            if country_name:
+                names.append(country_name)
+            names.extend(SPANISH_COUNTRY_NAMES.get(zone.country, []))
+            aliases.append(names)
+
+        if city_index is not None:
+            for name, idx in city_index.iter_names():
+                city = city_index.get(idx)
+                zi = self._nearest_index(city.lat, city.lon, self._by_country.get(city.country))
+                if zi is not None:
+                    aliases[zi].append(name)
+
+        # El nombre legible (con espacios) también se indexa completo, ej. "america/argentina/buenos aires"
+        self._index = CityIndex(
+            (City(readable_names[0], zone.country, zone.lat, zone.lon), readable_names[1:])
+            for zone, readable_names in zip(zones, aliases)
+        )
+
+    def _nearest_index(self, lat: float, lon: float, candidates: list[int] = None) -> int | None:
+        candidates = candidates or range(len(self.zones))
+        best, best_distance = None, float("inf")
+        for zi in candidates:
+            zone = self.zones[zi]
+            distance = haversine_km(lat, lon, zone.lat, zone.lon)
+            if distance < best_distance:
+                best, best_distance = zi, distance
+        return best
+
+    def nearest_zone(self, lat: float, lon: float) -> str | None:
+        """Zona IANA cuya ciudad principal está más cerca de las coordenadas."""
+        zi = self._nearest_index(lat, lon)
+        return self.zones[zi].name if zi is not None else None
+
+    def search(self, text: str, limit: int = 6) -> tuple[list[str], bool]:
+        """
+        Busca zonas por nombre de zona, ciudad o país.
+        :return: (zonas IANA, True si son coincidencias exactas).
+        """
+        indices, exact = self._index.search(text.replace("_", " "), limit)
+        return [self.zones[zi].name for zi in indices], exact
+
+
+@lru_cache(maxsize=1)
+def get_timezone_index() -> TimezoneIndex:
+    """Construye (una sola vez) el índice de zonas horarias."""
+    index = TimezoneIndex(load_zone_tab(), get_city_index())
+    logger.info(f"Índice de zonas horarias construido: {len(index.zones)} zonas.")
+    return index
@@ -1,68 +1,217 @@
 import os
-import requests
+import time
+import asyncio
+import logging
+
+import httpx
 from dotenv import load_dotenv
 
 # Importaciones específicas de python-telegram-bot que necesita este módulo
-from telegram import Update
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
 
+from src.utils.http_client import get_http_client, CircuitBreaker, CircuitOpenError
+from src.utils.cache import AsyncTTLCache
+from src.utils.city_index import City, get_city_index, normalize_city
+from src.utils.conversation_state import release_user_data
+from src.utils import metrics
+
 # Carga la API Key de OpenWeather
 load_dotenv() #Esto permite que se cargue la constante OPENWEATHER_API_KEY
 OPENWEATHER_API_KEY = os.getenv("OPENWEATHER_API_KEY") 
+# Configurable para poder probar contra un servidor local que simule la API
+OPENWEATHER_BASE_URL = os.getenv("OPENWEATHER_BASE_URL", "https://api.openweathermap.org/data/2.5/weather")
 
-async def start_weather_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Inicia la conversación para obtener el clima."""
-    await update.message.reply_text("Por favor, ingresa el nombre de la ciudad para la cual quieres saber el clima:")
-    return 0 # Estado para esperar el nombre de la ciudad
+logger = logging.getLogger(__name__)
 
-async def get_weather(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Obtiene y muestra el clima para la ciudad ingresada."""
-    city = update.message.text.strip()
-    api_key = OPENWEATHER_API_KEY
-    base_url = "http://api.openweathermap.org/data/2.5/weather"
-    params = {
-        "q": city,
-        "appid": api_key,
+# Estados de la conversación del clima
+WEATHER_CITY_INPUT, WEATHER_CITY_SELECT = range(2)
+
+# Tras varios fallos seguidos de OpenWeather se deja de consultar un rato
+# en lugar de hacer esperar a cada usuario hasta el timeout.
+weather_circuit = CircuitBreaker(
+    "openweather",
+    failure_threshold=int(os.getenv("OPENWEATHER_CIRCUIT_THRESHOLD", "5")),
+    reset_timeout=float(os.getenv("OPENWEATHER_CIRCUIT_RESET", "30")),
+)
+
+# El clima cambia despacio: se guarda por ciudad y, ya vencido, se sigue sirviendo
+# un rato más mientras se actualiza en segundo plano.
+weather_cache = AsyncTTLCache(
+    "weather",
+    ttl=float(os.getenv("WEATHER_CACHE_TTL", "600")),
+    stale_ttl=float(os.getenv("WEATHER_CACHE_STALE", "1800")),
+    max_entries=int(os.getenv("WEATHER_CACHE_MAX_ENTRIES", "1024")),
+)
+
+metrics.describe("weather_upstream_seconds", "Duración de las consultas a OpenWeather.")
+metrics.describe("weather_upstream_requests_total", "Consultas a OpenWeather por resultado.")
+
+
+class CityNotFoundError(Exception):
+    """OpenWeather no reconoce la ciudad consultada."""
+
+
+async def fetch_weather(params: dict) -> dict:
+    """
+    Consulta el clima actual a OpenWeather con el cliente HTTP compartido.
+    :param params: Parámetros de búsqueda (ej. {"q": "Salta"} o {"lat": ..., "lon": ...}).
+    :return: El JSON de la respuesta.
+    :raises CityNotFoundError: si la ciudad no existe (404).
+    :raises CircuitOpenError: si el circuito está abierto por fallos previos.
+    :raises httpx.HTTPError: ante timeouts, errores de red o respuestas 5xx.
+    :raises ValueError: si la respuesta no es JSON válido.
+    """
+    weather_circuit.before_request()
+    request_params = {
+        **params,
+        "appid": OPENWEATHER_API_KEY,
         "units": "metric", # Para obtener grados Celsius
         "lang": "es"       # Para obtener la descripción en español
     }
-
+    started = time.monotonic()
+    result = "ok"
     try:
-        response = requests.get(base_url, params=params)
+        response = await get_http_client().get(OPENWEATHER_BASE_URL, params=request_params)
+        if response.status_code == 404:
+            # La ciudad no existe: el servicio responde bien, no cuenta como fallo del circuito
+            result = "not_found"
+            weather_circuit.record_success()
+            raise CityNotFoundError(params.get("q"))
         response.raise_for_status() # Lanza un error para códigos de estado HTTP erróneos
-        weather_data = response.json()
-
-        if weather_data["cod"] == 200: # Si la respuesta es exitosa
-            main_data = weather_data["main"]
-            weather_desc = weather_data["weather"][0]["description"]
-            city_name = weather_data["name"]
-            country_name = weather_data["sys"]["country"]
-
-            temperature = main_data["temp"]
-            feels_like = main_data["feels_like"]
-            humidity = main_data["humidity"]
-
-            message = (
-                f"El clima en {city_name}, {country_name}:\n"
-                f"🌡️ Temperatura: {temperature}°C\n"
-                f"🥶 Sensación térmica: {feels_like}°C\n"
-                f"☁️ Descripción: {weather_desc.capitalize()}\n"
-                f"💧 Humedad: {humidity}%"
-            )
-        else:
-            message = f"No se pudo encontrar el clima para '{city}'. Por favor, verifica el nombre de la ciudad."
-
-    except requests.exceptions.RequestException as e:
-        message = f"Lo siento, no pude conectar con el servicio del clima. Error: {e}"
-    except KeyError:
-        message = f"Hubo un problema al procesar los datos del clima para '{city}'. Asegúrate de que el nombre de la ciudad es correcto."
+        data = response.json()
+        weather_circuit.record_success()
+        return data
+    except CityNotFoundError:
+        raise
+    except asyncio.CancelledError:
+        weather_circuit.abort_request()
+        raise
+    except Exception as e:
+        # httpx.HTTPError, un cuerpo que no es JSON (ValueError) o cualquier otro error: cuenta como
+        # fallo y libera la petición de prueba del circuito semiabierto
+        result = type(e).__name__
+        weather_circuit.record_failure()
+        raise
+    finally:
+        metrics.observe("weather_upstream_seconds", time.monotonic() - started)
+        metrics.increment("weather_upstream_requests_total", {"result": result})
+
+
+async def get_weather_for_city(city: str) -> dict:
+    """Devuelve el clima de una ciudad, usando la caché y compartiendo consultas simultáneas."""
+    return await weather_cache.get_or_load(("q", normalize_city(city)), lambda: fetch_weather({"q": city}))
+
+
+async def get_weather_for_place(city: City) -> dict:
+    """Devuelve el clima de una ciudad del índice consultando por sus coordenadas."""
+    key = ("geo", round(city.lat, 2), round(city.lon, 2))
+    return await weather_cache.get_or_load(key, lambda: fetch_weather({"lat": city.lat, "lon": city.lon}))
+
+
+def format_weather_message(weather_data: dict, place_label: str = None) -> str:
+    """
+    Arma el mensaje para el usuario a partir de la respuesta de OpenWeather.
+    :param place_label: Nombre a mostrar; por defecto, el que devuelve OpenWeather.
+    """
+    main_data = weather_data["main"]
+    weather_desc = weather_data["weather"][0]["description"]
+    if place_label is None:
+        place_label = f"{weather_data['name']}, {weather_data['sys']['country']}"
+
+    temperature = main_data["temp"]
+    feels_like = main_data["feels_like"]
+    humidity = main_data["humidity"]
+
+    return (
+        f"El clima en {place_label}:\n"
+        f"🌡️ Temperatura: {temperature}°C\n"
+        f"🥶 Sensación térmica: {feels_like}°C\n"
+        f"☁️ Descripción: {weather_desc.capitalize()}\n"
+        f"💧 Humedad: {humidity}%"
+    )
+
+
+async def _weather_reply(city_text: str, place: City = None) -> str:
+    """Consulta el clima (por coordenadas si hay una ciudad del índice) y devuelve el mensaje a mostrar."""
+    try:
+        if place is not None:
+            return format_weather_message(await get_weather_for_place(place), place.label)
+        return format_weather_message(await get_weather_for_city(city_text))
+    except CityNotFoundError:
+        return f"No se pudo encontrar el clima para '{city_text}'. Por favor, verifica el nombre de la ciudad."
+    except CircuitOpenError:
+        return "El servicio del clima no está disponible en este momento. Por favor, intenta de nuevo en unos minutos."
+    except httpx.TimeoutException:
+        logger.warning(f"Timeout al consultar el clima para '{city_text}'.")
+        return "El servicio del clima tardó demasiado en responder. Por favor, intenta de nuevo más tarde."
+    except httpx.HTTPError as e:
+        logger.warning(f"Error al consultar el clima para '{city_text}': {e}")
+        return "Lo siento, no pude conectar con el servicio del clima. Por favor, intenta de nuevo más tarde."
+    except (KeyError, IndexError):
+        return f"Hubo un problema al procesar los datos del clima para '{city_text}'. Asegúrate de que el nombre de la ciudad es correcto."
     except Exception as e:
-        message = f"Ocurrió un error inesperado: {e}"
+        logger.error(f"Error inesperado al obtener el clima para '{city_text}': {e}", exc_info=True)
+        return "Ocurrió un error inesperado al obtener el clima."
+
+
+async def start_weather_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Inicia la conversación para obtener el clima."""
+    await update.message.reply_text("Por favor, ingresa el nombre de la ciudad para la cual quieres saber el clima:")
+    return WEATHER_CITY_INPUT # Estado para esperar el nombre de la ciudad
+
+async def get_weather(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Busca la ciudad ingresada en el índice local. Si hay una única coincidencia exacta
+    muestra el clima directamente; si es ambigua o tiene errores ofrece sugerencias;
+    si no aparece en el índice se consulta a OpenWeather con el texto tal cual.
+    """
+    city = update.message.text.strip()
+    index = get_city_index()
+    indices, exact = index.search(city)
+
+    if exact and len(indices) == 1:
+        message = await _weather_reply(city, index.get(indices[0]))
+    elif indices:
+        context.user_data['weather_query'] = city
+        keyboard = [[InlineKeyboardButton(index.get(idx).label, callback_data=f"wcity_{idx}")] for idx in indices]
+        keyboard.append([InlineKeyboardButton(f"Buscar '{city[:40]}' tal cual", callback_data="wcity_raw")])
+        await update.message.reply_text(
+            "¿A cuál de estas ciudades te refieres?",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return WEATHER_CITY_SELECT
+    else:
+        message = await _weather_reply(city)
 
     await update.message.reply_text(message)
     return ConversationHandler.END # Termina la conversación
 
+async def select_weather_city(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Muestra el clima de la ciudad elegida entre las sugerencias."""
+    query = update.callback_query
+    await query.answer()
+    city_text = context.user_data.get('weather_query', "")
+    release_user_data(context, query.from_user.id, 'weather_query')
+    choice = query.data.removeprefix("wcity_")
+
+    if choice == "raw":
+        if not city_text:
+            await query.edit_message_text("La consulta expiró. Usa /clima para volver a empezar.")
+            return ConversationHandler.END
+        message = await _weather_reply(city_text)
+    else:
+        place = get_city_index().get(int(choice)) if choice.isdigit() else None
+        if place is None:
+            await query.edit_message_text("Ciudad no válida. Usa /clima para volver a empezar.")
+            return ConversationHandler.END
+        message = await _weather_reply(place.name, place)
+
+    await query.edit_message_text(message)
+    return ConversationHandler.END
+
 async def cancel_weather_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancela la conversación de consulta del clima."""
+    release_user_data(context, update.effective_user.id, 'weather_query')
     await update.message.reply_text("Consulta del clima cancelada.")
     return ConversationHandler.END
@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+
+from src.utils import cache
+from src.utils.cache import AsyncTTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(cache, "time", fake)
+    return fake
+
+
+class GatedLoader:
+    """Loader que cuenta sus llamadas y no termina hasta que se abre la compuerta."""
+
+    def __init__(self, value):
+        self.value = value
+        self.calls = 0
+        self.gate = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.gate.wait()
+        return self.value
+
+
+async def _settle():
+    """Deja correr a las tareas pendientes hasta que todas queden bloqueadas."""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_concurrent_misses_share_one_load(clock):
+    async def scenario():
+        ttl_cache = AsyncTTLCache("test", ttl=60)
+        loader = GatedLoader("value")
+        waiters = [asyncio.create_task(ttl_cache.get_or_load("key", loader)) for _ in range(10)]
+        await _settle()
+        loader.gate.set()
+        results = await asyncio.gather(*waiters)
+        assert results == ["value"] * 10
+        assert loader.calls == 1
+        # El valor quedó guardado: la siguiente consulta no vuelve a cargar
+        assert await ttl_cache.get_or_load("key", loader) == "value"
+        assert loader.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_stale_hit_triggers_exactly_one_refresh(clock):
+    async def scenario():
+        ttl_cache = AsyncTTLCache("test", ttl=10, stale_ttl=100)
+        ttl_cache.set("key", "old")
+        clock.now += 20
+        loader = GatedLoader("new")
+        # Mientras la recarga está en curso, todos reciben el valor vencido sin esperar
+        for _ in range(5):
+            assert await ttl_cache.get_or_load("key", loader) == "old"
+        await _settle()
+        assert loader.calls == 1
+        loader.gate.set()
+        await _settle()
+        assert await ttl_cache.get_or_load("key", loader) == "new"
+        assert loader.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_expired_past_stale_window_loads_again(clock):
+    async def scenario():
+        ttl_cache = AsyncTTLCache("test", ttl=10, stale_ttl=5)
+        ttl_cache.set("key", "old")
+        clock.now += 20
+        loader = GatedLoader("new")
+        loader.gate.set()
+        assert await ttl_cache.get_or_load("key", loader) == "new"
+        assert loader.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_invalidate_during_load_prevents_write_back(clock):
+    async def scenario():
+        ttl_cache = AsyncTTLCache("test", ttl=60)
+        loader = GatedLoader("old")
+        waiter = asyncio.create_task(ttl_cache.get_or_load("key", loader))
+        await _settle()
+        ttl_cache.invalidate("key")
+        loader.gate.set()
+        # Quien ya esperaba recibe el resultado, pero la caché no lo guarda
+        assert await waiter == "old"
+        assert "key" not in ttl_cache._entries
+
+        fresh = GatedLoader("new")
+        fresh.gate.set()
+        assert await ttl_cache.get_or_load("key", fresh) == "new"
+        assert fresh.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_load_errors_are_not_cached(clock):
+    async def scenario():
+        ttl_cache = AsyncTTLCache("test", ttl=60)
+
+        async def failing():
+            raise RuntimeError("boom")
+
+        with pytest.raises(RuntimeError):
+            await ttl_cache.get_or_load("key", failing)
+        loader = GatedLoader("value")
+        loader.gate.set()
+        assert await ttl_cache.get_or_load("key", loader) == "value"
+
+    asyncio.run(scenario())
@@ -0,0 +1,89 @@
+import pytest
+
+from src.utils import circuit_breaker
+from src.utils.circuit_breaker import CircuitBreaker, CircuitOpenError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(circuit_breaker, "time", fake)
+    return fake
+
+
+def _trip(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.before_request()
+        breaker.record_failure()
+
+
+def test_opens_after_threshold_failures(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.before_request()
+        breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.before_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_half_open_allows_a_single_probe(clock):
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=30)
+    _trip(breaker)
+    clock.now += 30
+    assert breaker.state == "half_open"
+    breaker.before_request()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+
+def test_successful_probe_closes_the_circuit(clock):
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=30)
+    _trip(breaker)
+    clock.now += 30
+    breaker.before_request()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.before_request()
+
+
+def test_failed_probe_reopens_for_a_full_reset_timeout(clock):
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=30)
+    _trip(breaker)
+    clock.now += 30
+    breaker.before_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    clock.now += 29
+    assert breaker.state == "open"
+    clock.now += 1
+    assert breaker.state == "half_open"
+    breaker.before_request()
+
+
+def test_aborted_probe_releases_the_slot(clock):
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=30)
+    _trip(breaker)
+    clock.now += 30
+    breaker.before_request()
+    breaker.abort_request()
+    breaker.before_request()
@@ -0,0 +1,57 @@
+from datetime import date, datetime, time
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from src.utils.date_parser import ParsedDueDate, parse_date_range, parse_date_text, parse_time_text
+
+TZ = "Europe/Madrid"
+# Miércoles 21/10/2026
+NOW = datetime(2026, 10, 21, 10, 0, tzinfo=ZoneInfo(TZ))
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("lunes a viernes", (date(2026, 10, 26), date(2026, 10, 30))),
+    ("de lunes a viernes", (date(2026, 10, 26), date(2026, 10, 30))),
+    ("viernes a lunes", (date(2026, 10, 23), date(2026, 10, 26))),
+    ("pasado mañana", (date(2026, 10, 23), date(2026, 10, 23))),
+    ("el viernes", (date(2026, 10, 23), date(2026, 10, 23))),
+    ("mañana", (date(2026, 10, 22), date(2026, 10, 22))),
+    ("hoy a mañana", (date(2026, 10, 21), date(2026, 10, 22))),
+    ("22/10 25/10", (date(2026, 10, 22), date(2026, 10, 25))),
+    ("25/10 5/11", (date(2026, 10, 25), date(2026, 11, 5))),
+    ("1 de noviembre | 15 de noviembre", (date(2026, 11, 1), date(2026, 11, 15))),
+    ("1 de noviembre 15 de noviembre", (date(2026, 11, 1), date(2026, 11, 15))),
+    ("mañana al viernes", (date(2026, 10, 22), date(2026, 10, 23))),
+])
+def test_parse_date_range(text, expected):
+    assert parse_date_range(text, TZ, NOW) == expected
+
+
+def test_parse_date_range_end_before_start_is_reported():
+    first_day, last_day = parse_date_range("25/10/2026 | 20/10/2026", TZ, NOW)
+    assert last_day < first_day
+
+
+def test_parse_date_range_rejects_too_many_parts():
+    assert parse_date_range("lunes | martes | miércoles", TZ, NOW) is None
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("12 de la noche", time(0, 0)),
+    ("11 de la noche", time(23, 0)),
+    ("12 de la tarde", time(12, 0)),
+    ("6pm", time(18, 0)),
+    ("6 p.m.", time(18, 0)),
+    ("6 p.m", time(18, 0)),
+    ("7 a.m.", time(7, 0)),
+    ("12 a.m.", time(0, 0)),
+    ("25:00", None),
+])
+def test_parse_time_text(text, expected):
+    assert parse_time_text(text) == expected
+
+
+def test_parse_date_text_with_dotted_pm_uses_fast_path():
+    parsed = parse_date_text("mañana 6 p.m.", TZ, NOW)
+    assert parsed == ParsedDueDate(date(2026, 10, 22), time(18, 0))
@@ -0,0 +1,70 @@
+import asyncio
+import random
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip("telegram")
+
+from telegram import Chat, Message, Update
+
+from src.bot.update_processor import PerChatUpdateProcessor
+
+
+def _update(update_id: int, chat_id: int) -> Update:
+    chat = Chat(id=chat_id, type=Chat.PRIVATE)
+    message = Message(message_id=update_id, date=datetime.now(timezone.utc), chat=chat, text="/hoy")
+    return Update(update_id=update_id, message=message)
+
+
+def test_same_chat_updates_run_in_order_and_chats_run_concurrently():
+    async def scenario():
+        processor = PerChatUpdateProcessor(8)
+        started, finished = {}, {}
+        running = {"now": 0, "max": 0}
+
+        async def handle(chat_id: int, seq: int):
+            started.setdefault(chat_id, []).append(seq)
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+            # Dentro de un chat, nadie empieza antes de que termine el anterior
+            assert len(started[chat_id]) == len(finished.get(chat_id, [])) + 1
+            await asyncio.sleep(random.uniform(0, 0.005))
+            running["now"] -= 1
+            finished.setdefault(chat_id, []).append(seq)
+
+        calls = []
+        update_id = 0
+        for seq in range(10):
+            for chat_id in (1, 2, 3):
+                update_id += 1
+                calls.append(processor.process_update(_update(update_id, chat_id), handle(chat_id, seq)))
+        await asyncio.gather(*calls)
+
+        for chat_id in (1, 2, 3):
+            assert started[chat_id] == list(range(10))
+            assert finished[chat_id] == list(range(10))
+        assert running["max"] > 1
+        # Los locks por chat se liberan al terminar
+        assert processor._chat_locks == {}
+
+    asyncio.run(scenario())
+
+
+def test_concurrency_limit_is_respected():
+    async def scenario():
+        processor = PerChatUpdateProcessor(2)
+        running = {"now": 0, "max": 0}
+
+        async def handle():
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+            await asyncio.sleep(0.001)
+            running["now"] -= 1
+
+        await asyncio.gather(*(
+            processor.process_update(_update(chat_id, chat_id), handle()) for chat_id in range(1, 11)
+        ))
+        assert running["max"] == 2
+
+    asyncio.run(scenario())